@@ -0,0 +1,223 @@
+"""Benchmark delle query di Gestione Roll su dati sintetici, senza interfaccia grafica.
+
+Genera un database usa e getta con movimenti realistici e misura i percorsi di
+aggiornamento e di report usati dalle viste. Esempi:
+
+    python benchmark_roll.py --giorni 730 --movimenti-giorno 200
+    python benchmark_roll.py --giorni 3650 --movimenti-giorno 300 --json > risultati.json
+    python benchmark_roll.py --db grande.db --riusa      # rimisura un database già generato
+    python benchmark_roll.py --compatto                  # stessi dati nel formato compatto
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from supporti_db import (
+    apri_database, inserimento_massivo, calcola_saldo, chiudi_mesi, converti_in_compatto, layout_compatto,
+    ricostruisci_riepilogo,
+    inserisci_movimenti, inserisci_lotto, elimina_inserimento,
+    dati_pagina_storico, dati_dettaglio_giorno, dati_cauzioni, dati_resi, dati_giorno, dati_report,
+    esporta_movimenti, andamento,
+)
+
+MAGAZZINI = ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
+ARTICOLI = ['Roll', 'Griglia', 'Cassetta CPR']
+PESI_ARTICOLI = [5, 3, 2]
+GIORNI_PER_PAGINA = 60
+
+
+def genera_movimenti(giorni, magazzini, movimenti_giorno, fino_al, seme):
+    """Movimenti sintetici degli ultimi `giorni` giorni fino a `fino_al`, in ordine di data.
+
+    Il volume varia del ±50% da un giorno all'altro e la domenica è ridotto a un quinto;
+    Carne e Ortofrutta hanno solo entrate, Freschi e Secchi anche uscite (resi al CEDI).
+    """
+    casuale = random.Random(seme)
+    inizio = fino_al - timedelta(days=giorni - 1)
+    for n in range(giorni):
+        giorno = inizio + timedelta(days=n)
+        data = giorno.strftime('%Y-%m-%d')
+        volume = casuale.randint(movimenti_giorno // 2, movimenti_giorno * 3 // 2)
+        if giorno.weekday() == 6:
+            volume //= 5
+        for _ in range(volume):
+            magazzino = casuale.choice(magazzini)
+            if magazzino in ('Carne', 'Ortofrutta') or casuale.random() < 0.4:
+                direzione = 'ENTRATA'
+            else:
+                direzione = 'USCITA'
+            articolo = casuale.choices(ARTICOLI, PESI_ARTICOLI)[0]
+            yield data, articolo, direzione, magazzino, casuale.randint(1, 30)
+
+
+def misura(nome, funzione, ripetizioni, prima=None, dopo=None):
+    """Tempi di funzione() in millisecondi; prima/dopo girano fuori dal cronometro."""
+    tempi = []
+    esito = None
+    for _ in range(ripetizioni):
+        if prima:
+            prima()
+        inizio = time.perf_counter()
+        esito = funzione()
+        tempi.append((time.perf_counter() - inizio) * 1000)
+        if dopo:
+            dopo()
+    return {
+        'operazione': nome,
+        'mediana_ms': round(statistics.median(tempi), 3),
+        'min_ms': round(min(tempi), 3),
+        'max_ms': round(max(tempi), 3),
+        'righe': len(esito) if isinstance(esito, (list, dict, tuple)) else esito,
+    }
+
+
+def esegui_benchmark(conn, ripetizioni, cartella):
+    ultimo, primo = conn.execute('SELECT MAX(data), MIN(data) FROM riepilogo_giornaliero').fetchone()
+    giorno = date.fromisoformat(ultimo)
+    inizio_mese = giorno.replace(day=1).strftime('%Y-%m-%d')
+    meta = (date.fromisoformat(primo) + (giorno - date.fromisoformat(primo)) / 2).strftime('%Y-%m-%d')
+    # giorno da cui partirebbe l'ultima pagina dello Storico, la più lontana nel tempo
+    in_fondo = conn.execute('SELECT DISTINCT data FROM riepilogo_giornaliero ORDER BY data LIMIT 1 OFFSET ?',
+                            (GIORNI_PER_PAGINA,)).fetchone()
+    in_fondo = in_fondo[0] if in_fondo else None
+    file_csv = os.path.join(cartella, 'export_benchmark.csv')
+    nuovo = [(ultimo, 'Roll', 'ENTRATA', 'Carne', 3), (ultimo, 'Griglia', 'ENTRATA', 'Carne', 2),
+             (ultimo, 'Cassetta CPR', 'ENTRATA', 'Carne', 5)]
+
+    inseriti = []  # intervalli di id da annullare, come la pila della postazione nell'interfaccia
+
+    def inserisci():
+        inseriti.append(inserisci_movimenti(conn, nuovo))
+
+    def registra():
+        inserisci()
+        return dati_giorno(conn, ultimo)
+
+    def annulla():
+        elimina_inserimento(conn, *inseriti.pop())
+
+    lotto = [(ultimo, articolo, 'USCITA', magazzino, 1 + n)
+             for n, (magazzino, articolo) in enumerate((m, a) for m in ('Freschi', 'Secchi') for a in ARTICOLI)] * 4
+
+    def registra_lotto():
+        date_toccate, intervallo = inserisci_lotto(conn, lotto)
+        inseriti.append(intervallo)
+        return [dati_giorno(conn, data) for data in date_toccate]
+
+    def annulla_e_aggiorna():
+        annulla()
+        return dati_giorno(conn, ultimo)
+
+    # saldo totale letto da tutte le righe: misura il costo per riga del formato di memorizzazione
+    if layout_compatto(conn):
+        scansione = 'SELECT SUM(quantita) FROM movimenti_compatti'
+    else:
+        scansione = "SELECT SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE -quantita END) FROM movimenti"
+
+    return [
+        misura('scansione completa movimenti', lambda: conn.execute(scansione).fetchall(), ripetizioni),
+        misura('ricostruisci_riepilogo', lambda: ricostruisci_riepilogo(conn), min(ripetizioni, 3)),
+        misura('aggiorna_storico (prima pagina)',
+               lambda: dati_pagina_storico(conn, None, GIORNI_PER_PAGINA), ripetizioni),
+        misura('aggiorna_storico (ultima pagina)',
+               lambda: dati_pagina_storico(conn, in_fondo, GIORNI_PER_PAGINA), ripetizioni),
+        misura('toggle_giorno (dettaglio)', lambda: dati_dettaglio_giorno(conn, ultimo), ripetizioni),
+        misura('aggiorna_valore_cauzioniOFC (prima pagina)',
+               lambda: dati_cauzioni(conn, None, GIORNI_PER_PAGINA)[0], ripetizioni),
+        misura('aggiorna_cauzioni_resi (prima pagina)',
+               lambda: dati_resi(conn, None, GIORNI_PER_PAGINA)[0], ripetizioni),
+        misura('aggiorna_cauzioni_resi (tutto lo storico)', lambda: dati_resi(conn)[0], min(ripetizioni, 3)),
+        misura('genera_report (giorno)', lambda: dati_report(conn, ultimo, ultimo)[0], ripetizioni),
+        misura('genera_report (mese)', lambda: dati_report(conn, inizio_mese, ultimo)[0], ripetizioni),
+        misura('genera_report (tutto)', lambda: dati_report(conn, primo, ultimo)[0], ripetizioni),
+        misura('andamento (tutto lo storico)', lambda: andamento(conn, primo, ultimo, punti=900)['giorni'],
+               ripetizioni),
+        misura('calcola_saldo (articolo, magazzino)', lambda: calcola_saldo(conn, 'Roll', 'Carne'), ripetizioni),
+        misura('calcola_saldo (totale)', lambda: calcola_saldo(conn), ripetizioni),
+        misura('calcola_saldo (a metà storico)', lambda: calcola_saldo(conn, al=meta), ripetizioni),
+        misura('registrazione singola + aggiornamento giorno', registra, ripetizioni, dopo=annulla),
+        misura(f'registrazione lotto ({len(lotto)} movimenti) + aggiornamento',
+               registra_lotto, ripetizioni, dopo=annulla),
+        misura('annulla ultimo + aggiornamento giorno', annulla_e_aggiorna, ripetizioni,
+               prima=inserisci),
+        misura('esporta_csv (tutto)', lambda: esporta_movimenti(conn, file_csv), min(ripetizioni, 3)),
+    ]
+
+
+def stampa_tabella(dataset, risultati):
+    print(f"Dataset: formato {dataset['formato']}, {dataset['giorni']} giorni, {dataset['movimenti']:,} movimenti, "
+          f"{dataset['dimensione_mb']:.1f} MB (generato in {dataset['generazione_s']:.1f} s)")
+    print()
+    larghezza = max(len(r['operazione']) for r in risultati)
+    print(f"{'operazione':<{larghezza}}  {'mediana ms':>11}  {'min ms':>9}  {'max ms':>9}  {'righe':>8}")
+    print('-' * (larghezza + 46))
+    for r in risultati:
+        print(f"{r['operazione']:<{larghezza}}  {r['mediana_ms']:>11.3f}  {r['min_ms']:>9.3f}  "
+              f"{r['max_ms']:>9.3f}  {r['righe'] if r['righe'] is not None else '':>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark headless delle query di Gestione Roll su dati sintetici.")
+    parser.add_argument('--giorni', type=int, default=365, help="giorni di storico da generare (predefinito 365)")
+    parser.add_argument('--magazzini', type=int, default=4, choices=range(1, 5),
+                        help="quanti magazzini usare tra Carne, Ortofrutta, Freschi, Secchi (predefinito 4)")
+    parser.add_argument('--movimenti-giorno', type=int, default=100,
+                        help="movimenti medi per giorno (predefinito 100)")
+    parser.add_argument('--ripetizioni', type=int, default=5, help="ripetizioni per misura (predefinito 5)")
+    parser.add_argument('--seme', type=int, default=1, help="seme del generatore casuale")
+    parser.add_argument('--db', help="file del database generato (predefinito: temporaneo, cancellato alla fine)")
+    parser.add_argument('--riusa', action='store_true', help="non rigenera i dati se --db esiste già")
+    parser.add_argument('--compatto', action='store_true', help="misura il formato compatto dei movimenti")
+    parser.add_argument('--json', action='store_true', help="stampa i risultati in JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='benchmark_roll_') as cartella:
+        percorso = args.db or os.path.join(cartella, 'benchmark.db')
+        riusa = args.riusa and os.path.exists(percorso)
+        if not riusa and os.path.exists(percorso):
+            os.remove(percorso)
+
+        conn = apri_database(percorso)
+        inizio = time.perf_counter()
+        if not riusa:
+            righe = genera_movimenti(args.giorni, MAGAZZINI[:args.magazzini], args.movimenti_giorno,
+                                     date.today(), args.seme)
+            inserimento_massivo(conn, righe, blocco=50000)
+            chiudi_mesi(conn)  # come all'avvio del programma
+        if args.compatto and not layout_compatto(conn):
+            converti_in_compatto(conn)
+            conn.execute('ANALYZE')
+        generazione = time.perf_counter() - inizio
+
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')  # la dimensione misurata è quella del solo file
+        movimenti, giorni = conn.execute(
+            'SELECT COALESCE(SUM(num_movimenti), 0), COUNT(DISTINCT data) FROM riepilogo_giornaliero').fetchone()
+        if not movimenti:
+            print("Il database non contiene movimenti.", file=sys.stderr)
+            return 1
+        dataset = {
+            'formato': 'compatto' if layout_compatto(conn) else 'esteso',
+            'giorni': giorni,
+            'movimenti': movimenti,
+            'dimensione_mb': os.path.getsize(percorso) / 1e6,
+            'generazione_s': generazione,
+        }
+        risultati = esegui_benchmark(conn, args.ripetizioni, cartella)
+        conn.close()
+
+    if args.json:
+        json.dump({'dataset': dataset, 'risultati': risultati}, sys.stdout, indent=2)
+        print()
+    else:
+        stampa_tabella(dataset, risultati)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
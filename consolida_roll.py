@@ -0,0 +1,176 @@
+"""Consolidato di più punti vendita, ognuno con il suo supporti.db, senza interfaccia grafica.
+
+Per ogni file calcola in un processo a parte, con una connessione in sola lettura, gli
+stessi aggregati delle schede Report, Cauzioni C/O e Cauzioni e Resi più i saldi attuali,
+poi li somma per il gruppo. Esempi:
+
+    python consolida_roll.py negozi/*/supporti.db
+    python consolida_roll.py "negozi/**/supporti.db" --dal 2025-01-01 --al 2025-03-31
+    python consolida_roll.py a.db b.db c.db --per-giorno --processi 4
+    python consolida_roll.py negozi/*/supporti.db --json > consolidato.json
+
+Sotto Windows i caratteri jolly sono espansi dal programma stesso; i file di archivio annuale
+(<nome>_archivio_<anno>.db) vengono esclusi dall'espansione, li legge già il loro database, e
+così le copie di backup (<nome>_<AAAAMMGG-hhmmss>_<motivo>.db).
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+
+from supporti_db import riepilogo_punto_vendita, somma_punti_vendita
+
+MAGAZZINI = ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
+ARTICOLI = ['Roll', 'Griglia', 'Cassetta CPR']
+NON_PUNTI_VENDITA = re.compile(r'(_archivio_\d{4}|_\d{8}-\d{6}_[a-z_]+)\.db$')  # archivi annuali e backup
+
+
+def espandi_percorsi(argomenti):
+    """File dei punti vendita indicati, con i caratteri jolly espansi e senza doppioni."""
+    percorsi = []
+    for argomento in argomenti:
+        if glob.has_magic(argomento):
+            trovati = sorted(p for p in glob.glob(argomento, recursive=True) if not NON_PUNTI_VENDITA.search(p))
+        else:
+            trovati = [argomento]
+        for percorso in trovati:
+            if os.path.abspath(percorso) not in map(os.path.abspath, percorsi):
+                percorsi.append(percorso)
+    return percorsi
+
+
+def nomi_punti_vendita(percorsi):
+    """Nome breve di ogni file: il percorso senza la parte comune a tutti (es. Milano/supporti.db)."""
+    assoluti = [os.path.abspath(p) for p in percorsi]
+    if len(assoluti) < 2:
+        return {p: os.path.basename(a) for p, a in zip(percorsi, assoluti)}
+    comune = os.path.commonpath([os.path.dirname(a) for a in assoluti])
+    return {p: os.path.relpath(a, comune) for p, a in zip(percorsi, assoluti)}
+
+
+def leggi_punti_vendita(percorsi, dal, al, processi, riepiloghi, errori):
+    """Riempie riepiloghi {percorso: riepilogo} ed errori {percorso: messaggio}, un processo per file.
+
+    Restituisce i file rimasti senza esito perché un processo del pool è caduto.
+    """
+    interrotti = []
+    with ProcessPoolExecutor(max_workers=processi) as pool:
+        futuri = {pool.submit(riepilogo_punto_vendita, percorso, dal, al): percorso for percorso in percorsi}
+        for futuro in as_completed(futuri):
+            try:
+                riepiloghi[futuri[futuro]] = futuro.result()
+            except BrokenProcessPool:
+                interrotti.append(futuri[futuro])
+            except Exception as e:
+                errori[futuri[futuro]] = str(e) or type(e).__name__
+    return interrotti
+
+
+def consolida(percorsi, dal, al, processi=None):
+    """Riepilogo di ogni punto vendita, un processo per file, e la loro somma.
+
+    Qualunque errore resta del suo file: se un processo cade, e con lui tutto il pool, i file
+    rimasti in sospeso si rileggono uno per pool, così solo quello che lo ha fatto cadere
+    finisce tra gli errori. Restituisce (punti_vendita, errori, gruppo): punti_vendita
+    [(percorso, riepilogo)] ed errori [(percorso, messaggio)] nell'ordine dato.
+    """
+    riepiloghi, errori = {}, {}
+    for percorso in leggi_punti_vendita(percorsi, dal, al, processi, riepiloghi, errori):
+        if leggi_punti_vendita([percorso], dal, al, 1, riepiloghi, errori):
+            errori[percorso] = "il processo che leggeva il database si è interrotto"
+    punti_vendita = [(percorso, riepiloghi[percorso]) for percorso in percorsi if percorso in riepiloghi]
+    return (punti_vendita, [(percorso, errori[percorso]) for percorso in percorsi if percorso in errori],
+            somma_punti_vendita(riepiloghi.values()))
+
+
+def totali_periodo(riepilogo):
+    """Entrate e uscite del periodo, tutti i magazzini e articoli."""
+    return (sum(entrate for entrate, _ in riepilogo['totali'].values()),
+            sum(uscite for _, uscite in riepilogo['totali'].values()))
+
+
+def in_json(riepilogo):
+    """Il riepilogo con le chiavi (magazzino, articolo) scritte come 'magazzino/articolo'."""
+    def chiavi(valori):
+        return {f'{mag}/{art}': valore for (mag, art), valore in valori.items()}
+    return {
+        'report': {data: chiavi(valori) for data, valori in riepilogo['report'].items()},
+        'totali': chiavi(riepilogo['totali']),
+        'cauzioni': riepilogo['cauzioni'],
+        'resi': riepilogo['resi'],
+        'saldi': chiavi(riepilogo['saldi']),
+        'ultimo_giorno': riepilogo['ultimo_giorno'],
+    }
+
+
+def stampa_tabella(dal, al, punti_vendita, gruppo, nomi, per_giorno):
+    print(f"Consolidato di {len(punti_vendita)} punti vendita, report dal {dal} al {al}")
+    print()
+    larghezza = max([len('Gruppo')] + [len(nomi[p]) for p, _ in punti_vendita])
+    intestazione = (f"{'punto vendita':<{larghezza}}  {'ultimo giorno':>13}  {'entrate':>9}  {'uscite':>9}  "
+                    f"{'cauzioni C/O €':>15}  {'resi CEDI €':>13}  {'saldo':>9}")
+    print(intestazione)
+    print('-' * len(intestazione))
+    for nome, riepilogo in [(nomi[p], r) for p, r in punti_vendita] + [('Gruppo', gruppo)]:
+        if nome == 'Gruppo':
+            print('-' * len(intestazione))
+        entrate, uscite = totali_periodo(riepilogo)
+        print(f"{nome:<{larghezza}}  {riepilogo['ultimo_giorno'] or '—':>13}  {entrate:>9}  {uscite:>9}  "
+              f"{riepilogo['cauzioni']:>15.2f}  {riepilogo['resi']:>13.2f}  {sum(riepilogo['saldi'].values()):>+9}")
+
+    print()
+    print(f"{'Gruppo':<26}{'entrate':>9}  {'uscite':>9}  {'saldo attuale':>13}")
+    for mag in MAGAZZINI:
+        for art in ARTICOLI:
+            entrate, uscite = gruppo['totali'].get((mag, art), (0, 0))
+            print(f"{mag:<12}{art:<14}{entrate:>9}  {uscite:>9}  {gruppo['saldi'].get((mag, art), 0):>+13}")
+
+    if per_giorno:
+        print()
+        print(f"{'data':<12}{'entrate':>9}  {'uscite':>9}")
+        for data, valori in gruppo['report'].items():
+            print(f"{data:<12}{sum(e for e, _ in valori.values()):>9}  {sum(u for _, u in valori.values()):>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consolidato headless di più database di Gestione Roll.")
+    parser.add_argument('database', nargs='+', help="file supporti.db dei punti vendita (anche con * e **)")
+    oggi = date.today().strftime('%Y-%m-%d')
+    parser.add_argument('--dal', default=oggi[:8] + '01', help="inizio del report AAAA-MM-GG (predefinito: inizio mese)")
+    parser.add_argument('--al', default=oggi, help="fine del report e data dei saldi AAAA-MM-GG (predefinito: oggi)")
+    parser.add_argument('--processi', type=int, help="processi in parallelo (predefinito: uno per core)")
+    parser.add_argument('--per-giorno', action='store_true', help="stampa anche il report di gruppo giorno per giorno")
+    parser.add_argument('--json', action='store_true', help="stampa i risultati in JSON")
+    args = parser.parse_args(argv)
+
+    percorsi = espandi_percorsi(args.database)
+    if not percorsi:
+        print("Nessun database trovato.", file=sys.stderr)
+        return 1
+    inizio = time.perf_counter()
+    punti_vendita, errori, gruppo = consolida(percorsi, args.dal, args.al, args.processi)
+    durata = time.perf_counter() - inizio
+    nomi = nomi_punti_vendita(percorsi)
+
+    if args.json:
+        json.dump({'dal': args.dal, 'al': args.al,
+                   'punti_vendita': {nomi[p]: in_json(r) for p, r in punti_vendita},
+                   'gruppo': in_json(gruppo),
+                   'errori': {nomi[p]: messaggio for p, messaggio in errori}}, sys.stdout, indent=2)
+        print()
+    else:
+        stampa_tabella(args.dal, args.al, punti_vendita, gruppo, nomi, args.per_giorno)
+    for percorso, messaggio in errori:
+        print(f"{nomi[percorso]}: {messaggio}", file=sys.stderr)
+    print(f"{len(percorsi)} database letti in {durata:.2f} s", file=sys.stderr)
+    return 2 if errori else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
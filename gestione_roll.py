@@ -1,56 +1,164 @@
 import sqlite3
 import tkinter as tk
-from tkinter import ttk, messagebox
-from datetime import date
-import csv
-from tkcalendar import DateEntry
+from tkinter import ttk, messagebox, filedialog
+from datetime import date, timedelta
+import argparse
 #import winsound  # solo Windows
+import os
 import sys
-import time
-movimenti_per_giorno = {}   # iid_giorno → lista di tuple (direzione, articolo, magazzino, quantita)
-# Connessione database
-conn = sqlite3.connect('supporti.db')
-cursor = conn.cursor()
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS movimenti (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    data TEXT,
-    articolo TEXT,
-    direzione TEXT,
-    magazzino TEXT,
-    quantita INTEGER
+from collections import OrderedDict
+from supporti_db import (
+    DB_PATH, DECORRENZA_BASE, apri_database, LavoratoreDB,
+    ricostruisci_riepilogo, inserisci_movimenti, inserisci_lotto, elimina_inserimento, svuota_movimenti,
+    dati_pagina_storico, dati_dettaglio_giorno, dati_cauzioni, dati_resi, dati_giorno, dati_report,
+    dati_prezzi, imposta_prezzo, elimina_prezzo, dati_filtro_storico, totali_filtro_storico, andamento,
+    riconcilia_cedi, esporta_riconciliazione,
+    esporta_movimenti, importa_movimenti, calcola_saldo, crea_chiusura, chiudi_mesi,
+    converti_in_compatto, dati_modifiche, pota_registro_modifiche, anno_archiviabile, archivia_anno,
+    crea_backup, backup_se_scaduto, connetti_sola_lettura,
+    FILE_LOG, logger, configura_log, statistiche, azzera_statistiche, soglia_lenta_ms, imposta_soglia_lenta,
 )
-''')
-conn.commit()
+GIORNI_PER_PAGINA = 60        # giorni dello Storico caricati per volta durante lo scorrimento
+storico_ultimo_giorno = None  # giorno più vecchio già mostrato nello Storico
+storico_completo = False      # True quando non restano giorni da caricare
+storico_pagina_in_attesa = False
+filtro_storico = {}           # filtro attivo dello Storico ({} = tutti i giorni); cambia sempre oggetto
+RITARDO_FILTRO = 300          # ms senza battute prima di applicare il filtro
+attesa_filtro = None          # id di root.after del filtro in attesa
+righe_storico = {}            # data → iid della riga giorno nello Storico
+righe_cauzioni = {}           # data → (iid, valore giorno, cumulato) in Cauzioni C/O
+righe_resi = {}               # data → (iid, valore giorno, cumulato) in Cauzioni e Resi
+totale_cauzioni = 0.0
+totale_resi = 0.0
+pagine_valori = {vista: {'ultimo': None, 'completo': False, 'in_attesa': False} for vista in ('cauzioni', 'resi')}
+INTERVALLO_MODIFICHE = 2000   # ms tra un controllo e l'altro delle scritture di altre postazioni
+versione_dati = None          # PRAGMA data_version all'ultimo controllo
+ultima_modifica = None        # id dell'ultima voce di registro_modifiche già applicata
+modifiche_in_attesa = False
+TUTTO = 'tutto'
+viste_in_sospeso = {}         # vista → giorni da rileggere (set) o TUTTO; assente finché mai mostrata
+MAX_REPORT_IN_CACHE = 64      # periodi del Report tenuti in memoria (i meno usati escono per primi)
+cache_report = OrderedDict()  # (dal, al) → (per_giorno, totali)
+report_in_corso = set()       # periodi già chiesti al lavoratore
+righe_lotto = {}              # iid della coda del lotto → righe da registrare
+inserimenti_postazione = []  # (primo_id, ultimo_id) delle registrazioni di questa postazione, l'ultima in fondo
+lotto_in_registrazione = False
+INTERVALLO_CONTROLLO_BACKUP = 3600 * 1000  # ms tra un controllo e l'altro del backup automatico
+backup_in_corso = False
 
 # ────────────────────────────────────────────────
 # FUNZIONI DI LOGICA
 # ────────────────────────────────────────────────
 
-def calcola_saldo(articolo=None, magazzino=None):
-    query = 'SELECT SUM(CASE WHEN direzione = "ENTRATA" THEN quantita ELSE -quantita END) FROM movimenti'
-    params = []
-    conditions = []
-    if articolo:
-        conditions.append('articolo = ?')
-        params.append(articolo)
-    if magazzino:
-        conditions.append('magazzino = ?')
-        params.append(magazzino)
-    if conditions:
-        query += ' WHERE ' + ' AND '.join(conditions)
-    cursor.execute(query, params)
-    result = cursor.fetchone()[0]
-    return result if result is not None else 0
+def errore_db(errore):
+    messagebox.showerror("Errore database", f"Operazione non riuscita:\n{errore}")
 
-def registra_movimenti():
+def controlla_risultati_db():
+    """Consegna al thread di Tk i risultati pronti del lavoratore; si ripianifica da sola."""
+    root.after(50, controlla_risultati_db)
+    db.consegna_risultati()
+    lavori_lunghi.consegna_risultati()
+
+def controlla_modifiche():
+    """Ogni INTERVALLO_MODIFICHE ms chiede al lavoratore se altre postazioni hanno scritto."""
+    global modifiche_in_attesa
+    root.after(INTERVALLO_MODIFICHE, controlla_modifiche)
+    if modifiche_in_attesa:
+        return
+    modifiche_in_attesa = True
+    db.invia(dati_modifiche, versione_dati, ultima_modifica, al_termine=applica_modifiche,
+             in_errore=modifiche_non_lette)
+
+def modifiche_non_lette(_):
+    # un errore qui (es. database bloccato a lungo) non merita un avviso: si riprova al prossimo giro
+    global modifiche_in_attesa
+    modifiche_in_attesa = False
+
+def applica_modifiche(esito):
+    """Aggiorna solo i giorni toccati dalle altre postazioni, o tutto se sono troppi."""
+    global versione_dati, ultima_modifica, modifiche_in_attesa
+    prima_lettura = ultima_modifica is None
+    versione_dati, ultima_modifica, giorni = esito
+    modifiche_in_attesa = False
+    if prima_lettura:
+        return
+    if giorni is None:
+        aggiorna_tutto()
+        return
+    aggiorna_giorni(giorni)
+
+def vista_corrente():
+    """Nome della vista nella scheda a schermo (None per Registrazione)."""
+    return viste_per_scheda.get(notebook.select())
+
+def segna_scaduta(vista, data=TUTTO):
+    """Annota un giorno (o TUTTO) da rileggere quando la vista tornerà a schermo."""
+    sospesi = viste_in_sospeso.get(vista)
+    if sospesi is None or sospesi == TUTTO:
+        return  # mai caricata o già da ricaricare per intero
+    viste_in_sospeso[vista] = TUTTO if data == TUTTO else sospesi | {data}
+
+def scheda_cambiata(event=None):
+    """Porta in pari la vista appena mostrata: la prima volta per intero, poi solo i giorni scaduti."""
+    vista = vista_corrente()
+    if vista is None:
+        return
+    sospesi = viste_in_sospeso.get(vista)
+    viste_in_sospeso[vista] = set()
+    if sospesi is None or sospesi == TUTTO or (vista in ('report', 'andamento') and sospesi):
+        AGGIORNA_VISTA[vista]()
+        return
+    for data in sorted(sospesi):
+        db.invia(dati_giorno, data, al_termine=lambda esito, v=vista: mostra_giorno(esito, (v,)))
+
+def aggiorna_tutto():
+    invalida_report()
+    for vista in viste_in_sospeso:
+        viste_in_sospeso[vista] = TUTTO
+    scheda_cambiata()
+
+def richiedi_report():
+    if vista_corrente() == 'report':
+        genera_report()
+    else:
+        segna_scaduta('report')
+
+def ricostruisci_riepilogo_e_aggiorna():
+    db.invia(ricostruisci_riepilogo, al_termine=riepilogo_ricostruito)
+
+def riepilogo_ricostruito(_):
+    aggiorna_tutto()
+    messagebox.showinfo("Riepilogo", "Riepilogo giornaliero ricostruito da movimenti.")
+
+def archivia_anno_vecchio():
+    db.invia(anno_archiviabile, al_termine=chiedi_archiviazione)
+
+def chiedi_archiviazione(anno):
+    if anno is None:
+        messagebox.showinfo("Archivia anno", "Nel database ci sono solo movimenti dell'anno in corso.")
+        return
+    if not messagebox.askyesno("Archivia anno",
+                               f"Spostare i movimenti del {anno} in un file di archivio?\n\n"
+                               "Restano consultabili nello Storico, nelle Cauzioni e nei report, "
+                               "ma non si possono più registrare movimenti con date di quell'anno."):
+        return
+    lavori_lunghi.invia(archivia_anno, anno, al_termine=anno_archiviato,
+                        in_errore=lambda e: messagebox.showerror("Archiviazione non riuscita",
+                                                                 f"Database invariato:\n{e}"))
+
+def anno_archiviato(esito):
+    archivio, spostati = esito
+    aggiorna_tutto()
+    messagebox.showinfo("Archivia anno", f"{spostati} movimenti spostati in {archivio}.")
+
+def leggi_movimento():
+    """Righe (data, articolo, direzione, magazzino, quantita) dai campi di registrazione, None se non valide."""
     data_str = calendario.get_date().strftime('%Y-%m-%d')
     magazzino = magazzino_var.get()
 
     if not magazzino:
         messagebox.showerror("Errore", "Seleziona il magazzino!")
-        return
+        return None
 
     # Direzione forzata per Carne e Ortofrutta
     if magazzino in ["Carne", "Ortofrutta"]:
@@ -64,54 +172,193 @@ def registra_movimenti():
         q_cpr     = int(cpr_entry.get()     or 0)
     except ValueError:
         messagebox.showerror("Errore", "Le quantità devono essere numeri interi!")
-        return
+        return None
 
     if q_roll == 0 and q_griglia == 0 and q_cpr == 0:
         messagebox.showerror("Errore", "Inserisci almeno una quantità maggiore di zero!")
-        return
+        return None
 
     articoli_qty = [("Roll", q_roll), ("Griglia", q_griglia), ("Cassetta CPR", q_cpr)]
+    return [(data_str, articolo, direzione, magazzino, qty) for articolo, qty in articoli_qty if qty > 0]
 
-    for articolo, qty in articoli_qty:
-        if qty > 0:
-            cursor.execute(
-                'INSERT INTO movimenti (data, articolo, direzione, magazzino, quantita) VALUES (?, ?, ?, ?, ?)',
-                (data_str, articolo, direzione, magazzino, qty)
-            )
-
-    conn.commit()
-
-    # Pulizia campi
+def pulisci_quantita():
     roll_entry.delete(0, tk.END)
     griglia_entry.delete(0, tk.END)
     cpr_entry.delete(0, tk.END)
 
+def quantita_nei_campi():
+    return roll_entry.get(), griglia_entry.get(), cpr_entry.get()
+
+movimento_in_registrazione = False  # come per il lotto: niente doppioni mentre il lavoratore scrive
+
+def registra_movimenti():
+    global movimento_in_registrazione
+    if movimento_in_registrazione:
+        return
+    righe = leggi_movimento()
+    if righe is None:
+        return
+    data_str = righe[0][0]
+    inviate = quantita_nei_campi()
+
+    movimento_in_registrazione = True
+    db.invia(inserisci_movimenti, righe,
+             al_termine=lambda intervallo: movimento_registrato(data_str, intervallo, inviate),
+             in_errore=movimento_non_registrato)
+
+def movimento_non_registrato(errore):
+    global movimento_in_registrazione
+    movimento_in_registrazione = False
+    errore_db(errore)  # i campi restano pieni: si può riprovare
+
+def movimento_registrato(data_str, intervallo, inviate):
+    global movimento_in_registrazione
+    movimento_in_registrazione = False
+    inserimenti_postazione.append(intervallo)
+    # Pulizia campi solo a registrazione confermata, e se intanto non sono stati riscritti
+    if quantita_nei_campi() == inviate:
+        pulisci_quantita()
     # Beep conferma
     #winsound.Beep(800, 120)
     beep_semplice()
-    time.sleep(0.3)
-    beep_semplice()
+    root.after(300, beep_semplice)
 
     #aggiorna_inventario()
-    aggiorna_storico()
-    aggiorna_valore_cauzioniOFC()
-    aggiorna_cauzioni_resi()
+    aggiorna_giorno(data_str)
 
 def annulla_ultimo():
-    if not messagebox.askyesno("Conferma", "Annullare l'ultimo movimento inserito?"):
+    # solo le registrazioni di questa postazione: quelle delle altre non si annullano da qui
+    if not inserimenti_postazione:
+        messagebox.showinfo("Annulla", "Nessuna registrazione di questa postazione da annullare.")
+        return
+    if not messagebox.askyesno("Conferma", "Annullare l'ultima registrazione di questa postazione?\n"
+                                           "Se è un lotto, viene annullato tutto il lotto."):
         return
 
-    cursor.execute('DELETE FROM movimenti WHERE id = (SELECT MAX(id) FROM movimenti)')
-    conn.commit()
+    intervallo = inserimenti_postazione.pop()
+    db.invia(elimina_inserimento, *intervallo, al_termine=movimento_annullato,
+             in_errore=lambda errore: annullamento_non_riuscito(intervallo, errore))
+
+def annullamento_non_riuscito(intervallo, errore):
+    inserimenti_postazione.append(intervallo)  # si può riprovare
+    errore_db(errore)
+
+def movimento_annullato(date_toccate):
+    if not date_toccate:
+        return
 
     #winsound.Beep(400, 200)  # beep diverso per annullamento
     beep_semplice()
-    time.sleep(0.3)
+    root.after(300, beep_semplice)
+    aggiorna_giorni(date_toccate)
+
+def aggiungi_al_lotto(event=None):
+    """Invio: mette il movimento dei campi nella coda del lotto, senza toccare il database."""
+    righe = leggi_movimento()
+    if righe is None:
+        return "break"
+    data_str, _, direzione, magazzino, _ = righe[0]
+    quantita = {articolo: qty for _, articolo, _, _, qty in righe}
+    iid = tree_lotto.insert('', 'end', values=(data_str, magazzino, direzione,
+                                               quantita.get('Roll', ''), quantita.get('Griglia', ''),
+                                               quantita.get('Cassetta CPR', '')))
+    righe_lotto[iid] = righe
+    tree_lotto.see(iid)
+    aggiorna_stato_lotto()
+    pulisci_quantita()
+    roll_entry.focus_set()
+    return "break"
+
+def togli_dal_lotto(event=None):
+    for iid in tree_lotto.selection():
+        tree_lotto.delete(iid)
+        del righe_lotto[iid]
+    aggiorna_stato_lotto()
+    return "break"
+
+def modifica_riga_lotto(event=None):
+    """Riporta la riga selezionata nei campi (e la toglie dalla coda) per correggerla."""
+    selezione = tree_lotto.selection()
+    if not selezione:
+        return "break"
+    iid = selezione[0]
+    data_str, magazzino, direzione, q_roll, q_griglia, q_cpr = tree_lotto.item(iid, 'values')
+    calendario.set_date(date.fromisoformat(data_str))
+    magazzino_var.set(magazzino)
+    direzione_var.set(direzione)
+    pulisci_quantita()
+    roll_entry.insert(0, q_roll)
+    griglia_entry.insert(0, q_griglia)
+    cpr_entry.insert(0, q_cpr)
+    tree_lotto.delete(iid)
+    del righe_lotto[iid]
+    aggiorna_stato_lotto()
+    roll_entry.focus_set()
+    return "break"
+
+def svuota_lotto():
+    if righe_lotto and not messagebox.askyesno("Conferma", f"Scartare i {len(righe_lotto)} movimenti in coda?"):
+        return
+    for iid in list(righe_lotto):
+        tree_lotto.delete(iid)
+    righe_lotto.clear()
+    aggiorna_stato_lotto()
+
+def registra_lotto(event=None):
+    """Ctrl+Invio: registra tutta la coda in un'unica transazione; le viste si aggiornano una volta."""
+    global lotto_in_registrazione
+    if not righe_lotto or lotto_in_registrazione:
+        return "break"
+    righe = [riga for iid in tree_lotto.get_children() for riga in righe_lotto[iid]]
+    lotto_in_registrazione = True
+    aggiorna_stato_lotto()
+    db.invia(inserisci_lotto, righe, al_termine=lotto_registrato, in_errore=lotto_non_registrato)
+    return "break"
+
+def lotto_registrato(esito):
+    global lotto_in_registrazione
+    date_toccate, intervallo = esito
+    inserimenti_postazione.append(intervallo)
+    lotto_in_registrazione = False
+    for iid in list(righe_lotto):
+        tree_lotto.delete(iid)
+    righe_lotto.clear()
+    aggiorna_stato_lotto()
     beep_semplice()
-    aggiorna_inventario()
-    aggiorna_storico()
-    aggiorna_valore_cauzioniOFC()
-    aggiorna_cauzioni_resi()
+    root.after(300, beep_semplice)
+    aggiorna_giorni(date_toccate)
+
+def lotto_non_registrato(errore):
+    global lotto_in_registrazione
+    # la coda resta com'era: si può correggere o riprovare
+    lotto_in_registrazione = False
+    aggiorna_stato_lotto()
+    errore_db(errore)
+
+def aggiorna_stato_lotto():
+    movimenti = sum(len(righe) for righe in righe_lotto.values())
+    if lotto_in_registrazione:
+        testo = "Registrazione del lotto in corso…"
+    elif righe_lotto:
+        testo = f"{len(righe_lotto)} righe in coda ({movimenti} movimenti)"
+    else:
+        testo = "Coda vuota"
+    stato_lotto.config(text=testo)
+
+def seleziona_magazzino(magazzino):
+    if notebook.select() == str(frame_reg):
+        magazzino_var.set(magazzino)
+        roll_entry.focus_set()
+
+def seleziona_direzione(direzione):
+    if notebook.select() == str(frame_reg) and magazzino_var.get() not in ["Carne", "Ortofrutta"]:
+        direzione_var.set(direzione)
+
+def chiudi_finestra():
+    if righe_lotto and not messagebox.askyesno(
+            "Lotto non registrato", f"Ci sono {len(righe_lotto)} righe in coda non registrate.\nChiudere comunque?"):
+        return
+    root.destroy()
 
 def aggiorna_direzione(*args):
     mag = magazzino_var.get()
@@ -126,61 +373,163 @@ def aggiorna_direzione(*args):
             direzione_var.set("ENTRATA")
 
 
+def per_filtro(funzione):
+    """Callback che scarta l'esito se intanto il filtro dello Storico è cambiato."""
+    filtro = filtro_storico
+    return lambda esito: funzione(esito) if filtro is filtro_storico else None
+
 def aggiorna_storico():
+    global storico_pagina_in_attesa
+    storico_pagina_in_attesa = True
+    if filtro_storico:
+        db.invia(dati_filtro_storico, filtro_storico, None, GIORNI_PER_PAGINA, al_termine=per_filtro(mostra_storico))
+        db.invia(totali_filtro_storico, filtro_storico, al_termine=per_filtro(mostra_totali_filtro))
+    else:
+        db.invia(dati_pagina_storico, None, GIORNI_PER_PAGINA, al_termine=per_filtro(mostra_storico))
+        totale_filtro_label.config(text="")
+
+def mostra_storico(giorni):
+    global storico_ultimo_giorno, storico_completo
     for item in tree_storico.get_children():
         tree_storico.delete(item)
-    
-    movimenti_per_giorno.clear()
-
-    cursor.execute('''
-        SELECT data, direzione, articolo, magazzino, quantita 
-        FROM movimenti 
-        ORDER BY data DESC, id DESC
-    ''')
-    rows = cursor.fetchall()
 
-    if not rows:
-        tree_storico.insert('', 'end', values=('', '', 'Nessun movimento registrato', '', ''))
+    righe_storico.clear()
+    storico_ultimo_giorno = None
+    storico_completo = False
+    mostra_pagina_storico(giorni)
+
+    if not tree_storico.get_children():
+        testo = 'Nessun movimento corrisponde al filtro' if filtro_storico else 'Nessun movimento registrato'
+        tree_storico.insert('', 'end', values=('', '', testo, '', ''))
+
+def mostra_totali_filtro(totali):
+    movimenti, giorni, entrate, uscite = totali
+    totale_filtro_label.config(text=f"Filtro: {movimenti} movimenti in {giorni} giorni – "
+                                    f"entrate {entrate}, uscite {uscite}, saldo {entrate - uscite:+d}")
+
+def leggi_filtro_storico():
+    """Filtro dai campi della barra; quelli vuoti, incompleti o non validi non filtrano."""
+    filtro = {}
+    for chiave, var in (('dal', filtro_dal_var), ('al', filtro_al_var)):
+        try:
+            filtro[chiave] = date.fromisoformat(var.get().strip()).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    for chiave, var in (('magazzino', filtro_mag_var), ('articolo', filtro_art_var), ('direzione', filtro_dir_var)):
+        if var.get() not in ('Tutti', 'Tutte'):
+            filtro[chiave] = var.get()
+    for chiave, var in (('minimo', filtro_min_var), ('massimo', filtro_max_var)):
+        try:
+            filtro[chiave] = int(var.get())
+        except ValueError:
+            pass
+    return filtro
+
+def filtro_modificato(*args):
+    """A ogni battuta riparte l'attesa: il filtro si applica quando si smette di scrivere."""
+    global attesa_filtro
+    if attesa_filtro:
+        root.after_cancel(attesa_filtro)
+    attesa_filtro = root.after(RITARDO_FILTRO, applica_filtro_storico)
+
+def applica_filtro_storico():
+    global filtro_storico, attesa_filtro
+    attesa_filtro = None
+    nuovo = leggi_filtro_storico()
+    if nuovo == filtro_storico:
         return
+    filtro_storico = nuovo
+    if vista_corrente() == 'storico':
+        aggiorna_storico()
+    else:
+        segna_scaduta('storico')
 
-    # Raggruppa per data
-    from collections import defaultdict
-    grouped = defaultdict(list)
-    for row in rows:
-        grouped[row[0]].append(row[1:])  # direzione, articolo, magazzino, quantita
+def pulisci_filtro_storico():
+    for var in (filtro_dal_var, filtro_al_var, filtro_min_var, filtro_max_var):
+        var.set('')
+    for var, tutti in ((filtro_mag_var, 'Tutti'), (filtro_art_var, 'Tutti'), (filtro_dir_var, 'Tutte')):
+        var.set(tutti)
 
+def testo_riepilogo_giorno(mov_giorno):
+    """Testo della riga giorno dello Storico da {(articolo, direzione): quantità}."""
     articoli = ['Roll', 'Griglia', 'Cassetta CPR']
 
-    # Inserisci riepiloghi giorni
-    for data in sorted(grouped.keys(), reverse=True):
-        mov_giorno = grouped[data]
-
-        # Calcola per articolo: entrate e uscite
-        riepilogo_articoli = []
-        for art in articoli:
-            entrate_art = sum(q for d, a, _, q in mov_giorno if a == art and d == 'ENTRATA')
-            uscite_art  = sum(q for d, a, _, q in mov_giorno if a == art and d == 'USCITA')
-
-            if entrate_art > 0 or uscite_art > 0:
-                parti = []
-                if entrate_art > 0:
-                    parti.append(f"+{entrate_art}")
-                if uscite_art > 0:
-                    parti.append(f"-{uscite_art}")
-                
-                if parti:
-                    riepilogo_articoli.append(f"{art}: {' / '.join(parti)}")
-
-        num_mov = len(mov_giorno)
-        riepilogo_txt = "   ".join(riepilogo_articoli) if riepilogo_articoli else "Nessun movimento"
-        #riepilogo_txt += f"   ({num_mov} mov.)"
-
+    # Calcola per articolo: entrate e uscite
+    riepilogo_articoli = []
+    for art in articoli:
+        entrate_art = mov_giorno.get((art, 'ENTRATA'), 0)
+        uscite_art  = mov_giorno.get((art, 'USCITA'), 0)
+
+        if entrate_art > 0 or uscite_art > 0:
+            parti = []
+            if entrate_art > 0:
+                parti.append(f"+{entrate_art}")
+            if uscite_art > 0:
+                parti.append(f"-{uscite_art}")
+
+            if parti:
+                riepilogo_articoli.append(f"{art}: {' / '.join(parti)}")
+
+    return "   ".join(riepilogo_articoli) if riepilogo_articoli else "Nessun movimento"
+
+def carica_pagina_storico():
+    """Chiede al lavoratore i GIORNI_PER_PAGINA giorni precedenti all'ultimo già mostrato."""
+    global storico_pagina_in_attesa
+    if storico_completo:
+        storico_pagina_in_attesa = False
+        return
+    if filtro_storico:
+        db.invia(dati_filtro_storico, filtro_storico, storico_ultimo_giorno, GIORNI_PER_PAGINA,
+                 al_termine=per_filtro(mostra_pagina_storico))
+    else:
+        db.invia(dati_pagina_storico, storico_ultimo_giorno, GIORNI_PER_PAGINA,
+                 al_termine=per_filtro(mostra_pagina_storico))
+
+def mostra_pagina_storico(giorni):
+    global storico_ultimo_giorno, storico_completo, storico_pagina_in_attesa
+    storico_pagina_in_attesa = False
+    if len(giorni) < GIORNI_PER_PAGINA:
+        storico_completo = True
+
+    # Inserisci riepiloghi giorni; col filtro arrivano anche i movimenti che lo rispettano
+    for data, mov_giorno, *dettaglio in giorni:
+        riepilogo_txt = testo_riepilogo_giorno(mov_giorno)
         iid = tree_storico.insert('', 'end', values=('', data, riepilogo_txt, '', ''), tags=('giorno',))
-        movimenti_per_giorno[iid] = mov_giorno
-
-    #print(f"Storico: caricati {len(grouped)} giorni")
+        righe_storico[data] = iid
+        if dettaglio:
+            mostra_dettaglio_giorno(iid, dettaglio[0])
+        storico_ultimo_giorno = data
+
+    #print(f"Storico: caricati {len(giorni)} giorni")
+
+def scorri_storico(primo, ultimo):
+    """yscrollcommand dello Storico: quando la vista si avvicina al fondo carica la pagina successiva."""
+    global storico_pagina_in_attesa
+    scrollbar_storico.set(primo, ultimo)
+    if float(ultimo) > 0.9 and not storico_completo and not storico_pagina_in_attesa:
+        storico_pagina_in_attesa = True
+        root.after_idle(carica_pagina_storico)
+
+def espandi_giorno(item):
+    tree_storico.set(item, 'Icona', '…')
+    data = tree_storico.set(item, 'Data')
+    if filtro_storico:
+        db.invia(dati_filtro_storico, {**filtro_storico, 'dal': data, 'al': data}, None, 1,
+                 al_termine=per_filtro(lambda pagina: mostra_dettaglio_giorno(item, pagina[0][2] if pagina else [])))
+    else:
+        db.invia(dati_dettaglio_giorno, data, al_termine=lambda movs: mostra_dettaglio_giorno(item, movs))
 
-    tree_storico.update_idletasks()
+def mostra_dettaglio_giorno(item, movs):
+    if not tree_storico.exists(item):
+        return
+    for child in tree_storico.get_children(item):
+        tree_storico.delete(child)
+    for direzione, articolo, magazzino, quantita in movs:
+        tag = 'entrata' if direzione == 'ENTRATA' else 'uscita'
+        descr = f"{articolo}  ({magazzino})"
+        tree_storico.insert(item, 'end', values=('', '', direzione, quantita, descr), tags=('dettaglio', tag))
+    tree_storico.set(item, 'Icona', '▶')  # o usa '-' o un simbolo
+    tree_storico.item(item, open=True)
 
 def toggle_giorno(event):
     region = tree_storico.identify("region", event.x, event.y)
@@ -196,152 +545,730 @@ def toggle_giorno(event):
         for child in tree_storico.get_children(item):
             tree_storico.delete(child)
         tree_storico.set(item, 'Icona', '')
-    else:
+    elif tree_storico.set(item, 'Icona') != '…':
         # espandi
-        movs = movimenti_per_giorno.get(item, [])
-        for direzione, articolo, magazzino, quantita in movs:
-            tag = 'entrata' if direzione == 'ENTRATA' else 'uscita'
-            descr = f"{articolo}  ({magazzino})"
-            tree_storico.insert(item, 'end', values=('', '', direzione, quantita, descr), tags=('dettaglio', tag))
-        tree_storico.set(item, 'Icona', '▶')  # o usa '-' o un simbolo
+        espandi_giorno(item)
+
+def posizione_giorno(tree, data, colonna=0):
+    """Indice a cui inserire la riga di `data` tra le righe radice ordinate per data decrescente."""
+    for indice, item in enumerate(tree.get_children()):
+        valori = tree.item(item, 'values')
+        if not valori or valori[colonna] < data:
+            return indice
+    return 'end'
+
+def valori_riga_cauzioni(data, entrate, prezzi):
+    """Celle di Cauzioni C/O e valore del giorno da {(articolo, 'ENTRATA'): entrate} e dai prezzi del giorno."""
+    valore_giorno = 0.0
+    row_values = [data]
+
+    for art in ['Roll', 'Griglia', 'Cassetta CPR']:
+        q = entrate.get((art, 'ENTRATA'), 0)
+        if q:
+            prezzo = prezzi.get(art, 0)
+            valore_art = q * prezzo
+            valore_giorno += valore_art
+            row_values.append(f"{q} × {prezzo:g} € = {valore_art:.2f} €")
+        else:
+            row_values.append("—")
 
-def aggiorna_valore_cauzioniOFC():
-    for item in tree_cauzioni.get_children():
-        tree_cauzioni.delete(item)
+    return row_values, valore_giorno
 
-    cursor.execute('''
-        SELECT data, articolo, SUM(quantita) AS entrate
-        FROM movimenti
-        WHERE magazzino IN ('Carne', 'Ortofrutta')
-          AND direzione = 'ENTRATA'
-        GROUP BY data, articolo
-        ORDER BY data DESC
-    ''')
-    rows = cursor.fetchall()
+def valori_riga_resi(data, dati_giorno, prezzi):
+    """Celle di Cauzioni e Resi e valore netto del giorno da {(articolo, direzione): quantità} e dai prezzi."""
+    row_values = [data]
+    valore_giorno = 0.0
 
-    if not rows:
-        tree_cauzioni.insert('', 'end', values=('', 'Nessuna entrata in Carne/Ortofrutta', '', '', ''))
-        return
+    for art in ['Roll', 'Griglia', 'Cassetta CPR']:
+        entrate = dati_giorno.get((art, 'ENTRATA'), 0)
+        uscite  = dati_giorno.get((art, 'USCITA'), 0)
 
-    from collections import defaultdict
-    grouped = defaultdict(dict)
-    for data, art, entrate in rows:
-        grouped[data][art] = entrate
+        prezzo = prezzi.get(art, 0)
+        val_entrate = entrate * prezzo
+        val_uscite  = uscite  * prezzo
+        val_netto   = val_entrate - val_uscite
 
-    costi = {'Roll': 52, 'Griglia': 8, 'Cassetta CPR': 4}
-    totale_cumulato = 0.0
+        valore_giorno += val_netto
 
-    for data in sorted(grouped.keys(), reverse=True):
-        entrate_art = grouped[data]
+        testo = ""
+        if entrate > 0:
+            testo += f"+{entrate} ({val_entrate:.2f} €)"
+        if uscite > 0:
+            testo += f"  -{uscite} ({val_uscite:.2f} €)" if testo else f"-{uscite} ({val_uscite:.2f} €)"
 
-        valore_giorno = 0.0
-        row_values = [data]
+        row_values.append(testo if testo else "—")
 
-        for art in ['Roll', 'Griglia', 'Cassetta CPR']:
-            q = entrate_art.get(art, 0)
-            valore_art = q * costi[art]
-            valore_giorno += valore_art
-            row_values.append(f"{q} × {costi[art]} € = {valore_art:.2f} €")
+    return row_values, valore_giorno
 
-        totale_cumulato += valore_giorno
-        row_values.append(f"{valore_giorno:.2f} €")
+def tag_valore(valore):
+    return 'positivo' if valore > 0 else ('negativo' if valore < 0 else '')
 
-        tree_cauzioni.insert('', 'end', values=row_values)
+# ── Cauzioni C/O e Cauzioni e Resi ──────────────
+# Valori e cumulati arrivano già calcolati dal database, una pagina di giorni per volta
+# come nello Storico; gli aggiornamenti di un giorno correggono i cumulati per differenza.
 
-    # Riga totale cumulato
-    tree_cauzioni.insert('', 'end', values=('', '', '', '', f"Totale cauzioni cumulato: {totale_cumulato:.2f} €"), tags=('totale',))
+def viste_valori(vista):
+    """(tree, righe, funzione dei dati, funzione delle celle) della vista 'cauzioni' o 'resi'."""
+    if vista == 'cauzioni':
+        return tree_cauzioni, righe_cauzioni, dati_cauzioni, valori_riga_cauzioni
+    return tree_cauzioni_resi, righe_resi, dati_resi, valori_riga_resi
 
-def aggiorna_cauzioni_resi():
-    for item in tree_cauzioni_resi.get_children():
-        tree_cauzioni_resi.delete(item)
+def testo_valore(vista, valore):
+    return f"{valore:+.2f} €" if vista == 'resi' else f"{valore:.2f} €"
 
-    cursor.execute('''
-        SELECT data, articolo, direzione, SUM(quantita) AS qty
-        FROM movimenti
-        WHERE magazzino IN ('Freschi', 'Secchi')
-        GROUP BY data, articolo, direzione
-        ORDER BY data DESC
-    ''')
-    rows = cursor.fetchall()
+def imposta_totale(vista, totale):
+    global totale_cauzioni, totale_resi
+    if vista == 'cauzioni':
+        totale_cauzioni = totale
+        totale_label_cauzioni.config(text=f"Totale cauzioni cumulato: {totale:.2f} €")
+    else:
+        totale_resi = totale
+        totale_label_resi.config(text=f"Totale cumulato: {totale:+.2f} €")
 
-    print(f"DEBUG Resi: trovati {len(rows)} record aggregati")
+def aggiorna_valore_cauzioniOFC():
+    aggiorna_valori('cauzioni')
 
-    if not rows:
-        tree_cauzioni_resi.insert('', 'end', values=('', 'Nessun movimento in Freschi/Secchi', '', '', ''))
-        tree_cauzioni_resi.insert('', 'end', values=('', '', '', '', 'Totale cumulato: 0.00 €'), tags=('totale',))
+def aggiorna_cauzioni_resi():
+    aggiorna_valori('resi')
+
+def aggiorna_valori(vista):
+    pagine_valori[vista].update(ultimo=None, completo=False, in_attesa=True)
+    db.invia(viste_valori(vista)[2], None, GIORNI_PER_PAGINA, al_termine=lambda esito: mostra_valori(vista, esito))
+
+def mostra_valori(vista, esito):
+    """Riparte dalla prima pagina della vista, con il totale cumulato su tutto lo storico."""
+    tree, righe = viste_valori(vista)[:2]
+    pagina, totale = esito
+    tree.delete(*tree.get_children())
+    righe.clear()
+    imposta_totale(vista, totale)
+    if not pagina:
+        testo = 'Nessuna entrata in Carne/Ortofrutta' if vista == 'cauzioni' else 'Nessun movimento in Freschi/Secchi'
+        tree.insert('', 'end', values=('', testo, '', '', '', ''))
+    mostra_pagina_valori(vista, pagina)
+
+def mostra_pagina_valori(vista, pagina):
+    tree, righe, _, valori_riga = viste_valori(vista)
+    stato = pagine_valori[vista]
+    stato['in_attesa'] = False
+    if len(pagina) < GIORNI_PER_PAGINA:
+        stato['completo'] = True
+
+    for data, quantita, prezzi, valore, cumulato in pagina:
+        if data in righe:
+            continue
+        row_values, _ = valori_riga(data, quantita, prezzi)
+        iid = tree.insert('', 'end', values=[*row_values, testo_valore(vista, valore), testo_valore(vista, cumulato)],
+                          tags=tag_valore(valore) if vista == 'resi' else ())
+        righe[data] = (iid, valore, cumulato)
+        stato['ultimo'] = data
+
+def carica_pagina_valori(vista):
+    stato = pagine_valori[vista]
+    if stato['completo']:
+        stato['in_attesa'] = False
+        return
+    db.invia(viste_valori(vista)[2], stato['ultimo'], GIORNI_PER_PAGINA,
+             al_termine=lambda esito: mostra_pagina_valori(vista, esito[0]))
+
+def scorri_valori(vista, scrollbar, primo, ultimo):
+    """yscrollcommand delle viste dei valori: vicino al fondo chiede la pagina successiva."""
+    scrollbar.set(primo, ultimo)
+    stato = pagine_valori[vista]
+    if float(ultimo) > 0.9 and not stato['completo'] and not stato['in_attesa']:
+        stato['in_attesa'] = True
+        root.after_idle(lambda: carica_pagina_valori(vista))
+
+def aggiorna_giorno_valori(vista, data, quantita, prezzi):
+    """Riscrive la riga di `data` e sposta della differenza i cumulati dei giorni dopo e il totale."""
+    tree, righe, _, valori_riga = viste_valori(vista)
+    stato = pagine_valori[vista]
+    if not righe or (not stato['completo'] and data < stato['ultimo']):
+        # oltre le pagine caricate il valore di prima non si conosce: si riparte da capo
+        aggiorna_valori(vista)
         return
 
-    from collections import defaultdict
-    grouped = defaultdict(lambda: defaultdict(int))
-    for data, art, dir_, qty in rows:
-        grouped[data][(art, dir_)] = qty
-
-    costi = {'Roll': 52, 'Griglia': 8, 'Cassetta CPR': 4}
-    totale_cumulato = 0.0
-
-    for data in sorted(grouped.keys(), reverse=True):
-        dati_giorno = grouped[data]
-
-        row_values = [data]
-        valore_giorno = 0.0
-
-        for art in ['Roll', 'Griglia', 'Cassetta CPR']:
-            entrate = dati_giorno.get((art, 'ENTRATA'), 0)
-            uscite  = dati_giorno.get((art, 'USCITA'), 0)
+    iid, valore_prima, cumulato = righe.pop(data, (None, 0.0, None))
+    row_values, valore_giorno = valori_riga(data, quantita, prezzi) if quantita else (None, 0.0)
+    delta = valore_giorno - valore_prima
 
-            val_entrate = entrate * costi[art]
-            val_uscite  = uscite  * costi[art]
-            val_netto   = val_entrate - val_uscite
+    if not quantita:
+        if iid:
+            tree.delete(iid)
+        if not righe:
+            aggiorna_valori(vista)
+            return
+    else:
+        if iid:
+            cumulato += delta
+        else:
+            # giorno nuovo: parte dal cumulato del giorno caricato prima di lui
+            precedenti = [d for d in righe if d < data]
+            cumulato = (righe[max(precedenti)][2] if precedenti else 0.0) + valore_giorno
+        valori = [*row_values, testo_valore(vista, valore_giorno), testo_valore(vista, cumulato)]
+        tags = tag_valore(valore_giorno) if vista == 'resi' else ()
+        if iid:
+            tree.item(iid, values=valori, tags=tags)
+        else:
+            iid = tree.insert('', posizione_giorno(tree, data), values=valori, tags=tags)
+        righe[data] = (iid, valore_giorno, cumulato)
+
+    for giorno, (iid_giorno, valore, cumulato_giorno) in list(righe.items()):
+        if giorno > data:
+            righe[giorno] = (iid_giorno, valore, cumulato_giorno + delta)
+            tree.set(iid_giorno, 'Cumulato €', testo_valore(vista, cumulato_giorno + delta))
+    imposta_totale(vista, (totale_cauzioni if vista == 'cauzioni' else totale_resi) + delta)
+
+# ── Andamento ───────────────────────────────────
+# Saldi per articolo nel periodo, con media mobile, variazione e valore delle cauzioni in
+# saldo: le serie arrivano dal lavoratore già campionate alla larghezza del grafico.
+
+COLORI_ARTICOLI = {'Roll': '#1565C0', 'Griglia': '#2E7D32', 'Cassetta CPR': '#EF6C00'}
+andamento_in_attesa = False
+andamento_da_rifare = False  # filtri cambiati mentre una richiesta era in corso
+
+def aggiorna_andamento():
+    global andamento_in_attesa, andamento_da_rifare
+    if andamento_in_attesa:
+        andamento_da_rifare = True
+        return
+    andamento_in_attesa = True
+    andamento_da_rifare = False
+    dal = andamento_dal.get_date()
+    al = max(andamento_al.get_date(), dal)
+    magazzini = None if andamento_mag_var.get() == 'Tutti' else [andamento_mag_var.get()]
+    db.invia(andamento, dal.strftime('%Y-%m-%d'), al.strftime('%Y-%m-%d'), magazzini,
+             int(andamento_finestra_var.get()), max(canvas_andamento.winfo_width(), 200) - 80,
+             al_termine=mostra_andamento, in_errore=andamento_non_riuscito)
+
+def andamento_non_riuscito(errore):
+    global andamento_in_attesa
+    andamento_in_attesa = False
+    if andamento_da_rifare:
+        aggiorna_andamento()
+        return
+    errore_db(errore)
+
+def mostra_andamento(esito):
+    global andamento_in_attesa
+    andamento_in_attesa = False
+    # risultato di filtri ormai superati: si richiede con quelli attuali senza disegnarlo
+    if andamento_da_rifare:
+        aggiorna_andamento()
+        return
+    larghezza = max(canvas_andamento.winfo_width(), 200)
+    altezza = max(canvas_andamento.winfo_height(), 200)
+    canvas_andamento.delete('all')
+    meta = altezza * 0.62
+    disegna_pannello(canvas_andamento, esito['giorni'],
+                     [(esito['saldo'][art], COLORI_ARTICOLI[art], ()) for art in esito['saldo']] +
+                     [(esito['media'][art], COLORI_ARTICOLI[art], (3, 3)) for art in esito['media']],
+                     60, 10, larghezza - 20, meta - 10, "Saldo (tratteggio: media mobile)")
+    disegna_pannello(canvas_andamento, esito['giorni'], [(esito['valore'], '#6A1B9A', ())],
+                     60, meta + 20, larghezza - 20, altezza - 25, "Valore cauzioni in saldo €")
+    x = 70
+    for art, colore in COLORI_ARTICOLI.items():
+        canvas_andamento.create_line(x, 16, x + 20, 16, fill=colore, width=2)
+        canvas_andamento.create_text(x + 24, 16, text=art, anchor='w', font=("Arial", 8))
+        x += 110
+
+    tree_andamento.delete(*tree_andamento.get_children())
+    for mag, art, saldo, variazione, media in esito['riepilogo']:
+        tree_andamento.insert('', 'end', values=(mag, art, f"{saldo:+.0f}", f"{variazione:+.0f}", f"{media:.1f}"),
+                              tags=tag_valore(variazione))
+
+def disegna_pannello(canvas, giorni, linee, x0, y0, x1, y1, titolo):
+    """Disegna le serie [(valori, colore, tratteggio)] nel riquadro (x0, y0)-(x1, y1), scala comune."""
+    canvas.create_rectangle(x0, y0, x1, y1, outline='#BDBDBD')
+    canvas.create_text(x1 - 4, y0 + 4, text=titolo, anchor='ne', font=("Arial", 8), fill='#616161')
+    valori = [v for serie, _, _ in linee for v in serie]
+    if not valori or len(giorni) < 2:
+        return
+    minimo, massimo = min(valori + [0]), max(valori + [0])
+    if massimo == minimo:
+        massimo = minimo + 1
+
+    def y(valore):
+        return y1 - (valore - minimo) * (y1 - y0) / (massimo - minimo)
+
+    passo = (x1 - x0) / (len(giorni) - 1)
+    canvas.create_line(x0, y(0), x1, y(0), fill='#9E9E9E', dash=(1, 2))
+    for valore in (minimo, massimo):
+        canvas.create_text(x0 - 4, y(valore), text=f"{valore:,.0f}".replace(',', '.'), anchor='e', font=("Arial", 7))
+    for indice in (0, len(giorni) // 2, len(giorni) - 1):
+        canvas.create_text(x0 + indice * passo, y1 + 2, text=giorni[indice], anchor='n', font=("Arial", 7))
+    for serie, colore, tratteggio in linee:
+        punti = [c for i, v in enumerate(serie) for c in (x0 + i * passo, y(v))]
+        canvas.create_line(*punti, fill=colore, width=1 if tratteggio else 2, dash=tratteggio)
+
+def mostra_prezzi():
+    """Listino delle cauzioni: ogni prezzo vale dalla sua data di decorrenza in poi."""
+    finestra = tk.Toplevel(root)
+    finestra.title("Prezzi cauzioni")
+    finestra.resizable(False, False)
+    finestra.transient(root)
+
+    tree = ttk.Treeview(finestra, columns=('Articolo', 'Dal', 'Prezzo'), show='headings', height=8)
+    for colonna, larghezza in [('Articolo', 140), ('Dal', 110), ('Prezzo', 90)]:
+        tree.heading(colonna, text=colonna)
+        tree.column(colonna, width=larghezza, anchor='center')
+    tree.grid(row=0, column=0, columnspan=4, padx=10, pady=(10, 6))
+    tree.bind('<<TreeviewSelect>>', lambda e: selezionato())
+    prezzi = {}  # iid → (articolo, dal, prezzo)
+
+    art_var = tk.StringVar(value='Roll')
+    ttk.Combobox(finestra, textvariable=art_var, state="readonly", width=13,
+                 values=['Roll', 'Griglia', 'Cassetta CPR']).grid(row=1, column=0, padx=(10, 5))
+    cal_dal = DateEntry(finestra, width=11, date_pattern='yyyy-mm-dd', font=("Arial", 10))
+    cal_dal.grid(row=1, column=1, padx=5)
+    prezzo_var = tk.StringVar()
+    tk.Entry(finestra, textvariable=prezzo_var, width=8, font=("Arial", 10)).grid(row=1, column=2, padx=5)
+
+    def ricarica():
+        db.invia(dati_prezzi, al_termine=mostra)
+
+    def mostra(righe):
+        if not finestra.winfo_exists():
+            return
+        tree.delete(*tree.get_children())
+        prezzi.clear()
+        for articolo, dal, prezzo in righe:
+            iid = tree.insert('', 'end', values=(articolo, 'sempre' if dal == DECORRENZA_BASE else dal, f"{prezzo:.2f} €"))
+            prezzi[iid] = (articolo, dal, prezzo)
+        selezionato()
+
+    def base_selezionato():
+        scelti = [prezzi[iid] for iid in tree.selection() if iid in prezzi]
+        return len(scelti) == 1 and scelti[0][1] == DECORRENZA_BASE
+
+    def selezionato():
+        """Una riga scelta riempie i campi; per il prezzo di base la data non si cambia."""
+        scelti = [prezzi[iid] for iid in tree.selection() if iid in prezzi]
+        cal_dal.configure(state='disabled' if base_selezionato() else 'normal')
+        if len(scelti) == 1:
+            articolo, dal, prezzo = scelti[0]
+            art_var.set(articolo)
+            if dal != DECORRENZA_BASE:
+                cal_dal.set_date(date.fromisoformat(dal))
+            prezzo_var.set(f"{prezzo:.2f}".replace('.', ','))
+
+    def cambiati(_):
+        ricarica()
+        # i valori dei giorni dalla decorrenza in poi cambiano: le due viste si ricaricano
+        for vista in ('cauzioni', 'resi'):
+            if vista_corrente() == vista:
+                aggiorna_valori(vista)
+            else:
+                segna_scaduta(vista)
+        if vista_corrente() == 'andamento':
+            aggiorna_andamento()
+        else:
+            segna_scaduta('andamento')
+
+    def salva():
+        try:
+            prezzo = float(prezzo_var.get().replace(',', '.'))
+        except ValueError:
+            messagebox.showerror("Prezzo non valido", "Inserisci il prezzo in euro, es. 52 o 7,50.", parent=finestra)
+            return
+        dal = DECORRENZA_BASE if base_selezionato() else cal_dal.get_date().strftime('%Y-%m-%d')
+        db.invia(imposta_prezzo, art_var.get(), dal, prezzo, al_termine=cambiati)
+
+    def elimina():
+        if any(prezzi[iid][1] == DECORRENZA_BASE for iid in tree.selection()):
+            messagebox.showerror("Prezzo di base",
+                                 "Il prezzo di base non si può eliminare: selezionalo, cambia il prezzo e premi Salva.",
+                                 parent=finestra)
+            return
+        for iid in tree.selection():
+            db.invia(elimina_prezzo, *prezzi[iid][:2], al_termine=cambiati)
+
+    tk.Button(finestra, text="Salva", command=salva, width=8).grid(row=1, column=3, padx=(5, 10))
+    tk.Button(finestra, text="Elimina selezionato", command=elimina).grid(row=2, column=0, columnspan=4, pady=(6, 10))
+    ricarica()
+
+# ── Aggiornamento incrementale delle viste ──────
+# Una registrazione o un annullamento tocca un solo giorno: invece di ricostruire
+# le viste si rilegge dal riepilogo solo quel giorno e si correggono i totali per differenza.
+
+def aggiorna_giorno(data, report=True):
+    """Rilegge il giorno solo per la vista a schermo; le altre lo annotano come scaduto."""
+    invalida_report(data)
+    visibile = vista_corrente()
+    for vista in ('storico', 'cauzioni', 'resi'):
+        if vista != visibile:
+            segna_scaduta(vista, data)
+    if visibile in ('storico', 'cauzioni', 'resi') and visibile in viste_in_sospeso:
+        db.invia(dati_giorno, data, al_termine=lambda esito: mostra_giorno(esito, (visibile,)))
+    # l'andamento dipende dai saldi cumulati: si ridisegna tutto
+    if visibile == 'andamento':
+        aggiorna_andamento()
+    else:
+        segna_scaduta('andamento', data)
+    dal, al = periodo_report()
+    if report and dal <= data <= al:
+        richiedi_report()
+
+def aggiorna_giorni(date_toccate):
+    """Come aggiorna_giorno per più date, con un solo aggiornamento del report."""
+    dal, al = periodo_report()
+    for data in date_toccate:
+        aggiorna_giorno(data, report=False)
+    if any(dal <= data <= al for data in date_toccate):
+        richiedi_report()
+
+def mostra_giorno(esito, viste=('storico', 'cauzioni', 'resi')):
+    data, mov_giorno, entrate_cauzioni, dati_resi_giorno, prezzi = esito
+    if 'storico' in viste:
+        aggiorna_giorno_storico(data, mov_giorno)
+    if 'cauzioni' in viste:
+        aggiorna_giorno_valori('cauzioni', data, entrate_cauzioni, prezzi)
+    if 'resi' in viste:
+        aggiorna_giorno_valori('resi', data, dati_resi_giorno, prezzi)
+
+def aggiorna_giorno_storico(data, mov_giorno):
+    if not righe_storico or filtro_storico:
+        # col filtro il giorno va riletto filtrato, e con lui il subtotale
+        aggiorna_storico()
+        return
 
-            valore_giorno += val_netto
+    iid = righe_storico.get(data)
+    if not mov_giorno:
+        if iid:
+            tree_storico.delete(iid)
+            del righe_storico[data]
+            if not righe_storico:
+                aggiorna_storico()
+        return
 
-            testo = ""
-            if entrate > 0:
-                testo += f"+{entrate} ({val_entrate:.2f} €)"
-            if uscite > 0:
-                testo += f"  -{uscite} ({val_uscite:.2f} €)" if testo else f"-{uscite} ({val_uscite:.2f} €)"
+    riepilogo_txt = testo_riepilogo_giorno(mov_giorno)
+    if iid:
+        tree_storico.set(iid, 'Tipo', riepilogo_txt)
+        if tree_storico.get_children(iid):
+            espandi_giorno(iid)
+    elif storico_completo or data > storico_ultimo_giorno:
+        # giorno nuovo dentro l'intervallo già caricato (le pagine successive lo troveranno da sole)
+        righe_storico[data] = tree_storico.insert('', posizione_giorno(tree_storico, data, colonna=1),
+                                                  values=('', data, riepilogo_txt, '', ''), tags=('giorno',))
+
+def periodo_report():
+    dal = calendario_report.get_date()
+    al = max(calendario_report_al.get_date(), dal)
+    return dal.strftime('%Y-%m-%d'), al.strftime('%Y-%m-%d')
+
+def imposta_periodo_report(periodo):
+    """Preimposta Dal/Al su giorno, settimana (lun–dom) o mese della data "Dal" e genera il report."""
+    giorno = calendario_report.get_date()
+    if periodo == 'settimana':
+        dal = giorno - timedelta(days=giorno.weekday())
+        al = dal + timedelta(days=6)
+    elif periodo == 'mese':
+        dal = giorno.replace(day=1)
+        al = (dal + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        dal = al = giorno
+    calendario_report.set_date(dal)
+    calendario_report_al.set_date(al)
+    genera_report()
 
-            row_values.append(testo if testo else "—")
+def genera_report():
+    """Mostra il report del periodo scelto: dalla cache se c'è, altrimenti dal lavoratore."""
+    dal, al = periodo_report()
+    chiave = (dal, al)
+    if chiave in cache_report:
+        cache_report.move_to_end(chiave)
+        mostra_report(dal, al, *cache_report[chiave])
+        precarica_report(dal, al)
+        return
 
-        totale_cumulato += valore_giorno
-        row_values.append(f"{valore_giorno:+.2f} €")
+    def pronto(esito):
+        memorizza_report(chiave, esito)
+        if periodo_report() == chiave:  # nel frattempo l'utente può aver cambiato periodo
+            mostra_report(dal, al, *esito)
+            precarica_report(dal, al)
+
+    report_in_corso.add(chiave)
+    db.invia(dati_report, dal, al, al_termine=pronto)
+
+def memorizza_report(chiave, esito):
+    report_in_corso.discard(chiave)
+    cache_report[chiave] = esito
+    cache_report.move_to_end(chiave)
+    while len(cache_report) > MAX_REPORT_IN_CACHE:
+        cache_report.popitem(last=False)
+
+def invalida_report(data=None):
+    """Toglie dalla cache i report che comprendono `data` (tutti se None)."""
+    for chiave in [k for k in cache_report if data is None or k[0] <= data <= k[1]]:
+        del cache_report[chiave]
+
+def periodo_adiacente(dal, al, verso):
+    """Periodo precedente (verso=-1) o successivo (+1) della stessa ampiezza; i mesi interi restano mesi."""
+    inizio, fine = date.fromisoformat(dal), date.fromisoformat(al)
+    if inizio.day == 1 and (fine + timedelta(days=1)).day == 1 and (inizio.year, inizio.month) == (fine.year, fine.month):
+        inizio = (inizio - timedelta(days=1)).replace(day=1) if verso < 0 else fine + timedelta(days=1)
+        fine = (inizio + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        passo = timedelta(days=((fine - inizio).days + 1) * verso)
+        inizio, fine = inizio + passo, fine + passo
+    return inizio.strftime('%Y-%m-%d'), fine.strftime('%Y-%m-%d')
+
+def precarica_report(dal, al):
+    """Chiede in background i periodi accanto a quello mostrato, per scorrere senza attese."""
+    for verso in (-1, 1):
+        chiave = periodo_adiacente(dal, al, verso)
+        if chiave not in cache_report and chiave not in report_in_corso:
+            report_in_corso.add(chiave)
+            db.invia(dati_report, *chiave, al_termine=lambda esito, c=chiave: memorizza_report(c, esito))
+
+def sposta_periodo_report(verso):
+    dal, al = periodo_adiacente(*periodo_report(), verso)
+    calendario_report.set_date(date.fromisoformat(dal))
+    calendario_report_al.set_date(date.fromisoformat(al))
+    genera_report()
 
-        tag = 'positivo' if valore_giorno > 0 else ('negativo' if valore_giorno < 0 else '')
-        tree_cauzioni_resi.insert('', 'end', values=row_values, tags=tag)
+def righe_report(tree, parent, data, valori):
+    """Inserisce sotto `parent` le 12 righe magazzino × articolo, anche a zero."""
+    articoli = ['Roll', 'Griglia', 'Cassetta CPR']
+    magazzini = ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
 
-    # Riga totale sempre visibile
-    tree_cauzioni_resi.insert('', 'end', values=('', '', '', '', f"Totale cumulato: {totale_cumulato:+.2f} €"), tags=('totale',))
-    print(f"DEBUG Resi: totale cumulato calcolato = {totale_cumulato:.2f} €")
+    for mag in magazzini:
+        for art in articoli:
+            entrate, uscite = valori.get((mag, art), (0, 0))
+            tag = tag_valore(entrate - uscite)
+            tree.insert(parent, 'end', values=(data, mag, art, entrate, uscite, f"{entrate - uscite:+d}"), tags=tag)
 
-def genera_report():
-    data_rep = calendario_report.get_date().strftime('%Y-%m-%d')
+def mostra_report(dal, al, per_giorno, totali):
     for row in tree_report.get_children():
         tree_report.delete(row)
 
-    articoli = ['Roll', 'Griglia', 'Cassetta CPR']
-    magazzini = ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
+    if dal == al:
+        righe_report(tree_report, '', dal, per_giorno.get(dal, {}))
+        return
 
-    for mag in magazzini:
-        for art in articoli:
-            cursor.execute('''
-                SELECT 
-                    SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE 0 END) as entrate,
-                    SUM(CASE WHEN direzione = 'USCITA'  THEN quantita ELSE 0 END) as uscite
-                FROM movimenti 
-                WHERE data = ? AND articolo = ? AND magazzino = ?
-            ''', (data_rep, art, mag))
-            entrate, uscite = cursor.fetchone()
-            entrate = entrate or 0
-            uscite  = uscite  or 0
-            tree_report.insert('', 'end', values=(data_rep, mag, art, entrate, uscite))
+    # Totali del periodo in cima, poi un gruppo richiudibile per ogni giorno con movimenti
+    iid_totale = tree_report.insert('', 'end', open=True, tags=('totale',),
+                                    values=(f"{dal} → {al}", 'Totale periodo', '', '', '', ''))
+    righe_report(tree_report, iid_totale, '', totali)
+
+    for data in sorted(per_giorno):
+        iid_giorno = tree_report.insert('', 'end', values=(data, '', '', '', '', ''), tags=('giorno',))
+        righe_report(tree_report, iid_giorno, data, per_giorno[data])
 
 def esporta_csv():
-    with open('movimenti_supporti.csv', 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['Data', 'Articolo', 'Direzione', 'Magazzino', 'Quantità'])
-        cursor.execute('SELECT data, articolo, direzione, magazzino, quantita FROM movimenti ORDER BY id')
-        writer.writerows(cursor.fetchall())
-    messagebox.showinfo("Esportato", "Creato file: movimenti_supporti.csv")
+    """Finestra di esportazione: filtri, compressione e avanzamento mentre il lavoro gira in background."""
+    finestra = tk.Toplevel(root)
+    finestra.title("Esporta movimenti")
+    finestra.resizable(False, False)
+    finestra.transient(root)
+
+    solo_periodo = tk.BooleanVar(value=False)
+    tk.Checkbutton(finestra, text="Solo periodo:", variable=solo_periodo,
+                   font=("Arial", 10)).grid(row=0, column=0, sticky="w", padx=10, pady=6)
+    cal_dal = DateEntry(finestra, width=12, date_pattern='yyyy-mm-dd', font=("Arial", 10))
+    cal_dal.grid(row=0, column=1, padx=5, pady=6)
+    cal_al = DateEntry(finestra, width=12, date_pattern='yyyy-mm-dd', font=("Arial", 10))
+    cal_al.grid(row=0, column=2, padx=(5, 10), pady=6)
+
+    tk.Label(finestra, text="Magazzino:", font=("Arial", 10)).grid(row=1, column=0, sticky="w", padx=10, pady=6)
+    mag_var = tk.StringVar(value="Tutti")
+    ttk.Combobox(finestra, textvariable=mag_var, state="readonly", width=14,
+                 values=['Tutti', 'Carne', 'Ortofrutta', 'Freschi', 'Secchi']).grid(row=1, column=1, sticky="w", padx=5)
+
+    tk.Label(finestra, text="Articolo:", font=("Arial", 10)).grid(row=2, column=0, sticky="w", padx=10, pady=6)
+    art_var = tk.StringVar(value="Tutti")
+    ttk.Combobox(finestra, textvariable=art_var, state="readonly", width=14,
+                 values=['Tutti', 'Roll', 'Griglia', 'Cassetta CPR']).grid(row=2, column=1, sticky="w", padx=5)
+
+    comprimi = tk.BooleanVar(value=False)
+    tk.Checkbutton(finestra, text="Comprimi (.csv.gz)", variable=comprimi,
+                   font=("Arial", 10)).grid(row=3, column=0, columnspan=2, sticky="w", padx=10, pady=6)
+
+    barra = ttk.Progressbar(finestra, length=320, mode='determinate')
+    barra.grid(row=4, column=0, columnspan=3, padx=10, pady=(10, 2))
+    stato = tk.Label(finestra, text="", font=("Arial", 9))
+    stato.grid(row=5, column=0, columnspan=3, pady=(0, 6))
+
+    def avanzamento(valore):
+        scritte, totale = valore
+        if finestra.winfo_exists():
+            barra['value'] = 100 * scritte / totale if totale else 100
+            stato.config(text=f"{scritte} / {totale} movimenti")
+
+    def completata(scritte, percorso):
+        if finestra.winfo_exists():
+            finestra.destroy()
+        messagebox.showinfo("Esportato", f"Creato file: {percorso}\n{scritte} movimenti esportati.")
+
+    def avvia():
+        estensione = '.csv.gz' if comprimi.get() else '.csv'
+        percorso = filedialog.asksaveasfilename(parent=finestra, defaultextension=estensione,
+                                                initialfile='movimenti_supporti' + estensione,
+                                                filetypes=[("CSV", "*.csv *.csv.gz"), ("Tutti i file", "*.*")])
+        if not percorso:
+            return
+        filtri = dict(magazzini=None if mag_var.get() == 'Tutti' else [mag_var.get()],
+                      articoli=None if art_var.get() == 'Tutti' else [art_var.get()],
+                      comprimi=comprimi.get())
+        if solo_periodo.get():
+            filtri['dal'] = cal_dal.get_date().strftime('%Y-%m-%d')
+            filtri['al'] = cal_al.get_date().strftime('%Y-%m-%d')
+        btn_esporta.config(state="disabled")
+        lavori_lunghi.invia(esporta_movimenti, percorso,
+                            progresso=lambda scritte, totale: lavori_lunghi.notifica(avanzamento, (scritte, totale)),
+                            al_termine=lambda scritte: completata(scritte, percorso),
+                            **filtri)
+
+    btn_esporta = tk.Button(finestra, text="Esporta", command=avvia,
+                            bg="#2196F3", fg="white", font=("Arial", 10, "bold"), width=12)
+    btn_esporta.grid(row=6, column=0, columnspan=3, pady=(4, 10))
+
+def importa_csv():
+    percorso = filedialog.askopenfilename(title="Importa movimenti da CSV",
+                                          filetypes=[("CSV", "*.csv *.csv.gz"), ("Tutti i file", "*.*")])
+    if not percorso:
+        return
+    if not messagebox.askyesno("Importa movimenti",
+                               f"Importare i movimenti da:\n{percorso}\n\n"
+                               "Le righe valide vengono registrate tutte insieme, quelle non valide scartate."):
+        return
+
+    finestra = tk.Toplevel(root)
+    finestra.title("Importazione in corso")
+    finestra.resizable(False, False)
+    finestra.transient(root)
+    barra = ttk.Progressbar(finestra, length=320, mode='indeterminate')
+    barra.pack(padx=10, pady=(12, 4))
+    barra.start(15)
+    stato = tk.Label(finestra, text="Lettura del file…", font=("Arial", 9))
+    stato.pack(padx=10, pady=(0, 12))
+
+    def avanzamento(valore):
+        importate, scartate = valore
+        if finestra.winfo_exists():
+            stato.config(text=f"{importate} movimenti letti, {scartate} righe scartate")
+
+    def chiudi(_=None):
+        if finestra.winfo_exists():
+            finestra.destroy()
+
+    def completata(esito):
+        importate, scarti = esito
+        chiudi()
+        aggiorna_tutto()
+
+        testo = f"Importati {importate} movimenti."
+        if scarti:
+            file_scarti = percorso + '.scarti.txt'
+            with open(file_scarti, 'w', encoding='utf-8') as f:
+                for numero, motivo in scarti:
+                    f.write(f"riga {numero}: {motivo}\n")
+            elenco = "\n".join(f"riga {numero}: {motivo}" for numero, motivo in scarti[:15])
+            testo += f"\n\n{len(scarti)} righe scartate (elenco completo in {file_scarti}):\n{elenco}"
+            if len(scarti) > 15:
+                testo += "\n…"
+        messagebox.showinfo("Importazione completata", testo)
+
+    def fallita(errore):
+        chiudi()
+        messagebox.showerror("Importazione non riuscita", f"Nessun movimento importato:\n{errore}")
+
+    lavori_lunghi.invia(importa_movimenti, percorso,
+                        progresso=lambda importate, scartate: lavori_lunghi.notifica(avanzamento, (importate, scartate)),
+                        al_termine=completata, in_errore=fallita)
+
+def riconcilia_estratto_cedi():
+    """Confronta un estratto cauzioni del CEDI con i movimenti Freschi/Secchi registrati."""
+    percorso = filedialog.askopenfilename(title="Estratto cauzioni CEDI da riconciliare",
+                                          filetypes=[("CSV", "*.csv *.csv.gz *.txt"), ("Tutti i file", "*.*")])
+    if not percorso:
+        return
+
+    finestra = tk.Toplevel(root)
+    finestra.title("Riconciliazione in corso")
+    finestra.resizable(False, False)
+    finestra.transient(root)
+    barra = ttk.Progressbar(finestra, length=320, mode='indeterminate')
+    barra.pack(padx=10, pady=(12, 4))
+    barra.start(15)
+    stato = tk.Label(finestra, text="Lettura dell'estratto…", font=("Arial", 9))
+    stato.pack(padx=10, pady=(0, 12))
+
+    def avanzamento(valore):
+        lette, scartate = valore
+        if finestra.winfo_exists():
+            stato.config(text=f"{lette} righe lette, {scartate} scartate")
+
+    def chiudi(_=None):
+        if finestra.winfo_exists():
+            finestra.destroy()
+
+    def completata(esito):
+        chiudi()
+        mostra_riconciliazione(esito, percorso)
+
+    def fallita(errore):
+        chiudi()
+        messagebox.showerror("Riconciliazione non riuscita", f"Estratto non letto:\n{errore}")
+
+    lavori_lunghi.invia(riconcilia_cedi, percorso,
+                        progresso=lambda lette, scartate: lavori_lunghi.notifica(avanzamento, (lette, scartate)),
+                        al_termine=completata, in_errore=fallita)
+
+def mostra_riconciliazione(esito, percorso):
+    finestra = tk.Toplevel(root)
+    finestra.title(f"Riconciliazione – {os.path.basename(percorso)}")
+    finestra.geometry("900x460")
+
+    differenza = esito['valore_estratto'] - esito['valore_registrato']
+    testo = (f"Periodo {esito['dal']} – {esito['al']}: {esito['righe']} righe"
+             f"{', depositi ' + ', '.join(esito['depositi']) if esito['depositi'] else ''}.  "
+             f"{len(esito['differenze'])} differenze, {len(esito['giorni_mancanti'])} giorni mancanti.\n"
+             f"Valore estratto CEDI {esito['valore_estratto']:.2f} € – registrato {esito['valore_registrato']:.2f} €"
+             f" – differenza {differenza:+.2f} €")
+    if esito['scarti']:
+        file_scarti = percorso + '.scarti.txt'
+        with open(file_scarti, 'w', encoding='utf-8') as f:
+            for numero, motivo in esito['scarti']:
+                f.write(f"riga {numero}: {motivo}\n")
+        testo += f"\n{len(esito['scarti'])} righe dell'estratto scartate (elenco in {file_scarti})"
+    tk.Label(finestra, text=testo, font=("Arial", 10), justify="left",
+             fg="#2E7D32" if not esito['differenze'] else "#C62828").pack(padx=10, pady=8, anchor="w")
+
+    colonne = [('Data', 95), ('Articolo', 110), ('Direzione', 85), ('Estratto', 85), ('Registrato', 85),
+               ('Differenza', 85), ('Valore €', 95), ('Giorno', 200)]
+    cornice = tk.Frame(finestra)
+    cornice.pack(fill="both", expand=True, padx=10)
+    tree = ttk.Treeview(cornice, columns=[c for c, _ in colonne], show='headings')
+    for colonna, larghezza in colonne:
+        tree.heading(colonna, text=colonna)
+        tree.column(colonna, width=larghezza, anchor='center')
+    tree.tag_configure('positivo', foreground='green')
+    tree.tag_configure('negativo', foreground='red')
+    tree.tag_configure('mancante', background='#FFF3E0')
+    scrollbar = ttk.Scrollbar(cornice, orient="vertical", command=tree.yview)
+    tree.configure(yscrollcommand=scrollbar.set)
+    scrollbar.pack(side="right", fill="y")
+    tree.pack(fill="both", expand=True)
+
+    mancanti = {'registro': "manca nel registro", 'estratto': "manca nell'estratto CEDI"}
+    giorni_mancanti = dict(esito['giorni_mancanti'])
+    for data, articolo, direzione, q_estratto, q_registrato, diff, _, valore in esito['differenze']:
+        nota = mancanti.get(giorni_mancanti.get(data), '')
+        tree.insert('', 'end', values=(data, articolo, direzione, q_estratto, q_registrato, f"{diff:+d}",
+                                       f"{valore:+.2f}", nota),
+                    tags=[tag for tag in (tag_valore(valore), 'mancante' if nota else '') if tag])
+
+    def esporta():
+        destinazione = filedialog.asksaveasfilename(parent=finestra, defaultextension='.csv',
+                                                    initialfile='riconciliazione_cedi.csv',
+                                                    filetypes=[("CSV", "*.csv"), ("Tutti i file", "*.*")])
+        if destinazione:
+            scritte = esporta_riconciliazione(esito, destinazione)
+            messagebox.showinfo("Esportato", f"Creato file: {destinazione}\n{scritte} differenze.", parent=finestra)
+
+    tk.Button(finestra, text="Esporta differenze…", command=esporta,
+              state="normal" if esito['differenze'] else "disabled").pack(pady=8)
 
 def azzera_database():
     if not messagebox.askyesno("CONFERMA CANCELLAZIONE", 
@@ -353,38 +1280,356 @@ def azzera_database():
 
     if not messagebox.askyesno("ULTIMA CONFERMA", 
                                "ULTIMA AVVERTENZA:\n\n"
-                               "Stai per cancellare IRRECUPERABILMENTE tutti i dati.\n"
+                               "Stai per cancellare tutti i dati.\n"
+                               "Prima viene salvata una copia nella cartella dei backup.\n"
                                "Sicuro al 100%?"):
         return
 
-    # Cancella tutti i record
-    cursor.execute("DELETE FROM movimenti")
-    conn.commit()
+    # Cancella tutti i record: istantanea, cancellazione e VACUUM non fermano registrazioni e viste
+    lavori_lunghi.invia(svuota_movimenti, al_termine=database_azzerato)
 
+def database_azzerato(copia):
+    inserimenti_postazione.clear()  # i movimenti registrati da qui non ci sono più
     # Aggiorna tutte le viste
-    aggiorna_storico()
-    aggiorna_cauzioni_c_o()
-    aggiorna_cauzioni_resi()
-    genera_report()
+    aggiorna_tutto()
 
     messagebox.showinfo("Database azzerato", 
                         "Il database è stato completamente azzerato.\n"
-                        "Ora è vuoto e pronto per nuovi inserimenti.")
+                        "Ora è vuoto e pronto per nuovi inserimenti."
+                        + (f"\n\nCopia dei dati cancellati:\n{os.path.abspath(copia)}" if copia else ""))
+
+    logger.info('Database azzerato')
 
-    print("DEBUG: Database azzerato con successo")
+def backup_manuale():
+    if backup_in_corso:
+        return
+    avvia_backup(crea_backup, 'manuale', al_termine=backup_completato)
+
+def controlla_backup():
+    """Ogni INTERVALLO_CONTROLLO_BACKUP ms: backup automatico se l'ultimo è troppo vecchio."""
+    root.after(INTERVALLO_CONTROLLO_BACKUP, controlla_backup)
+    if not backup_in_corso:
+        avvia_backup(backup_se_scaduto, al_termine=lambda _: fine_backup(), in_errore=backup_automatico_non_riuscito)
+
+def backup_automatico_non_riuscito(errore):
+    # nessun avviso a ogni controllo: resta nel log e si riprova al giro successivo
+    fine_backup()
+    logger.warning('Backup automatico non riuscito: %s', errore)
+
+def avvia_backup(funzione, *args, al_termine, in_errore=None):
+    """La copia gira su lavori_lunghi a passi di pagine: registrazioni e viste restano libere."""
+    global backup_in_corso
+    backup_in_corso = True
+    lavori_lunghi.invia(funzione, *args,
+                        progresso=lambda copiate, totale: lavori_lunghi.notifica(avanzamento_backup, (copiate, totale)),
+                        al_termine=al_termine, in_errore=in_errore or backup_non_riuscito)
+
+def avanzamento_backup(valore):
+    copiate, totale = valore
+    btn_backup.config(text=f"Backup {copiate * 100 // max(totale, 1)}%")
+
+def fine_backup():
+    global backup_in_corso
+    backup_in_corso = False
+    btn_backup.config(text="Backup")
+
+def backup_completato(percorso):
+    fine_backup()
+    messagebox.showinfo("Backup completato", f"Copia del database salvata in:\n{os.path.abspath(percorso)}")
+
+def backup_non_riuscito(errore):
+    fine_backup()
+    messagebox.showerror("Backup non riuscito", f"Nessuna copia salvata:\n{errore}")
+
+def mostra_diagnostica(event=None):
+    """Finestra con i tempi raccolti: richieste al database, istruzioni SQL e soglia del log."""
+    finestra = tk.Toplevel(root)
+    finestra.title("Diagnostica")
+    finestra.geometry("900x420")
+
+    barra = tk.Frame(finestra)
+    barra.pack(fill="x", padx=10, pady=6)
+    tk.Label(barra, text="Soglia operazioni lente (ms):").pack(side="left")
+    soglia_var = tk.StringVar(value=str(soglia_lenta_ms()))
+    tk.Spinbox(barra, from_=10, to=10000, increment=50, width=7, textvariable=soglia_var).pack(side="left", padx=5)
+    tk.Label(barra, text=f"Log: {os.path.abspath(FILE_LOG)}", fg="#555555").pack(side="left", padx=15)
+    tk.Button(barra, text="Azzera", command=lambda: (azzera_statistiche(), aggiorna())).pack(side="right")
+
+    tree = ttk.Treeview(finestra, columns=('Operazione', 'Volte', 'Media', 'Massimo', 'Totale'), show='headings')
+    for colonna, testo, larghezza, allinea in [('Operazione', 'Operazione', 520, 'w'), ('Volte', 'Volte', 70, 'e'),
+                                               ('Media', 'Media ms', 90, 'e'), ('Massimo', 'Max ms', 90, 'e'),
+                                               ('Totale', 'Totale ms', 100, 'e')]:
+        tree.heading(colonna, text=testo)
+        tree.column(colonna, width=larghezza, anchor=allinea)
+    tree.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+    tree.tag_configure('lenta', foreground='red')
+    etichetta_righe = tk.Label(finestra)
+    etichetta_righe.pack(pady=(0, 6))
+
+    prossimo = None  # id di after() del prossimo aggiornamento
+
+    def aggiorna():
+        nonlocal prossimo
+        if prossimo is not None:
+            finestra.after_cancel(prossimo)  # "Azzera" non deve avviare un secondo ciclo
+        try:
+            imposta_soglia_lenta(float(soglia_var.get()))
+        except ValueError:
+            pass
+        tree.delete(*tree.get_children())
+        voci = sorted(statistiche.items(), key=lambda voce: voce[1][1], reverse=True)
+        for operazione, (volte, totale, massimo) in voci:
+            tree.insert('', 'end', values=(operazione, volte, f"{totale / volte:.1f}", f"{massimo:.1f}", f"{totale:.0f}"),
+                        tags=('lenta',) if massimo >= soglia_lenta_ms() else ())
+        etichetta_righe.config(text=f"Righe inserite nelle viste dall'avvio: {TreeviewContato.righe_inserite}")
+        prossimo = finestra.after(1000, aggiorna)
+
+    def chiusa(event):
+        # <Destroy> arriva anche per ogni widget figlio
+        if event.widget is finestra and prossimo is not None:
+            finestra.after_cancel(prossimo)
+
+    finestra.bind('<Destroy>', chiusa)
+    aggiorna()
 
 def beep_semplice():
     sys.stdout.write('\a')
     sys.stdout.flush()
+
+# ────────────────────────────────────────────────
+# RIGA DI COMANDO
+# ────────────────────────────────────────────────
+# python gestione_roll.py esporta|importa FILE ... lavora senza aprire la finestra.
+
+def cli_esporta(args):
+    conn = apri_database(args.db)
+
+    def progresso(scritte, totale):
+        if not args.silenzioso:
+            print(f"\r{scritte}/{totale} movimenti", end='', file=sys.stderr, flush=True)
+
+    try:
+        scritte = esporta_movimenti(conn, args.file, dal=args.dal, al=args.al,
+                                    magazzini=args.magazzino, articoli=args.articolo,
+                                    comprimi=args.gzip or None, progresso=progresso)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"\nEsportazione non riuscita: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    if not args.silenzioso:
+        print(f"\rEsportati {scritte} movimenti in {args.file}", file=sys.stderr)
+    return 0
+
+def cli_importa(args):
+    conn = apri_database(args.db)
+
+    def progresso(importate, scartate):
+        if not args.silenzioso:
+            print(f"\r{importate} movimenti letti, {scartate} scartati", end='', file=sys.stderr, flush=True)
+
+    try:
+        importate, scarti = importa_movimenti(conn, args.file, progresso=progresso)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"\nImportazione non riuscita, nessun movimento importato: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+    if not args.silenzioso:
+        print(f"\rImportati {importate} movimenti da {args.file}", file=sys.stderr)
+    for numero, motivo in scarti:
+        print(f"riga {numero}: {motivo}", file=sys.stderr)
+    return 2 if scarti else 0
+
+def cli_saldo(args):
+    al = args.al or date.today().strftime('%Y-%m-%d')
+    try:
+        # senza --chiudi è una lettura: nessuna chiusura automatica che scriva mentre il programma è aperto
+        conn = apri_database(args.db) if args.chiudi else connetti_sola_lettura(args.db)
+    except (OSError, RuntimeError, sqlite3.Error) as e:
+        print(f"Saldo non calcolato: {e}", file=sys.stderr)
+        return 1
+    try:
+        if args.chiudi:
+            crea_chiusura(conn, al)
+        saldi = [(mag, art, calcola_saldo(conn, art, mag, al=args.al))
+                 for mag in ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
+                 for art in ['Roll', 'Griglia', 'Cassetta CPR']]
+        totale = calcola_saldo(conn, al=args.al)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"Saldo non calcolato: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+    print(f"Saldo al {al}")
+    for mag, art, saldo in saldi:
+        print(f"{mag:<12}{art:<14}{saldo:>+8d}")
+    print(f"{'Totale':<26}{totale:>+8d}")
+    return 0
+
+def cli_compatta(args):
+    conn = apri_database(args.db)
+    prima = os.path.getsize(args.db)
+    try:
+        converti_in_compatto(conn, args.db)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"Conversione non riuscita, database invariato: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print(f"Formato compatto: {prima / 1e6:.1f} MB → {os.path.getsize(args.db) / 1e6:.1f} MB "
+          f"(copia del formato esteso in {args.db}.esteso.bak)", file=sys.stderr)
+    return 0
+
+def cli_archivia(args):
+    conn = apri_database(args.db)
+    try:
+        anno = args.anno or anno_archiviabile(conn)
+        if anno is None:
+            print("Nessun anno concluso da archiviare.", file=sys.stderr)
+            return 1
+        archivio, spostati = archivia_anno(conn, anno)
+    except (ValueError, OSError, RuntimeError, sqlite3.Error) as e:
+        print(f"Archiviazione non riuscita, database invariato: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print(f"Archiviato il {anno}: {spostati} movimenti in {archivio}", file=sys.stderr)
+    return 0
+
+def cli_riconcilia(args):
+    conn = apri_database(args.db)
+
+    def progresso(lette, scartate):
+        if not args.silenzioso:
+            print(f"\r{lette} righe lette, {scartate} scartate", end='', file=sys.stderr, flush=True)
+
+    try:
+        esito = riconcilia_cedi(conn, args.file, progresso=progresso)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"\nRiconciliazione non riuscita: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+    if args.csv:
+        esporta_riconciliazione(esito, args.csv)
+    print(f"Periodo {esito['dal']} – {esito['al']}: {esito['righe']} righe, {esito['chiavi']} combinazioni "
+          f"giorno/articolo/direzione")
+    mancanti = {'registro': "manca nel registro", 'estratto': "manca nell'estratto CEDI"}
+    for data, dove in esito['giorni_mancanti']:
+        print(f"{data}  giorno che {mancanti[dove]}")
+    for data, articolo, direzione, q_estratto, q_registrato, differenza, _, valore in esito['differenze']:
+        print(f"{data}  {articolo:<13}{direzione:<8} CEDI {q_estratto:>6}  registrato {q_registrato:>6}  "
+              f"{differenza:>+6d}  {valore:>+10.2f} €")
+    print(f"Valore CEDI {esito['valore_estratto']:.2f} €, registrato {esito['valore_registrato']:.2f} €, "
+          f"differenza {esito['valore_estratto'] - esito['valore_registrato']:+.2f} €")
+    for numero, motivo in esito['scarti']:
+        print(f"riga {numero}: {motivo}", file=sys.stderr)
+    return 2 if esito['differenze'] or esito['scarti'] else 0
+
+def cli_backup(args):
+    conn = apri_database(args.db)
+
+    def progresso(copiate, totale):
+        if not args.silenzioso:
+            print(f"\r{copiate}/{totale} pagine", end='', file=sys.stderr, flush=True)
+
+    try:
+        if args.se_scaduto:
+            percorso = backup_se_scaduto(conn, args.cartella, progresso=progresso)
+        else:
+            percorso = crea_backup(conn, 'manuale', args.cartella, progresso=progresso)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print(f"\nBackup non riuscito: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    if not args.silenzioso:
+        print(f"\rBackup in {percorso}" if percorso else "Ultimo backup abbastanza recente, nessuna copia.",
+              file=sys.stderr)
+    return 0
+
+def main_cli(argv):
+    parser = argparse.ArgumentParser(prog='gestione_roll.py',
+                                     description="Gestione Roll / Griglie / CPR – comandi senza interfaccia grafica.")
+    parser.add_argument('--db', default=DB_PATH, help=f"file del database (predefinito: {DB_PATH})")
+    comandi = parser.add_subparsers(dest='comando', required=True)
+
+    esporta = comandi.add_parser('esporta', help="esporta i movimenti in CSV")
+    esporta.add_argument('file', help="file di destinazione (.csv o .csv.gz)")
+    esporta.add_argument('--dal', help="data iniziale AAAA-MM-GG (inclusa)")
+    esporta.add_argument('--al', help="data finale AAAA-MM-GG (inclusa)")
+    esporta.add_argument('--magazzino', action='append', choices=['Carne', 'Ortofrutta', 'Freschi', 'Secchi'],
+                         help="solo questo magazzino (ripetibile)")
+    esporta.add_argument('--articolo', action='append', choices=['Roll', 'Griglia', 'Cassetta CPR'],
+                         help="solo questo articolo (ripetibile)")
+    esporta.add_argument('--gzip', action='store_true', help="comprime l'output (implicito con estensione .gz)")
+    esporta.add_argument('--silenzioso', action='store_true', help="non mostra l'avanzamento")
+    esporta.set_defaults(esegui=cli_esporta)
+
+    importa = comandi.add_parser('importa', help="importa movimenti da un CSV nel formato di 'esporta'")
+    importa.add_argument('file', help="file CSV da importare (.csv o .csv.gz)")
+    importa.add_argument('--silenzioso', action='store_true', help="non mostra l'avanzamento")
+    importa.set_defaults(esegui=cli_importa)
+
+    saldo = comandi.add_parser('saldo', help="saldo per magazzino e articolo, anche a una data passata")
+    saldo.add_argument('--al', help="data AAAA-MM-GG (predefinito: oggi)")
+    saldo.add_argument('--chiudi', action='store_true', help="registra anche una chiusura di saldo a quella data")
+    saldo.set_defaults(esegui=cli_saldo)
+
+    compatta = comandi.add_parser('compatta', help="converte i movimenti nel formato compatto (più piccolo e veloce)")
+    compatta.set_defaults(esegui=cli_compatta)
+
+    archivia = comandi.add_parser('archivia', help="sposta un anno concluso in un file di archivio a parte")
+    archivia.add_argument('anno', type=int, nargs='?', help="anno da archiviare (predefinito: il più vecchio)")
+    archivia.set_defaults(esegui=cli_archivia)
+
+    riconcilia = comandi.add_parser('riconcilia', help="confronta un estratto cauzioni del CEDI con Freschi/Secchi")
+    riconcilia.add_argument('file', help="estratto CEDI in CSV (.csv o .csv.gz)")
+    riconcilia.add_argument('--csv', help="scrive anche le differenze in questo file CSV")
+    riconcilia.add_argument('--silenzioso', action='store_true', help="non mostra l'avanzamento")
+    riconcilia.set_defaults(esegui=cli_riconcilia)
+
+    backup = comandi.add_parser('backup', help="copia del database nella cartella dei backup, anche a programma aperto")
+    backup.add_argument('--cartella', help="cartella di destinazione (predefinita: backup accanto al database)")
+    backup.add_argument('--se-scaduto', action='store_true',
+                        help="copia con rotazione automatica, solo se l'ultimo backup è più vecchio di un giorno")
+    backup.add_argument('--silenzioso', action='store_true', help="non mostra l'avanzamento")
+    backup.set_defaults(esegui=cli_backup)
+
+    args = parser.parse_args(argv)
+    configura_log()
+    try:
+        return args.esegui(args)
+    except RuntimeError as e:  # es. apri_database() che rifiuta un file in WAL su una cartella di rete
+        print(e, file=sys.stderr)
+        return 1
+
+if __name__ == '__main__' and len(sys.argv) > 1:
+    sys.exit(main_cli(sys.argv[1:]))
+
 # ────────────────────────────────────────────────
 # INTERFACCIA GRAFICA
 # ────────────────────────────────────────────────
 
+from tkcalendar import DateEntry
+
 root = tk.Tk()
 root.title("Gestione Roll / Griglie / CPR")
 root.geometry("1000x600")
 root.resizable(False, False)
 
+class TreeviewContato(ttk.Treeview):
+    """Treeview che conta le righe inserite, per la diagnostica dei tempi delle viste."""
+    righe_inserite = 0
+
+    def insert(self, *args, **kwargs):
+        TreeviewContato.righe_inserite += 1
+        return super().insert(*args, **kwargs)
+
 notebook = ttk.Notebook(root)
 notebook.pack(pady=8, padx=8, fill="both", expand=True)
 
@@ -456,17 +1701,76 @@ tk.Button(btn_frame, text="REGISTRA", command=registra_movimenti,
 tk.Button(btn_frame, text="ANNULLA ULTIMO", command=annulla_ultimo,
           bg="#F44336", fg="white", font=("Arial", 10, "bold"), width=16).pack(side="left", padx=20)
 
-
-
-
+# Lotto: i movimenti si accumulano in coda e si registrano insieme
+frame_lotto = tk.LabelFrame(frame_reg, text=" Lotto ", padx=12, pady=6)
+frame_lotto.pack(padx=10, pady=(0, 10), fill="both", expand=True)
+
+tk.Label(frame_lotto, text="Invio aggiunge alla coda · Canc toglie · doppio clic o Invio sulla riga la modifica · "
+                           "Ctrl+Invio registra il lotto · F1–F4 magazzino · F5/F6 entrata/uscita",
+         font=("Arial", 9), fg="#555555").pack(anchor="w")
+
+tree_lotto = TreeviewContato(frame_lotto, columns=('Data', 'Magazzino', 'Movimento', 'Roll', 'Griglia', 'CPR'),
+                          show='headings', height=5)
+for colonna, larghezza in [('Data', 100), ('Magazzino', 120), ('Movimento', 100),
+                           ('Roll', 70), ('Griglia', 70), ('CPR', 70)]:
+    tree_lotto.heading(colonna, text=colonna)
+    tree_lotto.column(colonna, width=larghezza, anchor='center')
+tree_lotto.pack(side="left", fill="both", expand=True, pady=4)
+
+lotto_btn_frame = tk.Frame(frame_lotto)
+lotto_btn_frame.pack(side="left", fill="y", padx=(10, 0))
+stato_lotto = tk.Label(lotto_btn_frame, text="Coda vuota", font=("Arial", 9))
+stato_lotto.pack(pady=(4, 8))
+tk.Button(lotto_btn_frame, text="REGISTRA LOTTO", command=registra_lotto,
+          bg="#4CAF50", fg="white", font=("Arial", 10, "bold"), width=16).pack(pady=2)
+tk.Button(lotto_btn_frame, text="Svuota coda", command=svuota_lotto, width=16).pack(pady=2)
+
+for campo in (roll_entry, griglia_entry, cpr_entry, magazzino_combo):
+    campo.bind('<Return>', aggiungi_al_lotto)
+    campo.bind('<KP_Enter>', aggiungi_al_lotto)
+tree_lotto.bind('<Delete>', togli_dal_lotto)
+tree_lotto.bind('<Return>', modifica_riga_lotto)
+tree_lotto.bind('<Double-1>', modifica_riga_lotto)
+root.bind('<Control-Return>', registra_lotto)
+root.bind('<Control-KP_Enter>', registra_lotto)
+for tasto, magazzino in [('<F1>', 'Carne'), ('<F2>', 'Ortofrutta'), ('<F3>', 'Freschi'), ('<F4>', 'Secchi')]:
+    root.bind(tasto, lambda e, m=magazzino: seleziona_magazzino(m))
+root.bind('<F5>', lambda e: seleziona_direzione('ENTRATA'))
+root.bind('<F6>', lambda e: seleziona_direzione('USCITA'))
+root.protocol("WM_DELETE_WINDOW", chiudi_finestra)
 
 # ── Tab Storico ─────────────────────────────────
 frame_sto = tk.Frame(notebook)
 notebook.add(frame_sto, text="Storico")
 
-tk.Label(frame_sto, text="Storico movimenti", font=("Arial", 11, "bold")).pack(pady=8)
-
-tree_storico = ttk.Treeview(frame_sto,columns=('Icona', 'Data', 'Tipo', 'Qtà', 'Dettaglio'),show='tree headings',height=18)
+tk.Label(frame_sto, text="Storico movimenti", font=("Arial", 11, "bold")).pack(pady=(8, 2))
+
+# Barra dei filtri: ogni modifica riparte l'attesa, la query parte a battitura finita
+filtro_frame = tk.Frame(frame_sto)
+filtro_frame.pack(fill="x", padx=10)
+filtro_dal_var, filtro_al_var = tk.StringVar(), tk.StringVar()
+filtro_mag_var, filtro_art_var, filtro_dir_var = tk.StringVar(value='Tutti'), tk.StringVar(value='Tutti'), tk.StringVar(value='Tutte')
+filtro_min_var, filtro_max_var = tk.StringVar(), tk.StringVar()
+for testo, widget in [
+        ("Dal", tk.Entry(filtro_frame, textvariable=filtro_dal_var, width=11)),
+        ("Al", tk.Entry(filtro_frame, textvariable=filtro_al_var, width=11)),
+        ("Magazzino", ttk.Combobox(filtro_frame, textvariable=filtro_mag_var, state="readonly", width=10,
+                                   values=['Tutti', 'Carne', 'Ortofrutta', 'Freschi', 'Secchi'])),
+        ("Articolo", ttk.Combobox(filtro_frame, textvariable=filtro_art_var, state="readonly", width=12,
+                                  values=['Tutti', 'Roll', 'Griglia', 'Cassetta CPR'])),
+        ("Direzione", ttk.Combobox(filtro_frame, textvariable=filtro_dir_var, state="readonly", width=9,
+                                   values=['Tutte', 'ENTRATA', 'USCITA'])),
+        ("Qtà da", tk.Entry(filtro_frame, textvariable=filtro_min_var, width=5)),
+        ("a", tk.Entry(filtro_frame, textvariable=filtro_max_var, width=5))]:
+    tk.Label(filtro_frame, text=testo, font=("Arial", 9)).pack(side="left", padx=(6, 2))
+    widget.pack(side="left")
+for var in (filtro_dal_var, filtro_al_var, filtro_mag_var, filtro_art_var, filtro_dir_var, filtro_min_var, filtro_max_var):
+    var.trace_add('write', filtro_modificato)
+tk.Button(filtro_frame, text="Pulisci", command=pulisci_filtro_storico, font=("Arial", 9)).pack(side="left", padx=8)
+totale_filtro_label = tk.Label(frame_sto, text="", font=("Arial", 9, "bold"), fg="#1565C0")
+totale_filtro_label.pack(anchor="w", padx=10)
+
+tree_storico = TreeviewContato(frame_sto,columns=('Icona', 'Data', 'Tipo', 'Qtà', 'Dettaglio'),show='tree headings',height=18)
 
 tree_storico.heading('#0', text='')          # colonna tree (per indentazione figli)
 tree_storico.heading('Icona', text='')
@@ -482,7 +1786,10 @@ tree_storico.column('Tipo', width=300)
 tree_storico.column('Qtà', width=80, anchor='center')
 tree_storico.column('Dettaglio', width=100)
 
-tree_storico.pack(padx=10, pady=5, fill="both", expand=True)
+scrollbar_storico = ttk.Scrollbar(frame_sto, orient="vertical", command=tree_storico.yview)
+tree_storico.configure(yscrollcommand=scorri_storico)
+scrollbar_storico.pack(side="right", fill="y", padx=(0, 10), pady=5)
+tree_storico.pack(padx=(10, 0), pady=5, fill="both", expand=True)
 # Bind doppio click
 tree_storico.bind("<Double-1>", toggle_giorno)
 
@@ -499,51 +1806,81 @@ notebook.add(frame_rep, text="Report Giornaliero")
 frame_rep_top = tk.Frame(frame_rep)
 frame_rep_top.pack(pady=8)
 
-tk.Label(frame_rep_top, text="Data:", font=("Arial", 10)).pack(side="left", padx=5)
+tk.Label(frame_rep_top, text="Dal:", font=("Arial", 10)).pack(side="left", padx=5)
 calendario_report = DateEntry(frame_rep_top, width=13, background='darkblue', foreground='white', borderwidth=2,
                               date_pattern='yyyy-mm-dd', font=("Arial", 10))
 calendario_report.pack(side="left", padx=5)
 calendario_report.set_date(date.today())
 
+tk.Label(frame_rep_top, text="Al:", font=("Arial", 10)).pack(side="left", padx=5)
+calendario_report_al = DateEntry(frame_rep_top, width=13, background='darkblue', foreground='white', borderwidth=2,
+                                 date_pattern='yyyy-mm-dd', font=("Arial", 10))
+calendario_report_al.pack(side="left", padx=5)
+calendario_report_al.set_date(date.today())
+
 tk.Button(frame_rep_top, text="Genera", command=genera_report,
           bg="#2196F3", fg="white", font=("Arial", 10, "bold")).pack(side="left", padx=10)
-
-tree_report = ttk.Treeview(frame_rep, columns=('Data','Magazzino','Articolo','Entrate','Uscite'), show='headings', height=18)
+tk.Button(frame_rep_top, text="◀", command=lambda: sposta_periodo_report(-1),
+          font=("Arial", 9)).pack(side="left", padx=2)
+tk.Button(frame_rep_top, text="▶", command=lambda: sposta_periodo_report(1),
+          font=("Arial", 9)).pack(side="left", padx=(2, 10))
+calendario_report.bind('<<DateEntrySelected>>', lambda e: genera_report())
+calendario_report_al.bind('<<DateEntrySelected>>', lambda e: genera_report())
+
+for testo, periodo in [("Giorno", 'giorno'), ("Settimana", 'settimana'), ("Mese", 'mese')]:
+    tk.Button(frame_rep_top, text=testo, command=lambda p=periodo: imposta_periodo_report(p),
+              font=("Arial", 9)).pack(side="left", padx=2)
+
+tree_report = TreeviewContato(frame_rep, columns=('Data','Magazzino','Articolo','Entrate','Uscite','Saldo'), show='tree headings', height=18)
+tree_report.heading('#0', text='')
 tree_report.heading('Data', text='Data')
 tree_report.heading('Magazzino', text='Magazzino')
 tree_report.heading('Articolo', text='Articolo')
 tree_report.heading('Entrate', text='Entrate')
 tree_report.heading('Uscite', text='Uscite')
-tree_report.column('Data', width=90)
+tree_report.heading('Saldo', text='Saldo')
+tree_report.column('#0', width=30)
+tree_report.column('Data', width=170)
 tree_report.column('Magazzino', width=140)
 tree_report.column('Articolo', width=140)
 tree_report.column('Entrate', width=90, anchor='center')
 tree_report.column('Uscite', width=90, anchor='center')
+tree_report.column('Saldo', width=90, anchor='center')
+tree_report.tag_configure('giorno', font=('Arial', 10, 'bold'), background='#e8f4ff')
+tree_report.tag_configure('totale', font=('Arial', 10, 'bold'), background='#e6ffe6')
+tree_report.tag_configure('positivo', foreground='green')
+tree_report.tag_configure('negativo', foreground='red')
 tree_report.pack(padx=10, pady=5, fill="both", expand=True)
 
 # ── Tab Cauzioni Carne/Ortofrutta ───────────────
 frame_cauzioni = tk.Frame(notebook)
 notebook.add(frame_cauzioni, text="Cauzioni C/O")
 
-tk.Label(frame_cauzioni, text="Valore entrate Carne e Ortofrutta (cauzioni)", font=("Arial", 11, "bold")).pack(pady=8)
+tk.Label(frame_cauzioni, text="Valore entrate Carne e Ortofrutta (cauzioni)", font=("Arial", 11, "bold")).pack(pady=(8, 0))
+totale_label_cauzioni = tk.Label(frame_cauzioni, text="", font=("Arial", 10, "bold"), fg="#2E7D32")
+totale_label_cauzioni.pack()
+tk.Button(frame_cauzioni, text="Prezzi cauzioni…", command=mostra_prezzi, font=("Arial", 9)).pack(pady=(2, 0))
 
-tree_cauzioni = ttk.Treeview(frame_cauzioni, columns=('Data', 'Roll', 'Griglia', 'Cassetta CPR', 'Valore Giorno €'),show='headings', height=18)
+tree_cauzioni = TreeviewContato(frame_cauzioni, columns=('Data', 'Roll', 'Griglia', 'Cassetta CPR', 'Valore Giorno €', 'Cumulato €'),show='headings', height=18)
 
 tree_cauzioni.heading('Data', text='Data')
 tree_cauzioni.heading('Roll', text='Roll')
 tree_cauzioni.heading('Griglia', text='Griglia')
 tree_cauzioni.heading('Cassetta CPR', text='Cassetta CPR')
 tree_cauzioni.heading('Valore Giorno €', text='Valore Giorno €')
+tree_cauzioni.heading('Cumulato €', text='Cumulato €')
 
 tree_cauzioni.column('Data', width=100, anchor='center')
 tree_cauzioni.column('Roll', width=140)
 tree_cauzioni.column('Griglia', width=140)
 tree_cauzioni.column('Cassetta CPR', width=140)
-tree_cauzioni.column('Valore Giorno €', width=140, anchor='center')
-
-tree_cauzioni.tag_configure('totale', font=('Arial', 10, 'bold'), background='#e6ffe6')
+tree_cauzioni.column('Valore Giorno €', width=120, anchor='center')
+tree_cauzioni.column('Cumulato €', width=120, anchor='center')
 
-tree_cauzioni.pack(padx=10, pady=5, fill="both", expand=True)
+scrollbar_cauzioni = ttk.Scrollbar(frame_cauzioni, orient="vertical", command=tree_cauzioni.yview)
+tree_cauzioni.configure(yscrollcommand=lambda primo, ultimo: scorri_valori('cauzioni', scrollbar_cauzioni, primo, ultimo))
+scrollbar_cauzioni.pack(side="right", fill="y", padx=(0, 10), pady=5)
+tree_cauzioni.pack(padx=(10, 0), pady=5, fill="both", expand=True)
 
 
 # ── Tab Calcolo Cauzioni e Resi da CEDI ─────────
@@ -551,10 +1888,17 @@ frame_resi = tk.Frame(notebook)
 notebook.add(frame_resi, text="Cauzioni e Resi CEDI")
 
 tk.Label(frame_resi, text="Cauzioni e Resi – Freschi e Secchi", 
-         font=("Arial", 11, "bold")).pack(pady=8)
-
-tree_cauzioni_resi = ttk.Treeview(frame_resi, 
-                                  columns=('Data', 'Roll', 'Griglia', 'Cassetta CPR', 'Valore Giorno €'),
+         font=("Arial", 11, "bold")).pack(pady=(8, 0))
+totale_label_resi = tk.Label(frame_resi, text="", font=("Arial", 10, "bold"), fg="#2E7D32")
+totale_label_resi.pack()
+frame_resi_comandi = tk.Frame(frame_resi)
+frame_resi_comandi.pack(pady=(2, 0))
+tk.Button(frame_resi_comandi, text="Prezzi cauzioni…", command=mostra_prezzi, font=("Arial", 9)).pack(side="left", padx=4)
+tk.Button(frame_resi_comandi, text="Riconcilia estratto CEDI…", command=riconcilia_estratto_cedi,
+          font=("Arial", 9)).pack(side="left", padx=4)
+
+tree_cauzioni_resi = TreeviewContato(frame_resi, 
+                                  columns=('Data', 'Roll', 'Griglia', 'Cassetta CPR', 'Valore Giorno €', 'Cumulato €'),
                                   show='headings', height=18)
 
 tree_cauzioni_resi.heading('Data', text='Data')
@@ -562,34 +1906,119 @@ tree_cauzioni_resi.heading('Roll', text='Roll')
 tree_cauzioni_resi.heading('Griglia', text='Griglia')
 tree_cauzioni_resi.heading('Cassetta CPR', text='Cassetta CPR')
 tree_cauzioni_resi.heading('Valore Giorno €', text='Valore Giorno €')
+tree_cauzioni_resi.heading('Cumulato €', text='Cumulato €')
 
 tree_cauzioni_resi.column('Data', width=100, anchor='center')
-tree_cauzioni_resi.column('Roll', width=180)
-tree_cauzioni_resi.column('Griglia', width=180)
-tree_cauzioni_resi.column('Cassetta CPR', width=180)
-tree_cauzioni_resi.column('Valore Giorno €', width=140, anchor='center')
+tree_cauzioni_resi.column('Roll', width=160)
+tree_cauzioni_resi.column('Griglia', width=160)
+tree_cauzioni_resi.column('Cassetta CPR', width=160)
+tree_cauzioni_resi.column('Valore Giorno €', width=110, anchor='center')
+tree_cauzioni_resi.column('Cumulato €', width=110, anchor='center')
 
 tree_cauzioni_resi.tag_configure('positivo', foreground='green')
 tree_cauzioni_resi.tag_configure('negativo', foreground='red')
-tree_cauzioni_resi.tag_configure('totale', font=('Arial', 10, 'bold'), background='#e6ffe6')
 
-tree_cauzioni_resi.pack(padx=10, pady=5, fill="both", expand=True)
+scrollbar_resi = ttk.Scrollbar(frame_resi, orient="vertical", command=tree_cauzioni_resi.yview)
+tree_cauzioni_resi.configure(yscrollcommand=lambda primo, ultimo: scorri_valori('resi', scrollbar_resi, primo, ultimo))
+scrollbar_resi.pack(side="right", fill="y", padx=(0, 10), pady=5)
+tree_cauzioni_resi.pack(padx=(10, 0), pady=5, fill="both", expand=True)
+
+# ── Tab Andamento ───────────────────────────────
+frame_and = tk.Frame(notebook)
+notebook.add(frame_and, text="Andamento")
+
+frame_and_top = tk.Frame(frame_and)
+frame_and_top.pack(pady=6)
+tk.Label(frame_and_top, text="Dal:", font=("Arial", 10)).pack(side="left", padx=5)
+andamento_dal = DateEntry(frame_and_top, width=12, date_pattern='yyyy-mm-dd', font=("Arial", 10))
+andamento_dal.pack(side="left")
+andamento_dal.set_date(date.today() - timedelta(days=365))
+tk.Label(frame_and_top, text="Al:", font=("Arial", 10)).pack(side="left", padx=5)
+andamento_al = DateEntry(frame_and_top, width=12, date_pattern='yyyy-mm-dd', font=("Arial", 10))
+andamento_al.pack(side="left")
+tk.Label(frame_and_top, text="Magazzino:", font=("Arial", 10)).pack(side="left", padx=(12, 5))
+andamento_mag_var = tk.StringVar(value='Tutti')
+ttk.Combobox(frame_and_top, textvariable=andamento_mag_var, state="readonly", width=11,
+             values=['Tutti', 'Carne', 'Ortofrutta', 'Freschi', 'Secchi']).pack(side="left")
+tk.Label(frame_and_top, text="Finestra (giorni):", font=("Arial", 10)).pack(side="left", padx=(12, 5))
+andamento_finestra_var = tk.StringVar(value='30')
+ttk.Combobox(frame_and_top, textvariable=andamento_finestra_var, state="readonly", width=4,
+             values=['7', '30', '90']).pack(side="left")
+tk.Button(frame_and_top, text="Aggiorna", command=aggiorna_andamento,
+          bg="#2196F3", fg="white", font=("Arial", 10, "bold")).pack(side="left", padx=10)
+for widget in (andamento_dal, andamento_al):
+    widget.bind('<<DateEntrySelected>>', lambda e: aggiorna_andamento())
+for var in (andamento_mag_var, andamento_finestra_var):
+    var.trace_add('write', lambda *args: aggiorna_andamento())
+
+canvas_andamento = tk.Canvas(frame_and, height=270, bg='white', highlightthickness=0)
+canvas_andamento.pack(fill="x", padx=10)
+
+tree_andamento = TreeviewContato(frame_and, columns=('Magazzino', 'Articolo', 'Saldo', 'Variazione', 'Media'),
+                                 show='headings', height=4)
+for colonna, testo in [('Magazzino', 'Magazzino'), ('Articolo', 'Articolo'), ('Saldo', 'Saldo finale'),
+                       ('Variazione', 'Variazione nella finestra'), ('Media', 'Media mobile')]:
+    tree_andamento.heading(colonna, text=testo)
+    tree_andamento.column(colonna, width=150, anchor='center')
+tree_andamento.tag_configure('positivo', foreground='green')
+tree_andamento.tag_configure('negativo', foreground='red')
+scrollbar_andamento = ttk.Scrollbar(frame_and, orient="vertical", command=tree_andamento.yview)
+tree_andamento.configure(yscrollcommand=scrollbar_andamento.set)
+scrollbar_andamento.pack(side="right", fill="y", padx=(0, 10), pady=5)
+tree_andamento.pack(padx=(10, 0), pady=5, fill="both", expand=True)
+
 # Esporta globale
 bottom_frame = tk.Frame(root)
 bottom_frame.pack(pady=10, fill='x')
 
-tk.Button(bottom_frame, text="Esporta tutto in CSV", command=esporta_csv,
+tk.Button(bottom_frame, text="Esporta in CSV…", command=esporta_csv,
           bg="#2196F3", fg="white", font=("Arial", 10, "bold")).pack(side="left", padx=20)
 
+tk.Button(bottom_frame, text="Importa da CSV…", command=importa_csv,
+          bg="#2196F3", fg="white", font=("Arial", 10, "bold")).pack(side="left", padx=5)
+
+tk.Button(bottom_frame, text="Ricostruisci riepilogo", command=ricostruisci_riepilogo_e_aggiorna,
+          font=("Arial", 10)).pack(side="left", padx=5)
+
+tk.Button(bottom_frame, text="Archivia anno…", command=archivia_anno_vecchio,
+          font=("Arial", 10)).pack(side="left", padx=5)
+
+btn_backup = tk.Button(bottom_frame, text="Backup", command=backup_manuale, font=("Arial", 10))
+btn_backup.pack(side="left", padx=5)
+
+tk.Button(bottom_frame, text="Diagnostica", command=mostra_diagnostica,
+          font=("Arial", 10)).pack(side="left", padx=5)
+root.bind('<F12>', mostra_diagnostica)
+
 tk.Button(bottom_frame, text="AZZERA DATABASE (ATTENZIONE!)", command=azzera_database,
           bg="#F44336", fg="white", font=("Arial", 10, "bold")).pack(side="right", padx=20)
 
 # Avvio
+configura_log()
+try:
+    apri_database(DB_PATH).close()
+except (RuntimeError, sqlite3.Error) as e:
+    messagebox.showerror("Database non aperto", str(e))
+    sys.exit(1)
+db = LavoratoreDB(DB_PATH, in_errore=errore_db, conta_righe=lambda: TreeviewContato.righe_inserite)
+db.start()
+lavori_lunghi = LavoratoreDB(DB_PATH, in_errore=errore_db,  # esportazioni: non bloccano le registrazioni
+                             conta_righe=lambda: TreeviewContato.righe_inserite)
+lavori_lunghi.start()
+controlla_risultati_db()
+db.invia(chiudi_mesi)  # chiusure di saldo dei mesi conclusi dall'ultimo avvio
+db.invia(pota_registro_modifiche)
+controlla_backup()
+controlla_modifiche()
 ##aggiorna_inventario()
-aggiorna_storico()
-genera_report()
 aggiorna_direzione()  # stato iniziale
-aggiorna_valore_cauzioniOFC()
-aggiorna_cauzioni_resi()
+# le viste si caricano alla prima apertura della loro scheda
+viste_per_scheda = {str(frame_sto): 'storico', str(frame_rep): 'report',
+                    str(frame_cauzioni): 'cauzioni', str(frame_resi): 'resi', str(frame_and): 'andamento'}
+AGGIORNA_VISTA = {'storico': aggiorna_storico, 'report': genera_report,
+                  'cauzioni': aggiorna_valore_cauzioniOFC, 'resi': aggiorna_cauzioni_resi,
+                  'andamento': aggiorna_andamento}
+notebook.bind('<<NotebookTabChanged>>', scheda_cambiata)
 root.mainloop()
-conn.close()
+db.ferma()
+lavori_lunghi.ferma()
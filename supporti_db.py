@@ -0,0 +1,2113 @@
+"""Accesso al database dei supporti (Roll / Griglie / CPR), senza dipendenze da Tk.
+
+Schema e migrazioni, il lavoratore in background e tutte le query usate
+dall'interfaccia, dalla riga di comando e dai benchmark.
+"""
+import sqlite3
+import bisect
+import csv
+import gzip
+import threading
+import functools
+import itertools
+import operator
+import queue
+import time
+import contextlib
+import logging
+import logging.handlers
+import os
+import pathlib
+from datetime import date, timedelta
+
+try:
+    import numpy as np  # facoltativo: rende vettoriali i calcoli dell'andamento
+except ImportError:
+    np = None
+
+# ────────────────────────────────────────────────
+# SCHEMA DATABASE E MIGRAZIONI
+# ────────────────────────────────────────────────
+# Ogni voce di MIGRAZIONI porta lo schema dalla versione N alla N+1 (PRAGMA user_version).
+# Le voci si aggiungono solo in coda: quelle già distribuite non vanno mai modificate.
+
+MIGRAZIONI = [
+    # 1 – tabella movimenti (già presente nei database creati prima delle migrazioni)
+    '''
+    CREATE TABLE IF NOT EXISTS movimenti (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT,
+        articolo TEXT,
+        direzione TEXT,
+        magazzino TEXT,
+        quantita INTEGER
+    );
+    ''',
+
+    # 2 – riepilogo giornaliero materializzato, una riga per (data, magazzino, articolo, direzione),
+    #     mantenuto allineato a movimenti dai trigger così le viste non devono riaggregare tutto
+    '''
+    CREATE TABLE IF NOT EXISTS riepilogo_giornaliero (
+        data TEXT NOT NULL,
+        magazzino TEXT NOT NULL,
+        articolo TEXT NOT NULL,
+        direzione TEXT NOT NULL,
+        quantita INTEGER NOT NULL DEFAULT 0,
+        num_movimenti INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (data, magazzino, articolo, direzione)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS riepilogo_dopo_insert AFTER INSERT ON movimenti
+    BEGIN
+        INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+        VALUES (NEW.data, NEW.magazzino, NEW.articolo, NEW.direzione, NEW.quantita, 1)
+        ON CONFLICT (data, magazzino, articolo, direzione) DO UPDATE
+            SET quantita = quantita + excluded.quantita,
+                num_movimenti = num_movimenti + 1;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS riepilogo_dopo_delete AFTER DELETE ON movimenti
+    BEGIN
+        UPDATE riepilogo_giornaliero
+           SET quantita = quantita - OLD.quantita,
+               num_movimenti = num_movimenti - 1
+         WHERE data = OLD.data AND magazzino = OLD.magazzino
+           AND articolo = OLD.articolo AND direzione = OLD.direzione;
+        DELETE FROM riepilogo_giornaliero
+         WHERE data = OLD.data AND magazzino = OLD.magazzino
+           AND articolo = OLD.articolo AND direzione = OLD.direzione
+           AND num_movimenti <= 0;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS riepilogo_dopo_update AFTER UPDATE ON movimenti
+    BEGIN
+        UPDATE riepilogo_giornaliero
+           SET quantita = quantita - OLD.quantita,
+               num_movimenti = num_movimenti - 1
+         WHERE data = OLD.data AND magazzino = OLD.magazzino
+           AND articolo = OLD.articolo AND direzione = OLD.direzione;
+        DELETE FROM riepilogo_giornaliero
+         WHERE data = OLD.data AND magazzino = OLD.magazzino
+           AND articolo = OLD.articolo AND direzione = OLD.direzione
+           AND num_movimenti <= 0;
+        INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+        VALUES (NEW.data, NEW.magazzino, NEW.articolo, NEW.direzione, NEW.quantita, 1)
+        ON CONFLICT (data, magazzino, articolo, direzione) DO UPDATE
+            SET quantita = quantita + excluded.quantita,
+                num_movimenti = num_movimenti + 1;
+    END;
+
+    DELETE FROM riepilogo_giornaliero;
+    INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+    SELECT data, magazzino, articolo, direzione, SUM(quantita), COUNT(*)
+    FROM movimenti
+    GROUP BY data, magazzino, articolo, direzione;
+    ''',
+
+    # 3 – indici coprenti sulle forme di query reali: per giorno (dettaglio Storico,
+    #     ricostruzione riepilogo) e per magazzino/articolo (calcola_saldo, filtri magazzino IN (...))
+    '''
+    CREATE INDEX IF NOT EXISTS idx_movimenti_giorno
+        ON movimenti (data, magazzino, articolo, direzione, quantita);
+    CREATE INDEX IF NOT EXISTS idx_movimenti_saldo
+        ON movimenti (magazzino, articolo, direzione, quantita);
+    CREATE INDEX IF NOT EXISTS idx_riepilogo_magazzino
+        ON riepilogo_giornaliero (magazzino, direzione, data, articolo, quantita);
+    ANALYZE;
+    ''',
+
+    # 4 – chiusure di saldo: per ogni data in `chiusure` il saldo di ogni magazzino × articolo
+    #     a fine giornata, così calcola_saldo somma solo i movimenti successivi all'ultima chiusura.
+    #     I trigger correggono le chiusure successive quando si registra, annulla o modifica
+    #     un movimento con data anteriore.
+    '''
+    CREATE TABLE IF NOT EXISTS chiusure (
+        data TEXT PRIMARY KEY
+    );
+
+    CREATE TABLE IF NOT EXISTS saldi_chiusura (
+        data TEXT NOT NULL,
+        magazzino TEXT NOT NULL,
+        articolo TEXT NOT NULL,
+        saldo INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (data, magazzino, articolo)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS chiusure_dopo_insert AFTER INSERT ON movimenti
+    WHEN EXISTS (SELECT 1 FROM chiusure WHERE data >= NEW.data)
+    BEGIN
+        INSERT INTO saldi_chiusura (data, magazzino, articolo, saldo)
+        SELECT data, NEW.magazzino, NEW.articolo,
+               CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END
+        FROM chiusure WHERE data >= NEW.data
+        ON CONFLICT (data, magazzino, articolo) DO UPDATE SET saldo = saldo + excluded.saldo;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS chiusure_dopo_delete AFTER DELETE ON movimenti
+    WHEN EXISTS (SELECT 1 FROM chiusure WHERE data >= OLD.data)
+    BEGIN
+        UPDATE saldi_chiusura
+           SET saldo = saldo - CASE WHEN OLD.direzione = 'ENTRATA' THEN OLD.quantita ELSE -OLD.quantita END
+         WHERE data >= OLD.data AND magazzino = OLD.magazzino AND articolo = OLD.articolo;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS chiusure_dopo_update AFTER UPDATE ON movimenti
+    WHEN EXISTS (SELECT 1 FROM chiusure WHERE data >= MIN(OLD.data, NEW.data))
+    BEGIN
+        UPDATE saldi_chiusura
+           SET saldo = saldo - CASE WHEN OLD.direzione = 'ENTRATA' THEN OLD.quantita ELSE -OLD.quantita END
+         WHERE data >= OLD.data AND magazzino = OLD.magazzino AND articolo = OLD.articolo;
+        INSERT INTO saldi_chiusura (data, magazzino, articolo, saldo)
+        SELECT data, NEW.magazzino, NEW.articolo,
+               CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END
+        FROM chiusure WHERE data >= NEW.data
+        ON CONFLICT (data, magazzino, articolo) DO UPDATE SET saldo = saldo + excluded.saldo;
+    END;
+    ''',
+    # 5 – registro dei giorni modificati, scritto dai trigger sul riepilogo (quindi in entrambi
+    #     i formati di movimenti): ogni postazione rilegge solo i giorni toccati dalle altre
+    '''
+    CREATE TABLE IF NOT EXISTS registro_modifiche (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT NOT NULL
+    );
+
+    CREATE TRIGGER IF NOT EXISTS modifiche_dopo_insert AFTER INSERT ON riepilogo_giornaliero
+    BEGIN
+        INSERT INTO registro_modifiche (data) VALUES (NEW.data);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS modifiche_dopo_update AFTER UPDATE ON riepilogo_giornaliero
+    BEGIN
+        INSERT INTO registro_modifiche (data) VALUES (NEW.data);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS modifiche_dopo_delete AFTER DELETE ON riepilogo_giornaliero
+    BEGIN
+        INSERT INTO registro_modifiche (data) VALUES (OLD.data);
+    END;
+    ''',
+    # 6 – lotti registrati insieme dalla coda di inserimento: l'intervallo di id è contiguo
+    #     perché il lotto entra in un'unica transazione, e l'annullamento toglie tutto il lotto
+    '''
+    CREATE TABLE IF NOT EXISTS lotti (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        primo_id INTEGER NOT NULL,
+        ultimo_id INTEGER NOT NULL,
+        registrato_il TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+    );
+    ''',
+    # 7 – anni archiviati in file a parte (archivia_anno): la chiusura al 31/12 resta come
+    #     saldo riportato, e nei giorni archiviati il riepilogo non accetta più movimenti
+    '''
+    CREATE TABLE IF NOT EXISTS riporti (
+        data TEXT PRIMARY KEY,           -- ultimo giorno archiviato, sempre un 31/12
+        anno INTEGER NOT NULL UNIQUE,
+        archivio TEXT NOT NULL           -- nome del file, nella stessa cartella del database
+    );
+
+    CREATE TRIGGER IF NOT EXISTS riepilogo_periodo_archiviato BEFORE INSERT ON riepilogo_giornaliero
+    WHEN NEW.data <= (SELECT MAX(data) FROM riporti)
+    BEGIN
+        SELECT RAISE(ABORT, 'periodo archiviato: non si registrano movimenti in un anno già archiviato');
+    END;
+    ''',
+    # 8 – prezzi delle cauzioni con data di decorrenza: un nuovo prezzo vale dal giorno
+    #     indicato in poi, i giorni precedenti restano valutati al prezzo di allora
+    '''
+    CREATE TABLE IF NOT EXISTS prezzi_cauzione (
+        articolo TEXT NOT NULL,
+        dal TEXT NOT NULL,
+        prezzo REAL NOT NULL CHECK (prezzo >= 0),
+        PRIMARY KEY (articolo, dal)
+    ) WITHOUT ROWID;
+
+    INSERT OR IGNORE INTO prezzi_cauzione (articolo, dal, prezzo) VALUES
+        ('Roll', '0000-01-01', 52), ('Griglia', '0000-01-01', 8), ('Cassetta CPR', '0000-01-01', 4);
+    ''',
+]
+
+def applica_migrazioni(conn, percorso=None):
+    """Porta il database all'ultima versione dello schema, una migrazione per transazione.
+
+    Se il file contiene già dati, prima di modificarlo ne salva una copia accanto
+    (es. supporti.db.v0.bak): un aggiornamento fallito non tocca mai l'originale.
+    """
+    versione = conn.execute('PRAGMA user_version').fetchone()[0]
+    if versione > len(MIGRAZIONI):
+        raise RuntimeError(f"Il database è alla versione {versione}, più recente di questo programma "
+                           f"(versione {len(MIGRAZIONI)}). Aggiorna il programma.")
+    if versione == len(MIGRAZIONI):
+        return
+
+    ha_tabelle = conn.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table')").fetchone()[0]
+    if percorso and ha_tabelle:
+        copia = sqlite3.connect(f'{percorso}.v{versione}.bak')
+        conn.backup(copia)
+        copia.close()
+
+    for numero in range(versione + 1, len(MIGRAZIONI) + 1):
+        try:
+            conn.executescript(f'BEGIN;\n{MIGRAZIONI[numero - 1]}\nPRAGMA user_version = {numero};\nCOMMIT;')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+# Formato compatto facoltativo (converti_in_compatto): il giorno come numero intero
+# (giorni dal 1970-01-01), articolo e magazzino come codici delle tabelle di decodifica,
+# la direzione nel segno della quantità. Il nome `movimenti` resta a una vista con le
+# colonne di sempre: le query e l'esportazione CSV non cambiano, e i trigger INSTEAD OF
+# tengono aggiornati riepilogo e chiusure come fanno i trigger sulla tabella estesa.
+COMPATTAZIONE = '''
+CREATE TABLE articoli (
+    codice INTEGER PRIMARY KEY,
+    nome TEXT NOT NULL UNIQUE
+);
+CREATE TABLE magazzini (
+    codice INTEGER PRIMARY KEY,
+    nome TEXT NOT NULL UNIQUE
+);
+INSERT INTO articoli (codice, nome) VALUES (1, 'Roll'), (2, 'Griglia'), (3, 'Cassetta CPR');
+INSERT INTO magazzini (codice, nome) VALUES (1, 'Carne'), (2, 'Ortofrutta'), (3, 'Freschi'), (4, 'Secchi');
+INSERT OR IGNORE INTO articoli (nome) SELECT DISTINCT articolo FROM movimenti;
+INSERT OR IGNORE INTO magazzini (nome) SELECT DISTINCT magazzino FROM movimenti;
+
+CREATE TABLE movimenti_compatti (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    giorno INTEGER NOT NULL,
+    articolo INTEGER NOT NULL REFERENCES articoli (codice),
+    magazzino INTEGER NOT NULL REFERENCES magazzini (codice),
+    quantita INTEGER NOT NULL
+);
+INSERT INTO movimenti_compatti (id, giorno, articolo, magazzino, quantita)
+SELECT mv.id, CAST(julianday(mv.data) - 2440587.5 AS INTEGER), a.codice, m.codice,
+       CASE WHEN mv.direzione = 'ENTRATA' THEN mv.quantita ELSE -mv.quantita END
+FROM movimenti mv
+JOIN articoli a ON a.nome = mv.articolo
+JOIN magazzini m ON m.nome = mv.magazzino
+ORDER BY mv.id;
+DELETE FROM sqlite_sequence WHERE name = 'movimenti_compatti';
+INSERT INTO sqlite_sequence (name, seq) SELECT 'movimenti_compatti', seq FROM sqlite_sequence WHERE name = 'movimenti';
+DROP TABLE movimenti;
+
+-- stessa espressione della vista: le ricerche per data (dettaglio giorno, esportazione) la usano
+CREATE INDEX idx_compatti_data ON movimenti_compatti (date(giorno * 86400, 'unixepoch'));
+
+CREATE VIEW movimenti AS
+SELECT c.id,
+       date(c.giorno * 86400, 'unixepoch') AS data,
+       a.nome AS articolo,
+       CASE WHEN c.quantita >= 0 THEN 'ENTRATA' ELSE 'USCITA' END AS direzione,
+       m.nome AS magazzino,
+       abs(c.quantita) AS quantita
+FROM movimenti_compatti c
+JOIN articoli a ON a.codice = c.articolo
+JOIN magazzini m ON m.codice = c.magazzino;
+
+CREATE TRIGGER movimenti_insert INSTEAD OF INSERT ON movimenti
+BEGIN
+    INSERT OR IGNORE INTO articoli (nome) VALUES (NEW.articolo);
+    INSERT OR IGNORE INTO magazzini (nome) VALUES (NEW.magazzino);
+    INSERT INTO movimenti_compatti (id, giorno, articolo, magazzino, quantita)
+    VALUES (NEW.id, CAST(julianday(NEW.data) - 2440587.5 AS INTEGER),
+            (SELECT codice FROM articoli WHERE nome = NEW.articolo),
+            (SELECT codice FROM magazzini WHERE nome = NEW.magazzino),
+            CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END);
+
+    INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+    VALUES (NEW.data, NEW.magazzino, NEW.articolo, NEW.direzione, NEW.quantita, 1)
+    ON CONFLICT (data, magazzino, articolo, direzione) DO UPDATE
+        SET quantita = quantita + excluded.quantita,
+            num_movimenti = num_movimenti + 1;
+
+    INSERT INTO saldi_chiusura (data, magazzino, articolo, saldo)
+    SELECT data, NEW.magazzino, NEW.articolo,
+           CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END
+    FROM chiusure WHERE data >= NEW.data
+    ON CONFLICT (data, magazzino, articolo) DO UPDATE SET saldo = saldo + excluded.saldo;
+END;
+
+CREATE TRIGGER movimenti_delete INSTEAD OF DELETE ON movimenti
+BEGIN
+    DELETE FROM movimenti_compatti WHERE id = OLD.id;
+
+    UPDATE riepilogo_giornaliero
+       SET quantita = quantita - OLD.quantita,
+           num_movimenti = num_movimenti - 1
+     WHERE data = OLD.data AND magazzino = OLD.magazzino
+       AND articolo = OLD.articolo AND direzione = OLD.direzione;
+    DELETE FROM riepilogo_giornaliero
+     WHERE data = OLD.data AND magazzino = OLD.magazzino
+       AND articolo = OLD.articolo AND direzione = OLD.direzione
+       AND num_movimenti <= 0;
+
+    UPDATE saldi_chiusura
+       SET saldo = saldo - CASE WHEN OLD.direzione = 'ENTRATA' THEN OLD.quantita ELSE -OLD.quantita END
+     WHERE data >= OLD.data AND magazzino = OLD.magazzino AND articolo = OLD.articolo;
+END;
+
+CREATE TRIGGER movimenti_update INSTEAD OF UPDATE ON movimenti
+BEGIN
+    INSERT OR IGNORE INTO articoli (nome) VALUES (NEW.articolo);
+    INSERT OR IGNORE INTO magazzini (nome) VALUES (NEW.magazzino);
+    UPDATE movimenti_compatti
+       SET id = NEW.id,
+           giorno = CAST(julianday(NEW.data) - 2440587.5 AS INTEGER),
+           articolo = (SELECT codice FROM articoli WHERE nome = NEW.articolo),
+           magazzino = (SELECT codice FROM magazzini WHERE nome = NEW.magazzino),
+           quantita = CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END
+     WHERE id = OLD.id;
+
+    UPDATE riepilogo_giornaliero
+       SET quantita = quantita - OLD.quantita,
+           num_movimenti = num_movimenti - 1
+     WHERE data = OLD.data AND magazzino = OLD.magazzino
+       AND articolo = OLD.articolo AND direzione = OLD.direzione;
+    DELETE FROM riepilogo_giornaliero
+     WHERE data = OLD.data AND magazzino = OLD.magazzino
+       AND articolo = OLD.articolo AND direzione = OLD.direzione
+       AND num_movimenti <= 0;
+    INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+    VALUES (NEW.data, NEW.magazzino, NEW.articolo, NEW.direzione, NEW.quantita, 1)
+    ON CONFLICT (data, magazzino, articolo, direzione) DO UPDATE
+        SET quantita = quantita + excluded.quantita,
+            num_movimenti = num_movimenti + 1;
+
+    UPDATE saldi_chiusura
+       SET saldo = saldo - CASE WHEN OLD.direzione = 'ENTRATA' THEN OLD.quantita ELSE -OLD.quantita END
+     WHERE data >= OLD.data AND magazzino = OLD.magazzino AND articolo = OLD.articolo;
+    INSERT INTO saldi_chiusura (data, magazzino, articolo, saldo)
+    SELECT data, NEW.magazzino, NEW.articolo,
+           CASE WHEN NEW.direzione = 'ENTRATA' THEN NEW.quantita ELSE -NEW.quantita END
+    FROM chiusure WHERE data >= NEW.data
+    ON CONFLICT (data, magazzino, articolo) DO UPDATE SET saldo = saldo + excluded.saldo;
+END;
+
+ANALYZE;
+'''
+
+def layout_compatto(conn):
+    """True se `movimenti` è la vista sul formato compatto."""
+    return conn.execute("SELECT type FROM sqlite_master WHERE name = 'movimenti'").fetchone() == ('view',)
+
+def converti_in_compatto(conn, percorso=None):
+    """Porta i movimenti al formato compatto in un'unica transazione, poi compatta il file.
+
+    Come per le migrazioni, se `percorso` è dato salva prima una copia (supporti.db.esteso.bak).
+    Rifiuta la conversione se qualche movimento non è rappresentabile senza perdite.
+    """
+    if layout_compatto(conn):
+        return
+    non_convertibili = conn.execute('''
+        SELECT COUNT(*) FROM movimenti
+        WHERE date(data) IS NOT data OR articolo IS NULL OR magazzino IS NULL
+           OR direzione NOT IN ('ENTRATA', 'USCITA') OR quantita IS NULL OR quantita <= 0
+    ''').fetchone()[0]
+    if non_convertibili:
+        raise ValueError(f"{non_convertibili} movimenti hanno data, direzione o quantità non valide: "
+                         f"correggili prima di passare al formato compatto.")
+
+    if percorso:
+        copia = sqlite3.connect(f'{percorso}.esteso.bak')
+        conn.backup(copia)
+        copia.close()
+    try:
+        conn.executescript(f'BEGIN;\n{COMPATTAZIONE}\nCOMMIT;')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+# ────────────────────────────────────────────────
+# STRUMENTAZIONE
+# ────────────────────────────────────────────────
+# Ogni istruzione SQL e ogni richiesta al lavoratore viene cronometrata: i totali per
+# operazione finiscono in `statistiche` (pannello Diagnostica), le operazioni più lente
+# di SOGLIA_LENTA_MS nel log a rotazione, con il dettaglio dei tempi.
+
+FILE_LOG = 'gestione_roll.log'
+SOGLIA_LENTA_MS = 250
+
+logger = logging.getLogger('gestione_roll')
+logger.addHandler(logging.NullHandler())  # senza configura_log() (libreria, script) niente avvisi su stderr
+statistiche = {}              # operazione → [conteggio, totale ms, massimo ms]
+_blocco_statistiche = threading.Lock()
+
+def configura_log(percorso=FILE_LOG, livello=logging.INFO):
+    """Log a rotazione accanto al database: 1 MB per file, 5 file conservati."""
+    gestore = logging.handlers.RotatingFileHandler(percorso, maxBytes=1_000_000, backupCount=5, encoding='utf-8')
+    gestore.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(threadName)s %(message)s'))
+    logger.addHandler(gestore)
+    logger.setLevel(livello)
+
+def registra_tempo(operazione, ms, dettagli=''):
+    """Aggiorna le statistiche di `operazione`; se supera la soglia la scrive nel log."""
+    with _blocco_statistiche:
+        voce = statistiche.setdefault(operazione, [0, 0.0, 0.0])
+        voce[0] += 1
+        voce[1] += ms
+        voce[2] = max(voce[2], ms)
+    if ms >= SOGLIA_LENTA_MS:
+        logger.warning('LENTA %s: %.0f ms %s', operazione, ms, dettagli)
+    else:
+        logger.debug('%s: %.1f ms %s', operazione, ms, dettagli)
+
+def soglia_lenta_ms():
+    return SOGLIA_LENTA_MS
+
+def imposta_soglia_lenta(ms):
+    global SOGLIA_LENTA_MS
+    SOGLIA_LENTA_MS = ms
+
+def azzera_statistiche():
+    with _blocco_statistiche:
+        statistiche.clear()
+
+def testo_sql(sql):
+    """Istruzione su una riga, accorciata, come chiave delle statistiche."""
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= 90 else sql[:87] + '...'
+
+class ConnessioneCronometrata(sqlite3.Connection):
+    """Connessione che misura execute/executemany/executescript.
+
+    Per le SELECT il tempo comprende il calcolo fino alla prima riga: con GROUP BY e
+    ORDER BY è quasi tutto il lavoro. Il resto del fetch rientra nel tempo della richiesta.
+    """
+
+    def execute(self, sql, parametri=()):
+        inizio = time.perf_counter()
+        try:
+            return super().execute(sql, parametri)
+        finally:
+            registra_tempo(f'SQL {testo_sql(sql)}', (time.perf_counter() - inizio) * 1000)
+
+    def executemany(self, sql, parametri):
+        inizio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametri)
+        finally:
+            registra_tempo(f'SQL {testo_sql(sql)}', (time.perf_counter() - inizio) * 1000, '(executemany)')
+
+    def executescript(self, script):
+        inizio = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            registra_tempo(f'SQL {testo_sql(script)}', (time.perf_counter() - inizio) * 1000, '(script)')
+
+# Connessione database
+DB_PATH = 'supporti.db'
+
+# Più postazioni sullo stesso file. In WAL chi legge non blocca chi scrive e viceversa, ma
+# tutte le postazioni devono accedere al file con la memoria condivisa del sistema operativo:
+# su una cartella di rete (SMB/NFS) WAL non è affidabile e si usa il journal a rollback 'DELETE'.
+# Con JOURNAL_MODE None la scelta è automatica: WAL solo per un file su un disco locale
+# riconosciuto, altrimenti DELETE. La variabile d'ambiente GESTIONE_ROLL_JOURNAL=WAL|DELETE la
+# forza; tutte le postazioni che condividono il file devono usare lo stesso valore. Se il file
+# sta su una cartella di rete ma resta in WAL (lo ha aperto così una postazione sul server),
+# apri_database rifiuta di aprirlo invece di lavorarci sopra.
+JOURNAL_MODE = os.environ.get('GESTIONE_ROLL_JOURNAL', '').upper() or None
+FS_DI_RETE = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afpfs', 'fuse.sshfs', 'davfs', '9p'}
+ATTESA_BLOCCO = 10.0       # secondi che una connessione aspetta se un'altra postazione sta scrivendo
+TENTATIVI_SE_BLOCCATO = 4  # ripetizioni delle registrazioni oltre l'attesa, con pausa crescente
+
+def connetti(percorso=DB_PATH):
+    """Connessione con l'attesa sui blocchi delle altre postazioni."""
+    conn = sqlite3.connect(percorso, timeout=ATTESA_BLOCCO, factory=ConnessioneCronometrata)
+    if logger.isEnabledFor(logging.DEBUG):
+        conn.set_trace_callback(lambda sql: logger.debug('SQL %s', testo_sql(sql)))
+    return conn
+
+def su_disco_di_rete(percorso):
+    """True se il file sta su una cartella di rete, o se non si riesce a escluderlo."""
+    assoluto = os.path.realpath(percorso)
+    if os.name == 'nt':
+        if assoluto.startswith(('\\\\', '//')):
+            return True
+        import ctypes
+        return ctypes.windll.kernel32.GetDriveTypeW(os.path.splitdrive(assoluto)[0] + '\\') == 4  # DRIVE_REMOTE
+    try:
+        with open('/proc/mounts', encoding='utf-8') as f:
+            montaggi = [riga.split()[1:3] for riga in f]
+    except OSError:
+        return True
+    # il punto di montaggio più lungo che contiene il file ('/' c'è sempre)
+    contenenti = [(punto, tipo) for punto, tipo in montaggi
+                  if assoluto == punto or assoluto.startswith(punto.rstrip('/') + '/')]
+    if not contenenti:
+        return True
+    return max(contenenti, key=lambda montaggio: len(montaggio[0]))[1] in FS_DI_RETE
+
+def modo_journal(percorso):
+    modo = JOURNAL_MODE or ('DELETE' if su_disco_di_rete(percorso) else 'WAL')
+    if modo not in ('WAL', 'DELETE'):
+        raise ValueError(f"Journal non valido: {modo!r} (usa WAL o DELETE).")
+    return modo
+
+def apri_database(percorso=DB_PATH):
+    """Apre il database, lo porta all'ultima versione dello schema e imposta il journal."""
+    conn = connetti(percorso)
+    # auto_vacuum si sceglie prima di creare le tabelle; i file esistenti passano in libera_spazio()
+    if not conn.execute('SELECT EXISTS (SELECT 1 FROM sqlite_master)').fetchone()[0]:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    modo = modo_journal(percorso)
+    try:
+        conn.execute(f'PRAGMA journal_mode = {modo}')
+    except sqlite3.OperationalError as e:
+        attuale = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if attuale.upper() == 'WAL' and modo == 'DELETE' and su_disco_di_rete(percorso):
+            conn.close()
+            raise RuntimeError(
+                f"Il database {percorso} è in modalità WAL ma sta su una cartella di rete, dove WAL "
+                "può danneggiarlo. Chiudi il programma su tutte le postazioni, imposta "
+                "GESTIONE_ROLL_JOURNAL=DELETE su quella del server e riaprilo.") from e
+        # uscire da WAL richiede che nessun'altra postazione abbia il file aperto: si riprova al prossimo avvio
+        logger.warning('Journal %s non impostato, resta %s: %s', modo, attuale, e)
+    applica_migrazioni(conn, percorso)
+    return conn
+
+def ritenta_se_bloccato(funzione):
+    """Ripete funzione(conn, ...) quando il database resta bloccato oltre ATTESA_BLOCCO."""
+    @functools.wraps(funzione)
+    def con_ritentativi(conn, *args, **kwargs):
+        for tentativo in range(TENTATIVI_SE_BLOCCATO):
+            try:
+                return funzione(conn, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if 'is locked' not in str(e) or tentativo == TENTATIVI_SE_BLOCCATO - 1:
+                    raise
+                time.sleep(0.25 * 2 ** tentativo)
+    return con_ritentativi
+
+# ────────────────────────────────────────────────
+# LAVORATORE DATABASE
+# ────────────────────────────────────────────────
+
+class LavoratoreDB(threading.Thread):
+    """Esegue le query su un thread dedicato, con una connessione tutta sua.
+
+    Il thread di Tk accoda le richieste con invia() e non aspetta mai: i risultati
+    finiscono in una seconda coda che consegna_risultati() svuota dal mainloop.
+    Ogni richiesta viene cronometrata dall'accodamento alla fine della callback;
+    `conta_righe`, se data, restituisce il totale delle righe inserite nelle viste.
+    """
+
+    def __init__(self, percorso, in_errore=None, conta_righe=None):
+        super().__init__(name='lavoratore-db', daemon=True)
+        self.percorso = percorso
+        self.in_errore = in_errore
+        self.conta_righe = conta_righe
+        self.richieste = queue.Queue()
+        self.risultati = queue.Queue()
+
+    def run(self):
+        conn = connetti(self.percorso)
+        while True:
+            richiesta = self.richieste.get()
+            if richiesta is None:
+                break
+            funzione, args, al_termine, in_errore, accodata = richiesta
+            inizio = time.perf_counter()
+            try:
+                esito = funzione(conn, *args)
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.exception('Errore in %s', funzione.func.__name__)
+                self.risultati.put((in_errore or self.in_errore, e, None))
+            else:
+                tempi = (funzione.func.__name__, accodata, inizio, time.perf_counter())
+                self.risultati.put((al_termine, esito, tempi))
+        conn.close()
+
+    def invia(self, funzione, *args, al_termine=None, in_errore=None, **kwargs):
+        """Accoda funzione(conn, *args, **kwargs); al_termine(esito) sarà chiamata dal thread di Tk."""
+        self.richieste.put((functools.partial(funzione, **kwargs), args, al_termine, in_errore, time.perf_counter()))
+
+    def consegna_risultati(self):
+        while True:
+            try:
+                callback, esito, tempi = self.risultati.get_nowait()
+            except queue.Empty:
+                return
+            inizio_vista = time.perf_counter()
+            righe_prima = self.conta_righe() if self.conta_righe else 0
+            if callback is not None:
+                callback(esito)
+            if tempi:
+                nome, accodata, inizio, fine = tempi
+                fine_vista = time.perf_counter()
+                dettagli = (f'(attesa {(inizio - accodata) * 1000:.0f} ms, query {(fine - inizio) * 1000:.0f} ms, '
+                            f'consegna {(inizio_vista - fine) * 1000:.0f} ms, '
+                            f'vista {(fine_vista - inizio_vista) * 1000:.0f} ms')
+                if self.conta_righe:
+                    dettagli += f', {self.conta_righe() - righe_prima} righe inserite'
+                registra_tempo(nome, (fine_vista - accodata) * 1000, dettagli + ')')
+
+    def notifica(self, callback, valore):
+        """Dal thread del lavoratore: fa arrivare `valore` a callback sul thread di Tk."""
+        self.risultati.put((callback, valore, None))
+
+    def ferma(self):
+        self.richieste.put(None)
+        self.join()
+
+# ────────────────────────────────────────────────
+# QUERY (girano sul lavoratore, ognuna riceve la sua connessione)
+# ────────────────────────────────────────────────
+
+def ricostruisci_riepilogo(conn):
+    """Ricalcola da zero riepilogo_giornaliero (e le chiusure) a partire da movimenti."""
+    conn.execute('DELETE FROM riepilogo_giornaliero')
+    ricostruisci_riepilogo_periodo(conn, '', '9999-12-31')
+    ricalcola_chiusure(conn)
+    conn.commit()
+
+def calcola_saldo(conn, articolo=None, magazzino=None, al=None):
+    """Saldo (entrate - uscite) a fine giornata `al` (oggi se None), filtrato per articolo/magazzino.
+
+    Parte dall'ultima chiusura non successiva ad `al` e somma dal riepilogo solo i giorni dopo:
+    il costo dipende dai giorni trascorsi dalla chiusura, non dalla lunghezza dello storico.
+    """
+    conditions, params = [], []
+    if articolo:
+        conditions.append('articolo = ?')
+        params.append(articolo)
+    if magazzino:
+        conditions.append('magazzino = ?')
+        params.append(magazzino)
+    filtro = ''.join(f' AND {c}' for c in conditions)
+
+    chiusura = conn.execute('SELECT MAX(data) FROM chiusure WHERE data <= ?',
+                            (al or '9999-12-31',)).fetchone()[0] or ''
+    # prima dell'ultimo riporto i giorni dopo la chiusura stanno negli archivi
+    riepilogo = tabella_riepilogo(conn, giorno_dopo(chiusura) if chiusura else None, al)
+    result = conn.execute(f'''
+        SELECT (SELECT COALESCE(SUM(saldo), 0) FROM saldi_chiusura WHERE data = ?{filtro})
+             + (SELECT COALESCE(SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE -quantita END), 0)
+                FROM {riepilogo} WHERE data > ? AND data <= ?{filtro})
+    ''', [chiusura, *params, chiusura, al or '9999-12-31', *params]).fetchone()[0]
+    return result
+
+def calcola_chiusura(conn, data):
+    """Ricalcola i saldi della chiusura `data` dalla chiusura precedente più i giorni in mezzo."""
+    precedente = conn.execute('SELECT MAX(data) FROM chiusure WHERE data < ?', (data,)).fetchone()[0] or ''
+    conn.execute('DELETE FROM saldi_chiusura WHERE data = ?', (data,))
+    conn.execute('''
+        INSERT INTO saldi_chiusura (data, magazzino, articolo, saldo)
+        SELECT ?, magazzino, articolo, SUM(saldo)
+        FROM (
+            SELECT magazzino, articolo, saldo FROM saldi_chiusura WHERE data = ?
+            UNION ALL
+            SELECT magazzino, articolo, CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE -quantita END
+            FROM riepilogo_giornaliero WHERE data > ? AND data <= ?
+        )
+        GROUP BY magazzino, articolo
+    ''', (data, precedente, precedente, data))
+
+def ricalcola_chiusure(conn, dal=None):
+    """Ricalcola in ordine tutte le chiusure da `dal` in poi, dentro la transazione corrente.
+
+    Serve dopo le operazioni che scavalcano i trigger (inserimento massivo, ricostruzione).
+    Le chiusure fino all'ultimo riporto non si toccano: i loro giorni sono negli archivi.
+    """
+    riporto = ultimo_riporto(conn) or ''
+    for (data,) in conn.execute('SELECT data FROM chiusure WHERE data >= ? AND data > ? ORDER BY data',
+                                (dal or '', riporto)).fetchall():
+        calcola_chiusura(conn, data)
+
+def crea_chiusura(conn, data):
+    """Aggiunge (o ricalcola) la chiusura di saldo a fine giornata `data`."""
+    conn.execute('INSERT OR IGNORE INTO chiusure (data) VALUES (?)', (data,))
+    calcola_chiusura(conn, data)
+    conn.commit()
+
+def chiudi_mesi(conn, oggi=None):
+    """Crea le chiusure di fine mese mancanti, dal primo movimento all'ultimo mese concluso.
+
+    Restituisce il numero di chiusure create.
+    """
+    oggi = oggi or date.today()
+    primo = conn.execute('SELECT MIN(data) FROM riepilogo_giornaliero').fetchone()[0]
+    if primo is None:
+        return 0
+    esistenti = {d for (d,) in conn.execute('SELECT data FROM chiusure')}
+    create = 0
+    mese = date.fromisoformat(primo).replace(day=1)
+    while True:
+        successivo = (mese + timedelta(days=32)).replace(day=1)
+        fine_mese = successivo - timedelta(days=1)
+        if fine_mese >= oggi:
+            break
+        data = fine_mese.strftime('%Y-%m-%d')
+        if data not in esistenti:
+            conn.execute('INSERT INTO chiusure (data) VALUES (?)', (data,))
+            calcola_chiusura(conn, data)
+            create += 1
+        mese = successivo
+    conn.commit()
+    return create
+
+def intervallo_inserito(conn, prima):
+    """(primo_id, ultimo_id) dei movimenti inseriti dopo l'id `prima`, nella transazione in corso."""
+    return conn.execute('SELECT MIN(id), MAX(id) FROM movimenti WHERE id > ?', (prima,)).fetchone()
+
+@ritenta_se_bloccato
+def inserisci_movimenti(conn, righe):
+    """Registra le righe (data, articolo, direzione, magazzino, quantita) in un'unica transazione.
+
+    Restituisce (primo_id, ultimo_id) delle righe inserite, da passare a elimina_inserimento().
+    """
+    conn.execute('BEGIN IMMEDIATE')  # nessun'altra postazione può inserire in mezzo: gli id sono contigui
+    prima = conn.execute('SELECT COALESCE(MAX(id), 0) FROM movimenti').fetchone()[0]
+    conn.executemany(
+        'INSERT INTO movimenti (data, articolo, direzione, magazzino, quantita) VALUES (?, ?, ?, ?, ?)',
+        righe
+    )
+    intervallo = intervallo_inserito(conn, prima)
+    conn.commit()
+    return intervallo
+
+@ritenta_se_bloccato
+def inserisci_lotto(conn, righe):
+    """Registra un lotto di righe (data, articolo, direzione, magazzino, quantita) in un'unica transazione.
+
+    Restituisce (date toccate in ordine, (primo_id, ultimo_id)).
+    """
+    conn.execute('BEGIN IMMEDIATE')  # nessun'altra postazione può inserire in mezzo al lotto
+    prima = conn.execute('SELECT COALESCE(MAX(id), 0) FROM movimenti').fetchone()[0]
+    conn.executemany(
+        'INSERT INTO movimenti (data, articolo, direzione, magazzino, quantita) VALUES (?, ?, ?, ?, ?)',
+        righe
+    )
+    intervallo = intervallo_inserito(conn, prima)
+    conn.execute('INSERT INTO lotti (primo_id, ultimo_id) VALUES (?, ?)', intervallo)
+    conn.commit()
+    return sorted({r[0] for r in righe}), intervallo
+
+@ritenta_se_bloccato
+def elimina_inserimento(conn, primo, ultimo):
+    """Annulla una registrazione o un lotto di questa postazione: i movimenti con id tra `primo` e `ultimo`.
+
+    Gli id vengono da inserisci_movimenti()/inserisci_lotto() della stessa postazione: le
+    registrazioni delle altre non si toccano, nemmeno se arrivate dopo. Lettura e cancellazione
+    stanno in un'unica transazione con il blocco in scrittura. Restituisce le date toccate.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    date_toccate = [d for (d,) in conn.execute(
+        'SELECT DISTINCT data FROM movimenti WHERE id BETWEEN ? AND ? ORDER BY data', (primo, ultimo))]
+    conn.execute('DELETE FROM movimenti WHERE id BETWEEN ? AND ?', (primo, ultimo))
+    conn.execute('DELETE FROM lotti WHERE primo_id = ? AND ultimo_id = ?', (primo, ultimo))
+    conn.commit()
+    return date_toccate
+
+def svuota_movimenti(conn):
+    """Cancella tutti i movimenti, dopo averne salvato un'istantanea, e riduce il file.
+
+    Le tabelle si svuotano direttamente, senza trigger riga per riga; il registro delle
+    modifiche riparte da una sola voce TUTTI_I_GIORNI, che fa ricaricare tutto alle altre
+    postazioni. Restituisce il percorso dell'istantanea (None se non c'era nulla da salvare).
+    """
+    copia = istantanea(conn, 'azzeramento')
+    # i file di archivio restano su disco ma non fanno più parte dello storico
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        with trigger_sospesi(conn, ('movimenti', 'riepilogo_giornaliero')):
+            for tabella in ('saldi_chiusura', 'chiusure', 'riporti', 'lotti', 'riepilogo_giornaliero',
+                            'movimenti_compatti' if layout_compatto(conn) else 'movimenti',
+                            'registro_modifiche'):
+                conn.execute(f'DELETE FROM {tabella}')
+        conn.execute('INSERT INTO registro_modifiche (data) VALUES (?)', (TUTTI_I_GIORNI,))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    libera_spazio(conn)
+    return copia
+
+def dati_pagina_storico(conn, prima_di, giorni):
+    """Lista [(data, {(articolo, direzione): quantità})] dei `giorni` giorni precedenti a `prima_di`.
+
+    Gli archivi si aprono solo se il database principale non basta a riempire la pagina.
+    """
+    query = '''
+        SELECT data, direzione, articolo, SUM(quantita)
+        FROM {0}
+        WHERE data IN (
+            SELECT DISTINCT data FROM {0}
+            WHERE data < COALESCE(?, '9999-12-31')
+            ORDER BY data DESC
+            LIMIT ?
+        )
+        GROUP BY data, direzione, articolo
+        ORDER BY data DESC
+    '''
+    rows = conn.execute(query.format('riepilogo_giornaliero'), (prima_di, giorni)).fetchall()
+    if len({r[0] for r in rows}) < giorni:
+        riepilogo = tabella_riepilogo(conn, al=prima_di)
+        if riepilogo != 'riepilogo_giornaliero':
+            rows = conn.execute(query.format(riepilogo), (prima_di, giorni)).fetchall()
+
+    # Raggruppa per data
+    from collections import defaultdict
+    grouped = defaultdict(dict)
+    for data, dir_, art, qty in rows:
+        grouped[data][(art, dir_)] = qty
+    return sorted(grouped.items(), reverse=True)
+
+def condizioni_filtro_storico(filtro, prima_di=None, quantita=True):
+    """Condizioni e parametri del filtro dello Storico.
+
+    filtro è un dict con le chiavi facoltative dal, al, magazzino, articolo, direzione,
+    minimo e massimo (quantità del singolo movimento, ignorate se quantita=False).
+    """
+    conditions, params = ['data < ?'], [prima_di or '9999-12-31']
+    for chiave, condizione in (('dal', 'data >= ?'), ('al', 'data <= ?'), ('magazzino', 'magazzino = ?'),
+                               ('articolo', 'articolo = ?'), ('direzione', 'direzione = ?'),
+                               ('minimo', 'quantita >= ?'), ('massimo', 'quantita <= ?')):
+        if filtro.get(chiave) is not None and (quantita or chiave not in ('minimo', 'massimo')):
+            conditions.append(condizione)
+            params.append(filtro[chiave])
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+def filtro_su_quantita(filtro):
+    return filtro.get('minimo') is not None or filtro.get('massimo') is not None
+
+def dati_filtro_storico(conn, filtro, prima_di, giorni):
+    """Pagina dello Storico filtrato: [(data, {(articolo, direzione): quantità}, movimenti)].
+
+    I giorni sono i `giorni` precedenti a `prima_di` con almeno un movimento che rispetta il
+    filtro, per data decrescente; movimenti [(direzione, articolo, magazzino, quantita)] sono
+    solo quelli che lo rispettano. Le date vengono dal riepilogo (o dall'indice per giorno dei
+    movimenti se si filtra sulle quantità, dal più recente e un anno archiviato alla volta
+    finché la pagina non è piena) e i movimenti si leggono solo per quelle date, agganciando
+    soltanto gli archivi che le contengono.
+    """
+    al = min(filtro.get('al') or '9999-12-31', prima_di or '9999-12-31')
+    if filtro_su_quantita(filtro):
+        where, params = condizioni_filtro_storico(filtro, prima_di)
+        date_pagina = []
+        for schema in schemi_movimenti(conn, filtro.get('dal'), al, recenti_prima=True):
+            date_pagina += [d for (d,) in conn.execute(
+                f'SELECT DISTINCT data FROM {schema}.movimenti{where} ORDER BY data DESC LIMIT ?',
+                [*params, giorni - len(date_pagina)])]
+            if len(date_pagina) >= giorni:
+                break
+    else:
+        where, params = condizioni_filtro_storico(filtro, prima_di, quantita=False)
+        date_pagina = [d for (d,) in conn.execute(
+            f'SELECT DISTINCT data FROM {tabella_riepilogo(conn, filtro.get("dal"), al)}{where} '
+            f'ORDER BY data DESC LIMIT ?', [*params, giorni])]
+    if not date_pagina:
+        return []
+
+    where, params = condizioni_filtro_storico(filtro, prima_di)
+    rows = []
+    # archivi e database principale hanno date disgiunte: dal più recente l'ordine resta per data
+    for schema in schemi_movimenti(conn, date_pagina[-1], date_pagina[0], recenti_prima=True):
+        rows += conn.execute(f'''
+            SELECT data, direzione, articolo, magazzino, quantita
+            FROM {schema}.movimenti{where} AND data >= ?
+            ORDER BY data DESC, id DESC
+        ''', [*params, date_pagina[-1]]).fetchall()
+
+    pagina = {}
+    for data, dir_, art, mag, qty in rows:
+        mov_giorno, dettaglio = pagina.setdefault(data, ({}, []))
+        mov_giorno[(art, dir_)] = mov_giorno.get((art, dir_), 0) + qty
+        dettaglio.append((dir_, art, mag, qty))
+    return [(data, mov_giorno, dettaglio) for data, (mov_giorno, dettaglio) in pagina.items()]
+
+def totali_filtro_storico(conn, filtro):
+    """(movimenti, giorni, entrate, uscite) di tutto lo Storico filtrato.
+
+    Senza filtro sulle quantità bastano le righe del riepilogo; con il filtro si sommano i
+    totali di ogni anno archiviato, letti uno alla volta, e del database principale.
+    """
+    query = '''
+        SELECT COALESCE({0}, 0), COUNT(DISTINCT data),
+               COALESCE(SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita END), 0),
+               COALESCE(SUM(CASE WHEN direzione = 'USCITA' THEN quantita END), 0)
+        FROM {1}{2}
+    '''
+    al = filtro.get('al')
+    if not filtro_su_quantita(filtro):
+        where, params = condizioni_filtro_storico(filtro, quantita=False)
+        return conn.execute(query.format('SUM(num_movimenti)', tabella_riepilogo(conn, filtro.get('dal'), al), where),
+                            params).fetchone()
+    where, params = condizioni_filtro_storico(filtro)
+    totali = (0, 0, 0, 0)
+    # ogni giorno sta in un solo schema: anche i giorni distinti si possono sommare
+    for schema in schemi_movimenti(conn, filtro.get('dal'), al):
+        parziali = conn.execute(query.format('COUNT(*)', f'{schema}.movimenti', where), params).fetchone()
+        totali = tuple(map(operator.add, totali, parziali))
+    return totali
+
+def dati_dettaglio_giorno(conn, data):
+    righe = []
+    for schema in schemi_movimenti(conn, data, data):
+        righe += conn.execute(f'''
+            SELECT direzione, articolo, magazzino, quantita
+            FROM {schema}.movimenti
+            WHERE data = ?
+            ORDER BY id DESC
+        ''', (data,)).fetchall()
+    return righe
+
+# Prezzo in vigore il giorno r.data per l'articolo r.articolo (ricerca sulla chiave primaria)
+PREZZO_DEL_GIORNO = '''COALESCE((SELECT p.prezzo FROM prezzi_cauzione p
+                              WHERE p.articolo = r.articolo AND p.dal <= r.data
+                              ORDER BY p.dal DESC LIMIT 1), 0)'''
+
+def pagina_valori(conn, righe_sql, prima_di, giorni):
+    """Esegue la query dei valori giornalieri e ne restituisce una pagina per data decrescente.
+
+    `righe_sql` produce (data, articolo, direzione, quantita, valore) già prezzati; il valore
+    del giorno e il cumulato dall'inizio dello storico si calcolano in SQL con una funzione
+    finestra, così Python riceve solo i `giorni` giorni precedenti a `prima_di`.
+    Restituisce (pagina, totale): pagina [(data, {(articolo, direzione): quantità},
+    {articolo: prezzo}, valore, cumulato)], totale il cumulato all'ultimo giorno.
+    """
+    # il cumulato (ORDER BY data) comprende tutte le righe dello stesso giorno; il filtro
+    # della pagina viene dopo le finestre, che vedono quindi tutto lo storico
+    rows = conn.execute(f'''
+        SELECT data, valore_giorno, cumulato, articolo, direzione, quantita, prezzo, totale
+        FROM (
+            SELECT *, DENSE_RANK() OVER (ORDER BY data DESC) AS posizione
+            FROM (
+                SELECT data, articolo, direzione, quantita, prezzo,
+                       SUM(valore) OVER (PARTITION BY data) AS valore_giorno,
+                       SUM(valore) OVER (ORDER BY data) AS cumulato,
+                       SUM(valore) OVER () AS totale
+                FROM ({righe_sql})
+            )
+            WHERE data < COALESCE(?, '9999-12-31')
+        )
+        WHERE posizione <= COALESCE(?, posizione)
+        ORDER BY data DESC
+    ''', (prima_di, giorni)).fetchall()
+
+    pagina, totale = {}, None
+    for data, valore, cumulato, art, dir_, qty, prezzo, totale in rows:
+        giorno = pagina.setdefault(data, (data, {}, {}, valore, cumulato))
+        giorno[1][(art, dir_)] = qty
+        giorno[2][art] = prezzo
+    if totale is None:
+        totale = conn.execute(f'SELECT COALESCE(SUM(valore), 0) FROM ({righe_sql})').fetchone()[0]
+    return list(pagina.values()), totale
+
+def dati_cauzioni(conn, prima_di=None, giorni=None):
+    """Pagina di Cauzioni C/O: valore delle entrate Carne/Ortofrutta, anni archiviati compresi.
+
+    Come pagina_valori; le quantità sono per (articolo, 'ENTRATA').
+    """
+    return pagina_valori(conn, f'''
+        SELECT r.data, r.articolo, r.direzione, SUM(r.quantita) AS quantita,
+               {PREZZO_DEL_GIORNO} AS prezzo, SUM(r.quantita) * {PREZZO_DEL_GIORNO} AS valore
+        FROM {tabella_riepilogo(conn)} r
+        WHERE r.magazzino IN ('Carne', 'Ortofrutta')
+          AND r.direzione = 'ENTRATA'
+        GROUP BY r.data, r.articolo, r.direzione
+    ''', prima_di, giorni)
+
+def dati_resi(conn, prima_di=None, giorni=None):
+    """Pagina di Cauzioni e Resi: valore netto dei movimenti Freschi/Secchi, anni archiviati compresi."""
+    return pagina_valori(conn, f'''
+        SELECT r.data, r.articolo, r.direzione, SUM(r.quantita) AS quantita,
+               {PREZZO_DEL_GIORNO} AS prezzo,
+               SUM(CASE WHEN r.direzione = 'ENTRATA' THEN r.quantita ELSE -r.quantita END)
+                   * {PREZZO_DEL_GIORNO} AS valore
+        FROM {tabella_riepilogo(conn)} r
+        WHERE r.magazzino IN ('Freschi', 'Secchi')
+        GROUP BY r.data, r.articolo, r.direzione
+    ''', prima_di, giorni)
+
+def prezzi_al(conn, data):
+    """{articolo: prezzo} delle cauzioni in vigore il giorno `data`."""
+    return dict(conn.execute('''
+        SELECT articolo, prezzo FROM prezzi_cauzione p
+        WHERE dal = (SELECT MAX(dal) FROM prezzi_cauzione WHERE articolo = p.articolo AND dal <= ?)
+    ''', (data,)).fetchall())
+
+def dati_prezzi(conn):
+    """Listino completo [(articolo, dal, prezzo)], per articolo e decorrenza."""
+    return conn.execute('SELECT articolo, dal, prezzo FROM prezzi_cauzione ORDER BY articolo, dal').fetchall()
+
+DECORRENZA_BASE = '0000-01-01'  # prezzo di base, in vigore prima di ogni altra decorrenza
+
+def imposta_prezzo(conn, articolo, dal, prezzo):
+    """Registra (o corregge) il prezzo di cauzione di `articolo` in vigore da `dal`.
+
+    Come ogni cambio di prezzo, lascia nel registro delle modifiche una voce TUTTI_I_GIORNI:
+    i valori cambiano dalla decorrenza in poi e le altre postazioni ricaricano tutto.
+    """
+    if prezzo < 0:
+        raise ValueError("Il prezzo non può essere negativo.")
+    conn.execute('INSERT OR REPLACE INTO prezzi_cauzione (articolo, dal, prezzo) VALUES (?, ?, ?)',
+                 (articolo, dal, prezzo))
+    conn.execute('INSERT INTO registro_modifiche (data) VALUES (?)', (TUTTI_I_GIORNI,))
+    conn.commit()
+
+def elimina_prezzo(conn, articolo, dal):
+    """Elimina un prezzo datato; quello di base si può solo correggere."""
+    if dal == DECORRENZA_BASE:
+        raise ValueError(f"Il prezzo di base di {articolo} non si può eliminare, solo correggere.")
+    conn.execute('DELETE FROM prezzi_cauzione WHERE articolo = ? AND dal = ?', (articolo, dal))
+    conn.execute('INSERT INTO registro_modifiche (data) VALUES (?)', (TUTTI_I_GIORNI,))
+    conn.commit()
+
+def dati_giorno(conn, data):
+    """Quanto serve alle tre viste per aggiornare la sola riga di `data`, prezzi del giorno compresi."""
+    rows = conn.execute('''
+        SELECT magazzino, articolo, direzione, quantita
+        FROM riepilogo_giornaliero
+        WHERE data = ?
+    ''', (data,)).fetchall()
+
+    mov_giorno, entrate_cauzioni, dati_resi_giorno = {}, {}, {}
+    for mag, art, dir_, qty in rows:
+        mov_giorno[(art, dir_)] = mov_giorno.get((art, dir_), 0) + qty
+        if mag in ('Carne', 'Ortofrutta') and dir_ == 'ENTRATA':
+            entrate_cauzioni[(art, dir_)] = entrate_cauzioni.get((art, dir_), 0) + qty
+        elif mag in ('Freschi', 'Secchi'):
+            dati_resi_giorno[(art, dir_)] = dati_resi_giorno.get((art, dir_), 0) + qty
+    return data, mov_giorno, entrate_cauzioni, dati_resi_giorno, prezzi_al(conn, data)
+
+TUTTI_I_GIORNI = '*'  # voce del registro scritta dall'azzeramento e dai cambi di prezzo
+
+def dati_modifiche(conn, versione, dopo_id, massimo_giorni=60):
+    """Giorni modificati da altre connessioni dopo la voce `dopo_id` del registro.
+
+    Restituisce (versione, ultimo_id, giorni). Se PRAGMA data_version non è cambiata
+    nessun'altra connessione ha scritto e il registro non viene nemmeno letto. `giorni`
+    è None quando conviene ricaricare tutto: troppi giorni, voci già potate, un azzeramento
+    o un cambio di prezzo.
+    """
+    nuova = conn.execute('PRAGMA data_version').fetchone()[0]
+    if dopo_id is not None and nuova == versione:
+        return versione, dopo_id, []
+    primo, ultimo = conn.execute('SELECT MIN(id), MAX(id) FROM registro_modifiche').fetchone()
+    ultimo = max(ultimo or 0, dopo_id or 0)
+    if dopo_id is None:
+        return nuova, ultimo, []
+    if primo is not None and primo > dopo_id + 1:
+        return nuova, ultimo, None
+    giorni = [d for (d,) in conn.execute(
+        'SELECT DISTINCT data FROM registro_modifiche WHERE id > ? AND id <= ? ORDER BY data',
+        (dopo_id, ultimo))]
+    if len(giorni) > massimo_giorni or TUTTI_I_GIORNI in giorni:
+        return nuova, ultimo, None
+    return nuova, ultimo, giorni
+
+def pota_registro_modifiche(conn, conserva=50000):
+    """Tiene solo le ultime `conserva` voci del registro delle modifiche."""
+    conn.execute('DELETE FROM registro_modifiche WHERE id <= (SELECT MAX(id) FROM registro_modifiche) - ?',
+                 (conserva,))
+    conn.commit()
+
+def dati_report(conn, dal, al):
+    """Entrate/uscite per giorno × magazzino × articolo tra `dal` e `al` (inclusi), in una sola query.
+
+    Restituisce (per_giorno, totali): {data: {(magazzino, articolo): (entrate, uscite)}}
+    e {(magazzino, articolo): (entrate, uscite)} sull'intero periodo.
+    """
+    rows = conn.execute(f'''
+        SELECT data, magazzino, articolo,
+            SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE 0 END) as entrate,
+            SUM(CASE WHEN direzione = 'USCITA'  THEN quantita ELSE 0 END) as uscite
+        FROM {tabella_riepilogo(conn, dal, al)}
+        WHERE data BETWEEN ? AND ?
+        GROUP BY data, magazzino, articolo
+    ''', (dal, al)).fetchall()
+
+    from collections import defaultdict
+    per_giorno = defaultdict(dict)
+    totali = {}
+    for data, mag, art, entrate, uscite in rows:
+        per_giorno[data][(mag, art)] = (entrate, uscite)
+        tot_e, tot_u = totali.get((mag, art), (0, 0))
+        totali[(mag, art)] = (tot_e + entrate, tot_u + uscite)
+    return per_giorno, totali
+
+def filtri_movimenti(dal=None, al=None, magazzini=None, articoli=None):
+    """Clausola WHERE e parametri per i filtri comuni su data, magazzino e articolo."""
+    conditions, params = [], []
+    if dal:
+        conditions.append('data >= ?')
+        params.append(dal)
+    if al:
+        conditions.append('data <= ?')
+        params.append(al)
+    if magazzini:
+        conditions.append(f"magazzino IN ({', '.join('?' * len(magazzini))})")
+        params.extend(magazzini)
+    if articoli:
+        conditions.append(f"articolo IN ({', '.join('?' * len(articoli))})")
+        params.extend(articoli)
+    return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+def esporta_movimenti(conn, percorso, dal=None, al=None, magazzini=None, articoli=None,
+                      comprimi=None, progresso=None, blocco=5000):
+    """Scrive i movimenti filtrati in CSV a blocchi di `blocco` righe, a memoria costante.
+
+    Con comprimi=None il file è compresso gzip se il nome finisce per .gz.
+    progresso(scritte, totale) è chiamata dopo ogni blocco. Restituisce le righe scritte.
+    """
+    if comprimi is None:
+        comprimi = percorso.endswith('.gz')
+    where, params = filtri_movimenti(dal, al, magazzini, articoli)
+
+    # Il totale per l'avanzamento viene dal riepilogo, senza contare movimenti
+    totale = conn.execute(f'SELECT COALESCE(SUM(num_movimenti), 0) FROM {tabella_riepilogo(conn, dal, al)}{where}',
+                          params).fetchone()[0]
+
+    apri = gzip.open if comprimi else open
+    scritte = 0
+    with apri(percorso, 'wt', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Data', 'Articolo', 'Direzione', 'Magazzino', 'Quantità'])
+        # un anno archiviato alla volta, poi il database principale; gli id archiviati sono
+        # quelli originali: dentro ogni file l'ordine resta quello di registrazione
+        for schema in schemi_movimenti(conn, dal, al):
+            cursor = conn.execute(f'SELECT data, articolo, direzione, magazzino, quantita '
+                                  f'FROM {schema}.movimenti{where} ORDER BY id', params)
+            while True:
+                rows = cursor.fetchmany(blocco)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                scritte += len(rows)
+                if progresso:
+                    progresso(scritte, totale)
+    return scritte
+
+def leggi_movimenti_csv(f, scarti, archiviato_al=None):
+    """Genera le righe valide (data, articolo, direzione, magazzino, quantita) di un CSV
+    con le colonne di esporta_movimenti(); le righe non valide, e quelle datate entro
+    `archiviato_al` (ultimo giorno archiviato), finiscono in `scarti` come (numero_riga, motivo)."""
+    reader = csv.reader(f)
+    intestazione = [c.strip().lower() for c in next(reader, [])]
+    colonne = {'data': 'data', 'articolo': 'articolo', 'direzione': 'direzione',
+               'magazzino': 'magazzino', 'quantità': 'quantita', 'quantita': 'quantita'}
+    indici = {colonne[c]: i for i, c in enumerate(intestazione) if c in colonne}
+    mancanti = {'data', 'articolo', 'direzione', 'magazzino', 'quantita'} - indici.keys()
+    if mancanti:
+        raise ValueError(f"Intestazione non valida, mancano le colonne: {', '.join(sorted(mancanti))}")
+
+    articoli = {'Roll', 'Griglia', 'Cassetta CPR'}
+    magazzini = {'Carne', 'Ortofrutta', 'Freschi', 'Secchi'}
+
+    for numero, campi in enumerate(reader, start=2):
+        if not any(c.strip() for c in campi):
+            continue
+        try:
+            data, articolo, direzione, magazzino, quantita = (
+                campi[indici[c]].strip() for c in ('data', 'articolo', 'direzione', 'magazzino', 'quantita'))
+        except IndexError:
+            scarti.append((numero, "colonne mancanti"))
+            continue
+
+        try:
+            data = date.fromisoformat(data).strftime('%Y-%m-%d')
+        except ValueError:
+            scarti.append((numero, f"data non valida: {data!r}"))
+            continue
+        if archiviato_al and data <= archiviato_al:
+            scarti.append((numero, f"anno {data[:4]} già archiviato"))
+            continue
+        if articolo not in articoli:
+            scarti.append((numero, f"articolo sconosciuto: {articolo!r}"))
+            continue
+        if magazzino not in magazzini:
+            scarti.append((numero, f"magazzino sconosciuto: {magazzino!r}"))
+            continue
+        direzione = direzione.upper()
+        if direzione not in ('ENTRATA', 'USCITA'):
+            scarti.append((numero, f"direzione non valida: {direzione!r}"))
+            continue
+        # Come in registra_movimenti(): Carne e Ortofrutta hanno solo entrate
+        if magazzino in ('Carne', 'Ortofrutta') and direzione != 'ENTRATA':
+            scarti.append((numero, f"{magazzino} accetta solo ENTRATA"))
+            continue
+        try:
+            quantita = int(quantita)
+        except ValueError:
+            scarti.append((numero, f"quantità non intera: {quantita!r}"))
+            continue
+        if quantita <= 0:
+            scarti.append((numero, f"quantità non positiva: {quantita}"))
+            continue
+
+        yield data, articolo, direzione, magazzino, quantita
+
+def importa_movimenti(conn, percorso, progresso=None, blocco=5000):
+    """Importa un CSV (anche .gz) nel formato di esporta_movimenti() in un'unica transazione.
+
+    I trigger del riepilogo vengono sospesi durante gli inserimenti a blocchi e il
+    riepilogo è ricalcolato una volta sola, sull'intervallo di date importato; prima
+    dell'importazione si salva un'istantanea del database. Le righe degli anni già
+    archiviati vanno tra gli scarti.
+    Restituisce (importate, scarti) con scarti = [(numero_riga, motivo), ...].
+    """
+    apri = gzip.open if percorso.endswith('.gz') else open
+    scarti = []
+    istantanea(conn, 'importazione')
+
+    with apri(percorso, 'rt', newline='', encoding='utf-8-sig') as f:
+        righe = leggi_movimenti_csv(f, scarti, ultimo_riporto(conn))
+        importate = inserimento_massivo(
+            conn, righe, blocco=blocco,
+            progresso=(lambda importate: progresso(importate, len(scarti))) if progresso else None)
+    return importate, scarti
+
+@contextlib.contextmanager
+def trigger_sospesi(conn, tabelle=('movimenti',)):
+    """Toglie i trigger sulle `tabelle` per la durata del blocco e li ricrea all'uscita.
+
+    Va usato dentro una transazione: in caso di errore il rollback ripristina anche i trigger.
+    """
+    trigger = conn.execute(
+        f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ({', '.join('?' * len(tabelle))})",
+        tabelle).fetchall()
+    for nome, _ in trigger:
+        conn.execute(f'DROP TRIGGER "{nome}"')
+    yield
+    for _, sql in trigger:
+        conn.execute(sql)
+
+def inserimento_massivo(conn, righe, blocco=5000, progresso=None):
+    """Inserisce le righe (data, articolo, direzione, magazzino, quantita) in un'unica transazione.
+
+    Gli inserimenti vanno a blocchi con executemany senza trigger; riepilogo e chiusure sono
+    ricalcolati una volta sola, dalla prima data inserita. Restituisce il numero di righe.
+    """
+    inserite = 0
+    dal = al = None
+    compatto = layout_compatto(conn)
+    conn.execute('BEGIN')
+    try:
+        # nel formato compatto si scrive direttamente la tabella, che non ha trigger
+        with contextlib.nullcontext() if compatto else trigger_sospesi(conn):
+            while True:
+                lotto = list(itertools.islice(righe, blocco))
+                if not lotto:
+                    break
+                if compatto:
+                    inserisci_compatti(conn, lotto)
+                else:
+                    conn.executemany(
+                        'INSERT INTO movimenti (data, articolo, direzione, magazzino, quantita) VALUES (?, ?, ?, ?, ?)',
+                        lotto
+                    )
+                inserite += len(lotto)
+                date_lotto = [r[0] for r in lotto]
+                dal = min(date_lotto + ([dal] if dal else []))
+                al = max(date_lotto + ([al] if al else []))
+                if progresso:
+                    progresso(inserite)
+
+            if inserite:
+                ricostruisci_riepilogo_periodo(conn, dal, al)
+                ricalcola_chiusure(conn, dal)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return inserite
+
+def inserisci_compatti(conn, lotto):
+    """Inserisce le righe (data, articolo, direzione, magazzino, quantita) in movimenti_compatti."""
+    conn.executemany('INSERT OR IGNORE INTO articoli (nome) VALUES (?)', {(r[1],) for r in lotto})
+    conn.executemany('INSERT OR IGNORE INTO magazzini (nome) VALUES (?)', {(r[3],) for r in lotto})
+    conn.executemany('''
+        INSERT INTO movimenti_compatti (giorno, articolo, magazzino, quantita)
+        VALUES (CAST(julianday(?) - 2440587.5 AS INTEGER),
+                (SELECT codice FROM articoli WHERE nome = ?),
+                (SELECT codice FROM magazzini WHERE nome = ?), ?)
+    ''', ((data, articolo, magazzino, quantita if direzione == 'ENTRATA' else -quantita)
+          for data, articolo, direzione, magazzino, quantita in lotto))
+
+def ricostruisci_riepilogo_periodo(conn, dal, al):
+    """Ricalcola il riepilogo dei soli giorni tra `dal` e `al`, dentro la transazione corrente."""
+    conn.execute('DELETE FROM riepilogo_giornaliero WHERE data BETWEEN ? AND ?', (dal, al))
+    if layout_compatto(conn):
+        # si raggruppa sui codici e si decodifica una volta per gruppo, non per movimento
+        conn.execute('''
+            INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+            SELECT date(g.giorno * 86400, 'unixepoch'), m.nome, a.nome,
+                   CASE WHEN g.entrata THEN 'ENTRATA' ELSE 'USCITA' END, g.quantita, g.num_movimenti
+            FROM (
+                SELECT giorno, magazzino, articolo, quantita >= 0 AS entrata,
+                       SUM(abs(quantita)) AS quantita, COUNT(*) AS num_movimenti
+                FROM movimenti_compatti
+                WHERE date(giorno * 86400, 'unixepoch') BETWEEN ? AND ?
+                GROUP BY giorno, magazzino, articolo, entrata
+            ) g
+            JOIN articoli a ON a.codice = g.articolo
+            JOIN magazzini m ON m.codice = g.magazzino
+        ''', (dal, al))
+        return
+    conn.execute('''
+        INSERT INTO riepilogo_giornaliero (data, magazzino, articolo, direzione, quantita, num_movimenti)
+        SELECT data, magazzino, articolo, direzione, SUM(quantita), COUNT(*)
+        FROM movimenti
+        WHERE data BETWEEN ? AND ?
+        GROUP BY data, magazzino, articolo, direzione
+    ''', (dal, al))
+
+# ────────────────────────────────────────────────
+# ARCHIVI ANNUALI
+# ────────────────────────────────────────────────
+# archivia_anno sposta i movimenti di un anno concluso in un file a parte (es.
+# supporti_archivio_2023.db, con lo stesso schema) e lascia nel database principale la
+# chiusura al 31/12 come saldo riportato. SQLite regge al massimo 10 ATTACH per connessione:
+# il riepilogo di ogni archivio si copia una volta in una tabella temporanea della connessione
+# (qualche migliaio di righe l'anno, e gli archivi non cambiano più), i movimenti archiviati si
+# leggono un anno alla volta (schemi_movimenti), agganciando e staccando un archivio per volta.
+
+def giorno_dopo(data):
+    return (date.fromisoformat(data) + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def ultimo_riporto(conn):
+    """Ultimo giorno archiviato, o None se non ci sono archivi."""
+    return conn.execute('SELECT MAX(data) FROM riporti').fetchone()[0]
+
+def percorso_archivio(conn, archivio):
+    """Percorso del file di archivio, che sta nella cartella del database principale."""
+    return os.path.join(os.path.dirname(percorso_database(conn)), archivio)
+
+def riporti_tra(conn, dal=None, al=None):
+    """[(anno, archivio)] degli anni archiviati con giorni tra `dal` e `al`."""
+    return conn.execute('SELECT anno, archivio FROM riporti WHERE anno BETWEEN ? AND ? ORDER BY anno',
+                        (int((dal or '0000')[:4]), int((al or '9999')[:4]))).fetchall()
+
+def aggancia_archivio(conn, anno, archivio):
+    """Aggancia l'archivio dell'anno `anno`, se non lo è già, e ne restituisce lo schema."""
+    schema = f'archivio_{anno}'
+    if schema not in {nome for _, nome, _ in conn.execute('PRAGMA database_list')}:
+        percorso = percorso_archivio(conn, archivio)
+        # ATTACH di un file inesistente ne creerebbe uno vuoto: meglio un errore chiaro
+        if not os.path.exists(percorso):
+            raise FileNotFoundError(f"Archivio del {anno} non trovato: {percorso}")
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (percorso,))
+    return schema
+
+@contextlib.contextmanager
+def archivio_agganciato(conn, anno, archivio):
+    """Aggancia l'archivio dell'anno `anno` per la durata del blocco, se non lo era già."""
+    gia_agganciato = f'archivio_{anno}' in {nome for _, nome, _ in conn.execute('PRAGMA database_list')}
+    schema = aggancia_archivio(conn, anno, archivio)
+    try:
+        yield schema
+    finally:
+        if not gia_agganciato:
+            try:
+                conn.execute(f'DETACH DATABASE {schema}')
+            except sqlite3.OperationalError as e:
+                # un cursore lasciato a metà da un errore lo tiene occupato
+                logger.warning('Archivio %s non staccato: %s', schema, e)
+
+def schemi_movimenti(conn, dal=None, al=None, recenti_prima=False):
+    """Genera gli schemi con movimenti tra `dal` e `al`: gli archivi, dal più vecchio, poi 'main'.
+
+    Ogni archivio resta agganciato solo finché il chiamante non passa allo schema successivo,
+    quindi le sue query vanno lette per intero prima di proseguire: così anche lo storico
+    completo non supera il limite degli ATTACH. Con recenti_prima=True l'ordine è rovesciato.
+    """
+    archivi = riporti_tra(conn, dal, al)
+    if recenti_prima:
+        yield 'main'
+        archivi.reverse()
+    for anno, archivio in archivi:
+        with archivio_agganciato(conn, anno, archivio) as schema:
+            yield schema
+    if not recenti_prima:
+        yield 'main'
+
+def firma_archivio(conn, archivio):
+    """Nome, data di modifica e dimensione del file: cambiano se l'archivio viene rifatto."""
+    try:
+        stato = os.stat(percorso_archivio(conn, archivio))
+    except OSError:
+        return None
+    return f'{archivio}:{stato.st_mtime_ns}:{stato.st_size}'
+
+def carica_riepilogo_archivi(conn, dal=None, al=None):
+    """Copia in temp.riepilogo_archiviato il riepilogo degli archivi tra `dal` e `al` non ancora letti.
+
+    Ogni archivio resta agganciato solo il tempo della copia. Le copie di anni non più
+    archiviati, o di archivi rifatti nel frattempo, si scartano. Restituisce True se nel
+    periodo ci sono anni archiviati.
+    """
+    richiesti = riporti_tra(conn, dal, al)
+    if not richiesti:
+        return False
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS riepilogo_archiviato (
+            data TEXT NOT NULL,
+            magazzino TEXT NOT NULL,
+            articolo TEXT NOT NULL,
+            direzione TEXT NOT NULL,
+            quantita INTEGER NOT NULL DEFAULT 0,
+            num_movimenti INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (data, magazzino, articolo, direzione)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS archivi_letti (anno INTEGER PRIMARY KEY, firma TEXT NOT NULL)')
+    in_transazione = conn.in_transaction
+    archivi = dict(riporti_tra(conn))
+    letti = {}
+    for anno, firma in conn.execute('SELECT anno, firma FROM temp.archivi_letti').fetchall():
+        if anno in archivi and firma == firma_archivio(conn, archivi[anno]):
+            letti[anno] = firma
+        else:
+            conn.execute('DELETE FROM temp.riepilogo_archiviato WHERE data BETWEEN ? AND ?',
+                         (f'{anno}-01-01', f'{anno}-12-31'))
+            conn.execute('DELETE FROM temp.archivi_letti WHERE anno = ?', (anno,))
+    if not in_transazione and conn.in_transaction:
+        conn.commit()
+
+    for anno, archivio in richiesti:
+        if anno in letti:
+            continue
+        firma = firma_archivio(conn, archivio)
+        with archivio_agganciato(conn, anno, archivio) as schema:
+            try:
+                conn.execute(f'INSERT INTO temp.riepilogo_archiviato SELECT * FROM {schema}.riepilogo_giornaliero')
+                conn.execute('INSERT INTO temp.archivi_letti (anno, firma) VALUES (?, ?)', (anno, firma))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    return True
+
+def tabella_riepilogo(conn, dal=None, al=None):
+    """Nome o sottoquery da usare nel FROM per il riepilogo tra `dal` e `al`, archivi compresi."""
+    if not carica_riepilogo_archivi(conn, dal, al):
+        return 'riepilogo_giornaliero'
+    return '(SELECT * FROM main.riepilogo_giornaliero UNION ALL SELECT * FROM temp.riepilogo_archiviato)'
+
+def anno_archiviabile(conn):
+    """Anno più vecchio ancora nel database principale, se è già concluso; altrimenti None."""
+    primo = conn.execute('SELECT MIN(data) FROM riepilogo_giornaliero').fetchone()[0]
+    if primo is None or int(primo[:4]) >= date.today().year:
+        return None
+    return int(primo[:4])
+
+def archivia_anno(conn, anno):
+    """Sposta i movimenti dell'anno `anno`, già concluso, nel suo file di archivio.
+
+    Si archivia un anno alla volta partendo dal più vecchio. L'archivio viene scritto e
+    confermato per primo; il database principale perde i movimenti solo dopo, in una
+    transazione che registra anche il riporto: un'interruzione a metà lascia al più un
+    archivio senza riporto, che il tentativo successivo rifà da capo. Un file di archivio
+    già presente con lo stesso nome non viene mai cancellato: lo si rinomina da parte.
+    Prima si salva un'istantanea del database, dopo il file viene ridotto.
+    Restituisce (nome del file di archivio, movimenti spostati).
+    """
+    dal, al = f'{anno}-01-01', f'{anno}-12-31'
+    if al >= date.today().strftime('%Y-%m-%d'):
+        raise ValueError(f"Il {anno} non è ancora concluso.")
+    primo = conn.execute('SELECT MIN(data) FROM riepilogo_giornaliero').fetchone()[0]
+    if primo is None or primo > al:
+        raise ValueError(f"Nessun movimento del {anno} da archiviare.")
+    if primo < dal:
+        raise ValueError(f"Archivia prima gli anni precedenti: ci sono movimenti dal {primo[:4]}.")
+    istantanea(conn, 'archiviazione')
+
+    principale = conn.execute('PRAGMA database_list').fetchone()[2]
+    if not principale:
+        raise ValueError("Un database in memoria non si può archiviare.")
+    archivio = f'{os.path.splitext(os.path.basename(principale))[0]}_archivio_{anno}.db'
+    percorso = percorso_archivio(conn, archivio)
+    if os.path.exists(percorso):
+        da_parte = f"{percorso}.{time.strftime('%Y%m%d-%H%M%S')}.precedente"
+        for suffisso in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(percorso + suffisso):
+                os.replace(percorso + suffisso, da_parte + suffisso)
+        logger.warning('Archivio del %d già presente, rinominato in %s', anno, os.path.basename(da_parte))
+    # stesso schema del principale, ma senza WAL: l'archivio resta un file solo, da copiare com'è
+    nuovo = connetti(percorso)
+    applica_migrazioni(nuovo)
+    nuovo.close()
+
+    # 1. copia con gli id originali; i trigger dell'archivio ne costruiscono il riepilogo
+    attesi = conn.execute('SELECT COALESCE(SUM(num_movimenti), 0) FROM riepilogo_giornaliero '
+                          'WHERE data BETWEEN ? AND ?', (dal, al)).fetchone()[0]
+    conn.execute('ATTACH DATABASE ? AS nuovo_archivio', (percorso,))
+    try:
+        conn.execute('BEGIN')
+        try:
+            conn.execute('''
+                INSERT INTO nuovo_archivio.movimenti (id, data, articolo, direzione, magazzino, quantita)
+                SELECT id, data, articolo, direzione, magazzino, quantita
+                FROM main.movimenti WHERE data BETWEEN ? AND ?
+                ORDER BY id
+            ''', (dal, al))
+            copiati = conn.execute('SELECT COUNT(*) FROM nuovo_archivio.movimenti').fetchone()[0]
+            if copiati != attesi:
+                raise RuntimeError(f"Archivio incompleto: {copiati} movimenti copiati su {attesi}.")
+            conn.execute('DELETE FROM nuovo_archivio.registro_modifiche')
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE nuovo_archivio')
+
+    # 2. riporto e cancellazione dal database principale, senza trigger riga per riga
+    conn.execute('BEGIN')
+    try:
+        conn.execute('INSERT OR IGNORE INTO chiusure (data) VALUES (?)', (al,))
+        calcola_chiusura(conn, al)
+        conn.execute('INSERT INTO riporti (data, anno, archivio) VALUES (?, ?, ?)', (al, anno, archivio))
+        if layout_compatto(conn):
+            conn.execute("DELETE FROM movimenti_compatti WHERE date(giorno * 86400, 'unixepoch') BETWEEN ? AND ?",
+                         (dal, al))
+        else:
+            with trigger_sospesi(conn):
+                conn.execute('DELETE FROM movimenti WHERE data BETWEEN ? AND ?', (dal, al))
+        conn.execute('DELETE FROM riepilogo_giornaliero WHERE data BETWEEN ? AND ?', (dal, al))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    logger.info('Archiviato il %d in %s: %d movimenti', anno, archivio, copiati)
+    libera_spazio(conn)
+    return archivio, copiati
+
+# ────────────────────────────────────────────────
+# ANDAMENTO
+# ────────────────────────────────────────────────
+# Serie giornaliere dense (un valore per ogni giorno del periodo, anche senza movimenti) per
+# magazzino × articolo, dal riepilogo. Saldi, medie mobili e variazioni sono somme cumulative
+# sull'intera matrice con numpy, se installato; senza numpy le stesse formule girano su liste.
+
+MAGAZZINI_ANDAMENTO = ['Carne', 'Ortofrutta', 'Freschi', 'Secchi']
+ARTICOLI_ANDAMENTO = ['Roll', 'Griglia', 'Cassetta CPR']
+
+def saldi_al(conn, al):
+    """{(magazzino, articolo): saldo} a fine giornata `al`, come calcola_saldo ma per tutte le coppie."""
+    chiusura = conn.execute('SELECT MAX(data) FROM chiusure WHERE data <= ?', (al,)).fetchone()[0] or ''
+    riepilogo = tabella_riepilogo(conn, giorno_dopo(chiusura) if chiusura else None, al)
+    rows = conn.execute(f'''
+        SELECT magazzino, articolo, SUM(saldo)
+        FROM (
+            SELECT magazzino, articolo, saldo FROM saldi_chiusura WHERE data = ?
+            UNION ALL
+            SELECT magazzino, articolo, CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE -quantita END
+            FROM {riepilogo} WHERE data > ? AND data <= ?
+        )
+        GROUP BY magazzino, articolo
+    ''', (chiusura, chiusura, al)).fetchall()
+    return {(mag, art): saldo for mag, art, saldo in rows}
+
+def andamento(conn, dal, al, magazzini=None, finestra=30, punti=None):
+    """Andamento dei saldi tra `dal` e `al` per articolo, sommando i `magazzini` scelti (tutti se None).
+
+    media è la media mobile del saldo sugli ultimi `finestra` giorni, variazione la differenza
+    con il saldo di `finestra` giorni prima, valore il valore delle cauzioni dei supporti in
+    saldo al prezzo del giorno. Con `punti` le serie sono campionate a quel numero di giorni
+    (per il grafico); riepilogo ha l'ultimo giorno di ogni coppia magazzino × articolo.
+    """
+    giorni = (date.fromisoformat(al) - date.fromisoformat(dal)).days + 1
+    if giorni < 1:
+        raise ValueError("Periodo vuoto.")
+    serie = [(mag, art) for mag in MAGAZZINI_ANDAMENTO for art in ARTICOLI_ANDAMENTO]
+    iniziali = saldi_al(conn, (date.fromisoformat(dal) - timedelta(days=1)).strftime('%Y-%m-%d'))
+    iniziali = [iniziali.get(s, 0) for s in serie]
+
+    # (giorno, indice della serie, netto) già numerici, pronti per la matrice
+    codice = ' '.join(f"WHEN '{nome}' THEN {i}" for i, nome in enumerate(MAGAZZINI_ANDAMENTO))
+    codice_art = ' '.join(f"WHEN '{nome}' THEN {i}" for i, nome in enumerate(ARTICOLI_ANDAMENTO))
+    rows = conn.execute(f'''
+        SELECT CAST(julianday(data) - julianday(?) AS INTEGER),
+               (CASE magazzino {codice} END) * {len(ARTICOLI_ANDAMENTO)} + (CASE articolo {codice_art} END),
+               SUM(CASE WHEN direzione = 'ENTRATA' THEN quantita ELSE -quantita END)
+        FROM {tabella_riepilogo(conn, dal, al)}
+        WHERE data BETWEEN ? AND ?
+          AND magazzino IN ({', '.join('?' * len(MAGAZZINI_ANDAMENTO))})
+          AND articolo IN ({', '.join('?' * len(ARTICOLI_ANDAMENTO))})
+        GROUP BY data, magazzino, articolo
+    ''', (dal, dal, al, *MAGAZZINI_ANDAMENTO, *ARTICOLI_ANDAMENTO)).fetchall()
+
+    # prezzo di ogni articolo per ogni giorno: (giorno da cui vale, prezzo) in ordine
+    cambi_prezzo = {art: [] for art in ARTICOLI_ANDAMENTO}
+    for art, decorrenza, prezzo in dati_prezzi(conn):
+        if art in cambi_prezzo:
+            giorno = (date.fromisoformat(decorrenza) - date.fromisoformat(dal)).days if decorrenza > dal else 0
+            cambi_prezzo[art].append((giorno, prezzo))
+
+    scelti = [i for i, (mag, _) in enumerate(serie) if not magazzini or mag in magazzini]
+    calcola = serie_andamento_numpy if np is not None else serie_andamento_liste
+    saldi, media, variazione, valore = calcola(rows, iniziali, cambi_prezzo, giorni, finestra)
+
+    campioni = list(range(giorni))
+    if punti and giorni > punti:
+        campioni = [round(k * (giorni - 1) / (punti - 1)) for k in range(punti)]
+    inizio = date.fromisoformat(dal)
+
+    def per_articolo(matrice):
+        return {art: somma_righe(matrice, [s for s in scelti if serie[s][1] == art], campioni)
+                for art in ARTICOLI_ANDAMENTO}
+
+    return {
+        'giorni': [(inizio + timedelta(days=g)).strftime('%Y-%m-%d') for g in campioni],
+        'saldo': per_articolo(saldi),
+        'media': per_articolo(media),
+        'variazione': per_articolo(variazione),
+        'valore': somma_righe(valore, scelti, campioni),
+        'riepilogo': [(*serie[s], float(saldi[s][-1]), float(variazione[s][-1]), float(media[s][-1]))
+                      for s in scelti],
+        'numpy': np is not None,
+    }
+
+def somma_righe(matrice, righe, campioni):
+    """Somma delle righe scelte di una matrice serie × giorni, solo nei giorni `campioni`."""
+    if np is not None:
+        return matrice[righe][:, campioni].sum(axis=0).tolist()
+    return [sum(matrice[r][g] for r in righe) for g in campioni]
+
+def serie_andamento_numpy(rows, iniziali, cambi_prezzo, giorni, finestra):
+    """Matrici serie × giorni di saldo, media mobile, variazione e valore, con operazioni vettoriali."""
+    delta = np.zeros((len(iniziali), giorni))
+    if rows:
+        dati = np.array(rows, dtype=float)
+        np.add.at(delta, (dati[:, 1].astype(int), dati[:, 0].astype(int)), dati[:, 2])
+    iniziali = np.array(iniziali, dtype=float)[:, None]
+    saldi = iniziali + np.cumsum(delta, axis=1)
+
+    # media mobile dalle somme prefisse: (S[t] - S[t - finestra]) / finestra, più corta all'inizio
+    somme = np.concatenate([np.zeros((len(saldi), 1)), np.cumsum(saldi, axis=1)], axis=1)
+    fine = np.arange(1, giorni + 1)
+    inizio = np.maximum(fine - finestra, 0)
+    media = (somme[:, fine] - somme[:, inizio]) / (fine - inizio)
+
+    precedenti = np.concatenate([np.repeat(iniziali, finestra, axis=1), saldi], axis=1)[:, :giorni]
+    variazione = saldi - precedenti
+
+    prezzi = np.zeros((len(ARTICOLI_ANDAMENTO), giorni))
+    for a, art in enumerate(ARTICOLI_ANDAMENTO):
+        for giorno, prezzo in cambi_prezzo[art]:
+            prezzi[a, giorno:] = prezzo
+    valore = saldi * np.tile(prezzi, (len(MAGAZZINI_ANDAMENTO), 1))
+    return saldi, media, variazione, valore
+
+def serie_andamento_liste(rows, iniziali, cambi_prezzo, giorni, finestra):
+    """Come serie_andamento_numpy, senza numpy."""
+    delta = [[0] * giorni for _ in iniziali]
+    for giorno, s, netto in rows:
+        delta[s][giorno] += netto
+    saldi = [list(itertools.accumulate(riga, initial=iniziale))[1:] for riga, iniziale in zip(delta, iniziali)]
+
+    media, variazione = [], []
+    for riga, iniziale in zip(saldi, iniziali):
+        somme = list(itertools.accumulate(riga, initial=0))
+        media.append([(somme[t + 1] - somme[max(t + 1 - finestra, 0)]) / (t + 1 - max(t + 1 - finestra, 0))
+                      for t in range(giorni)])
+        variazione.append([riga[t] - (riga[t - finestra] if t >= finestra else iniziale) for t in range(giorni)])
+
+    prezzi = {}
+    for art in ARTICOLI_ANDAMENTO:
+        prezzi[art] = [0] * giorni
+        for giorno, prezzo in cambi_prezzo[art]:
+            prezzi[art][giorno:] = [prezzo] * (giorni - giorno)
+    articoli = ARTICOLI_ANDAMENTO * len(MAGAZZINI_ANDAMENTO)
+    valore = [[saldo * prezzo for saldo, prezzo in zip(riga, prezzi[art])] for riga, art in zip(saldi, articoli)]
+    return saldi, media, variazione, valore
+
+# ────────────────────────────────────────────────
+# RICONCILIAZIONE CEDI
+# ────────────────────────────────────────────────
+# L'estratto cauzioni del CEDI (CSV, anche .gz, uno o più depositi) si legge una riga alla
+# volta e si somma per (data, articolo, direzione): in memoria restano le sole chiavi
+# distinte, non il file. Le somme registrate per Freschi/Secchi escono dal riepilogo nello
+# stesso ordine e le due sequenze si confrontano con un'unica fusione ordinata.
+
+# Come il CEDI chiama i movimenti, dal punto di vista del punto vendita
+DIREZIONI_CEDI = {'ENTRATA': 'ENTRATA', 'CONSEGNA': 'ENTRATA', 'USCITA': 'USCITA', 'RESO': 'USCITA',
+                  'RITIRO': 'USCITA'}
+
+def leggi_estratto_cedi(f, scarti):
+    """Genera le righe valide (data, articolo, direzione, quantita, deposito) di un estratto CEDI.
+
+    Colonne obbligatorie Data, Articolo, Direzione, Quantità; facoltative Deposito e Magazzino
+    (solo Freschi o Secchi). Separatore virgola, punto e virgola o tabulazione; date
+    AAAA-MM-GG o GG/MM/AAAA. Le righe non valide finiscono in `scarti` come (numero_riga, motivo).
+    """
+    prima = f.readline()
+    separatore = max(',;\t', key=prima.count)
+    reader = csv.reader(itertools.chain([prima], f), delimiter=separatore)
+    intestazione = [c.strip().lower() for c in next(reader, [])]
+    colonne = {'data': 'data', 'articolo': 'articolo', 'direzione': 'direzione', 'quantità': 'quantita',
+               'quantita': 'quantita', 'deposito': 'deposito', 'magazzino': 'magazzino'}
+    indici = {colonne[c]: i for i, c in enumerate(intestazione) if c in colonne}
+    mancanti = {'data', 'articolo', 'direzione', 'quantita'} - indici.keys()
+    if mancanti:
+        raise ValueError(f"Intestazione non valida, mancano le colonne: {', '.join(sorted(mancanti))}")
+
+    articoli = {'Roll', 'Griglia', 'Cassetta CPR'}
+    estrai = operator.itemgetter(indici['data'], indici['articolo'], indici['direzione'], indici['quantita'])
+    i_deposito, i_magazzino = indici.get('deposito'), indici.get('magazzino')
+    # le combinazioni distinte di data, articolo, direzione e magazzino sono poche rispetto
+    # alle righe: ognuna si controlla una volta sola, poi basta una ricerca nel dizionario
+    chiavi = {}
+
+    def controlla(data, articolo, direzione, magazzino):
+        """(data, articolo, direzione) normalizzati, oppure il motivo dello scarto."""
+        data, articolo, direzione, magazzino = data.strip(), articolo.strip(), direzione.strip(), magazzino.strip()
+        try:
+            if '/' in data:
+                giorno, mese, anno = data.split('/')
+                data_iso = date(int(anno), int(mese), int(giorno)).strftime('%Y-%m-%d')
+            else:
+                data_iso = date.fromisoformat(data).strftime('%Y-%m-%d')
+        except ValueError:
+            return f"data non valida: {data!r}"
+        if articolo not in articoli:
+            return f"articolo sconosciuto: {articolo!r}"
+        if direzione.upper() not in DIREZIONI_CEDI:
+            return f"direzione non valida: {direzione!r}"
+        if magazzino and magazzino not in ('Freschi', 'Secchi'):
+            return f"magazzino non riconciliabile: {magazzino!r}"
+        return data_iso, articolo, DIREZIONI_CEDI[direzione.upper()]
+
+    for numero, campi in enumerate(reader, start=2):
+        try:
+            data, articolo, direzione, quantita = estrai(campi)
+            deposito = campi[i_deposito].strip() if i_deposito is not None else ''
+            magazzino = campi[i_magazzino] if i_magazzino is not None else ''
+        except IndexError:
+            if any(c.strip() for c in campi):
+                scarti.append((numero, "colonne mancanti"))
+            continue
+
+        grezza = (data, articolo, direzione, magazzino)
+        chiave = chiavi.get(grezza)
+        if chiave is None:
+            if not any(c.strip() for c in campi):
+                continue
+            chiave = chiavi[grezza] = controlla(*grezza)
+        if isinstance(chiave, str):
+            scarti.append((numero, chiave))
+            continue
+        try:
+            quantita = int(quantita)
+        except ValueError:
+            scarti.append((numero, f"quantità non intera: {quantita!r}"))
+            continue
+        if quantita <= 0:
+            scarti.append((numero, f"quantità non positiva: {quantita}"))
+            continue
+
+        yield (*chiave, quantita, deposito)
+
+def fondi_ordinati(a, b):
+    """Unisce due sequenze di (chiave, quantità) ordinate per chiave in (chiave, qa, qb), 0 dove manca."""
+    a, b = iter(a), iter(b)
+    x, y = next(a, None), next(b, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x[0] < y[0]):
+            yield x[0], x[1], 0
+            x = next(a, None)
+        elif x is None or y[0] < x[0]:
+            yield y[0], 0, y[1]
+            y = next(b, None)
+        else:
+            yield x[0], x[1], y[1]
+            x, y = next(a, None), next(b, None)
+
+def riconcilia_cedi(conn, percorso, progresso=None, blocco=50000):
+    """Confronta un estratto CEDI con i movimenti Freschi/Secchi registrati nello stesso periodo.
+
+    progresso(lette, scartate) è chiamata ogni `blocco` righe lette. Restituisce un dizionario
+    con il periodo, i depositi, le differenze [(data, articolo, direzione, estratto, registrato,
+    differenza, prezzo, valore)], i giorni mancanti [(data, 'registro' | 'estratto')], i valori
+    delle due parti e gli scarti. I valori hanno il segno di Cauzioni e Resi: entrate +, uscite −.
+    """
+    apri = gzip.open if percorso.endswith('.gz') else open
+    scarti, estratto, depositi, lette = [], {}, set(), 0
+    with apri(percorso, 'rt', newline='', encoding='utf-8-sig') as f:
+        for data, articolo, direzione, quantita, deposito in leggi_estratto_cedi(f, scarti):
+            chiave = (data, articolo, direzione)
+            estratto[chiave] = estratto.get(chiave, 0) + quantita
+            depositi.add(deposito)
+            lette += 1
+            if progresso and lette % blocco == 0:
+                progresso(lette, len(scarti))
+    if not estratto:
+        raise ValueError("L'estratto non contiene righe valide.")
+    dal, al = min(estratto)[0], max(estratto)[0]
+
+    registrati = conn.execute(f'''
+        SELECT data, articolo, direzione, SUM(quantita)
+        FROM {tabella_riepilogo(conn, dal, al)}
+        WHERE magazzino IN ('Freschi', 'Secchi') AND data BETWEEN ? AND ?
+        GROUP BY data, articolo, direzione
+        ORDER BY data, articolo, direzione
+    ''', (dal, al))
+
+    listino = {}
+    for articolo, decorrenza, prezzo in dati_prezzi(conn):
+        decorrenze, prezzi = listino.setdefault(articolo, ([], []))
+        decorrenze.append(decorrenza)
+        prezzi.append(prezzo)
+
+    def prezzo_del_giorno(articolo, data):
+        decorrenze, prezzi = listino.get(articolo, ((), ()))
+        posizione = bisect.bisect_right(decorrenze, data)
+        return prezzi[posizione - 1] if posizione else 0
+
+    differenze, giorni_mancanti = [], []
+    valore_estratto = valore_registrato = 0
+    giorno, nell_estratto, nel_registro = None, False, False
+    # le chiavi (data, articolo, direzione) escono in ordine: i giorni si chiudono man mano
+    for (data, articolo, direzione), q_estratto, q_registrato in fondi_ordinati(
+            sorted(estratto.items()), (((d, a, r), q) for d, a, r, q in registrati)):
+        if data != giorno:
+            if giorno is not None and nell_estratto != nel_registro:
+                giorni_mancanti.append((giorno, 'registro' if nell_estratto else 'estratto'))
+            giorno, nell_estratto, nel_registro = data, False, False
+        nell_estratto = nell_estratto or q_estratto > 0
+        nel_registro = nel_registro or q_registrato > 0
+
+        prezzo = prezzo_del_giorno(articolo, data) * (1 if direzione == 'ENTRATA' else -1)
+        valore_estratto += q_estratto * prezzo
+        valore_registrato += q_registrato * prezzo
+        if q_estratto != q_registrato:
+            differenze.append((data, articolo, direzione, q_estratto, q_registrato,
+                               q_estratto - q_registrato, abs(prezzo), (q_estratto - q_registrato) * prezzo))
+    if nell_estratto != nel_registro:
+        giorni_mancanti.append((giorno, 'registro' if nell_estratto else 'estratto'))
+
+    return {
+        'dal': dal,
+        'al': al,
+        'righe': lette,
+        'chiavi': len(estratto),
+        'depositi': sorted(d for d in depositi if d),
+        'differenze': differenze,
+        'giorni_mancanti': giorni_mancanti,
+        'valore_estratto': valore_estratto,
+        'valore_registrato': valore_registrato,
+        'scarti': scarti,
+    }
+
+def esporta_riconciliazione(esito, percorso):
+    """Scrive le differenze di riconcilia_cedi() in CSV, giorni mancanti compresi."""
+    mancanti = dict(esito['giorni_mancanti'])
+    with open(percorso, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Data', 'Articolo', 'Direzione', 'Estratto CEDI', 'Registrato', 'Differenza',
+                         'Prezzo', 'Valore differenza', 'Giorno mancante nel'])
+        for data, articolo, direzione, q_estratto, q_registrato, differenza, prezzo, valore in esito['differenze']:
+            writer.writerow([data, articolo, direzione, q_estratto, q_registrato, differenza,
+                             f"{prezzo:.2f}", f"{valore:.2f}", mancanti.get(data, '')])
+    return len(esito['differenze'])
+
+# ────────────────────────────────────────────────
+# CONSOLIDATO PUNTI VENDITA
+# ────────────────────────────────────────────────
+# Ogni punto vendita ha il suo supporti.db. Il consolidato legge ciascun file in sola lettura,
+# in un processo a parte (vedi consolida_roll.py), e somma qui gli aggregati restituiti.
+
+def connetti_sola_lettura(percorso):
+    """Connessione che non crea, non migra e non modifica il file (URI mode=ro)."""
+    if not os.path.isfile(percorso):
+        raise FileNotFoundError(f"Database non trovato: {percorso}")
+    conn = sqlite3.connect(pathlib.Path(os.path.abspath(percorso)).as_uri() + '?mode=ro', uri=True,
+                           timeout=ATTESA_BLOCCO, factory=ConnessioneCronometrata)
+    versione = conn.execute('PRAGMA user_version').fetchone()[0]
+    if versione != len(MIGRAZIONI):
+        conn.close()
+        raise RuntimeError(f"Il database è alla versione {versione}, questo programma alla {len(MIGRAZIONI)}: "
+                           "aprilo una volta con il programma aggiornato del punto vendita.")
+    return conn
+
+def riepilogo_punto_vendita(percorso, dal, al):
+    """Aggregati di un database per il consolidato, con la sua connessione in sola lettura.
+
+    Restituisce un dizionario con report e totali del periodo (come dati_report), il valore
+    cumulato di cauzioni C/O e resi CEDI, i saldi a fine `al` e l'ultimo giorno registrato.
+    """
+    conn = connetti_sola_lettura(percorso)
+    try:
+        per_giorno, totali = dati_report(conn, dal, al)
+        return {
+            'report': dict(per_giorno),
+            'totali': totali,
+            'cauzioni': dati_cauzioni(conn, None, 1)[1],
+            'resi': dati_resi(conn, None, 1)[1],
+            'saldi': saldi_al(conn, al),
+            'ultimo_giorno': conn.execute(f'SELECT MAX(data) FROM {tabella_riepilogo(conn)}').fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+def somma_punti_vendita(riepiloghi):
+    """Somma gli aggregati di riepilogo_punto_vendita() di più punti vendita, con la stessa forma."""
+    gruppo = {'report': {}, 'totali': {}, 'cauzioni': 0, 'resi': 0, 'saldi': {}, 'ultimo_giorno': None}
+    for riepilogo in riepiloghi:
+        for data, valori in riepilogo['report'].items():
+            giorno = gruppo['report'].setdefault(data, {})
+            for chiave, (entrate, uscite) in valori.items():
+                tot_e, tot_u = giorno.get(chiave, (0, 0))
+                giorno[chiave] = (tot_e + entrate, tot_u + uscite)
+        for chiave, (entrate, uscite) in riepilogo['totali'].items():
+            tot_e, tot_u = gruppo['totali'].get(chiave, (0, 0))
+            gruppo['totali'][chiave] = (tot_e + entrate, tot_u + uscite)
+        for chiave, saldo in riepilogo['saldi'].items():
+            gruppo['saldi'][chiave] = gruppo['saldi'].get(chiave, 0) + saldo
+        gruppo['cauzioni'] += riepilogo['cauzioni']
+        gruppo['resi'] += riepilogo['resi']
+        gruppo['ultimo_giorno'] = max(filter(None, (gruppo['ultimo_giorno'], riepilogo['ultimo_giorno'])), default=None)
+    gruppo['report'] = dict(sorted(gruppo['report'].items()))
+    return gruppo
+
+# ────────────────────────────────────────────────
+# BACKUP E SPAZIO LIBERO
+# ────────────────────────────────────────────────
+# Copie con l'API di backup online di SQLite: la copia avanza di PAGINE_PER_PASSO pagine per
+# volta sulla connessione di un lavoratore, mentre il programma e le altre postazioni
+# continuano a leggere e scrivere. Si scrive su un file .tmp rinominato solo a copia finita:
+# nella cartella dei backup non c'è mai una copia a metà. Oltre ai backup periodici, le
+# operazioni di massa (azzeramento, importazione, archiviazione) salvano prima un'istantanea.
+
+CARTELLA_BACKUP = 'backup'     # accanto al database
+PAGINE_PER_PASSO = 1024        # 4 MB per passo con le pagine da 4 KB
+PAUSA_TRA_PASSI = 0.005        # secondi tra un passo e l'altro, per lasciare spazio alle scritture
+INTERVALLO_BACKUP_ORE = 24     # il backup automatico parte se l'ultimo è più vecchio
+CONSERVA_BACKUP = {'automatico': 7, 'manuale': 10}
+CONSERVA_ISTANTANEE = 5        # per ogni operazione: prima_azzeramento, prima_importazione, ...
+
+def percorso_database(conn):
+    """File del database principale ('' se in memoria)."""
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+def cartella_backup(conn, cartella=None):
+    return cartella or os.path.join(os.path.dirname(percorso_database(conn)), CARTELLA_BACKUP)
+
+def elenco_backup(cartella, base, motivo=None):
+    """Backup di `base` (es. 'supporti') in `cartella`, dal più vecchio: [(percorso, quando, motivo)]."""
+    if not os.path.isdir(cartella):
+        return []
+    backup = []
+    for nome in sorted(os.listdir(cartella)):
+        if nome.startswith(base + '_') and nome.endswith('.db'):
+            quando, _, tipo = nome[len(base) + 1:-3].partition('_')
+            if len(quando) == 15 and (motivo is None or tipo == motivo):
+                backup.append((os.path.join(cartella, nome), quando, tipo))
+    return backup
+
+def crea_backup(conn, motivo='manuale', cartella=None, progresso=None):
+    """Copia online del database, a passi, in `cartella` (predefinita: backup/ accanto al file).
+
+    progresso(copiate, totale) riceve le pagine dopo ogni passo. Poi elimina i backup più
+    vecchi dello stesso motivo oltre quelli da conservare. Restituisce il percorso della copia.
+    """
+    principale = percorso_database(conn)
+    if not principale:
+        raise ValueError("Il database è in memoria: non c'è un file da copiare.")
+    cartella = cartella_backup(conn, cartella)
+    os.makedirs(cartella, exist_ok=True)
+    base = os.path.splitext(os.path.basename(principale))[0]
+    # il nome va al secondo: il .tmp creato in esclusiva lo prenota, e due copie dello stesso
+    # motivo nello stesso secondo non si sovrascrivono, la seconda prende il secondo dopo
+    while True:
+        destinazione = os.path.join(cartella, f"{base}_{time.strftime('%Y%m%d-%H%M%S')}_{motivo}.db")
+        temporaneo = destinazione + '.tmp'
+        try:
+            if os.path.exists(destinazione):
+                raise FileExistsError(destinazione)
+            open(temporaneo, 'x').close()
+            break
+        except FileExistsError:
+            time.sleep(0.2)
+
+    inizio = time.perf_counter()
+    copia = sqlite3.connect(temporaneo)
+    # In WAL una lettura aperta fissa l'istantanea da copiare: le altre connessioni continuano
+    # a scrivere e la copia non riparte da capo a ogni loro modifica. Con il journal a rollback
+    # la stessa lettura bloccherebbe chi scrive: lì i passi rilasciano il blocco, e se il file
+    # cambia nel frattempo la copia ricomincia.
+    fissa_lettura = not conn.in_transaction and conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    try:
+        if fissa_lettura:
+            conn.execute('BEGIN')
+            conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        conn.backup(copia, pages=PAGINE_PER_PASSO, sleep=PAUSA_TRA_PASSI,
+                    progress=(lambda stato, restanti, totale: progresso(totale - restanti, totale))
+                    if progresso else None)
+    except BaseException:
+        copia.close()
+        os.remove(temporaneo)
+        raise
+    finally:
+        if fissa_lettura:
+            conn.rollback()
+    copia.close()
+    os.replace(temporaneo, destinazione)
+    registra_tempo('crea_backup', (time.perf_counter() - inizio) * 1000, f'({motivo})')
+    logger.info('Backup %s: %s', motivo, destinazione)
+
+    ruota_backup(cartella, base, motivo, CONSERVA_BACKUP.get(motivo, CONSERVA_ISTANTANEE))
+    return destinazione
+
+def ruota_backup(cartella, base, motivo, conserva):
+    """Tiene gli ultimi `conserva` backup del motivo; toglie anche i .tmp rimasti da copie interrotte."""
+    for percorso, _, _ in elenco_backup(cartella, base, motivo)[:-conserva]:
+        os.remove(percorso)
+    for nome in os.listdir(cartella):
+        percorso = os.path.join(cartella, nome)
+        if nome.startswith(base + '_') and nome.endswith('.db.tmp') and time.time() - os.path.getmtime(percorso) > 86400:
+            os.remove(percorso)
+
+def backup_se_scaduto(conn, cartella=None, progresso=None):
+    """Backup automatico se l'ultimo backup automatico o manuale ha più di INTERVALLO_BACKUP_ORE ore.
+
+    Le istantanee prima delle operazioni di massa non contano: ruotano per conto loro e
+    non sostituiscono la copia periodica. Restituisce il percorso della nuova copia, o None
+    se non serviva.
+    """
+    cartella = cartella_backup(conn, cartella)
+    base = os.path.splitext(os.path.basename(percorso_database(conn)))[0]
+    backup = elenco_backup(cartella, base, 'automatico') + elenco_backup(cartella, base, 'manuale')
+    soglia = time.strftime('%Y%m%d-%H%M%S', time.localtime(time.time() - INTERVALLO_BACKUP_ORE * 3600))
+    if backup and max(quando for _, quando, _ in backup) > soglia:
+        return None
+    return crea_backup(conn, 'automatico', cartella, progresso)
+
+def istantanea(conn, operazione):
+    """Backup prima di un'operazione di massa; niente copia se non ci sono movimenti da perdere."""
+    if not percorso_database(conn):
+        return None
+    if not conn.execute('SELECT EXISTS (SELECT 1 FROM riepilogo_giornaliero)').fetchone()[0]:
+        return None
+    return crea_backup(conn, f'prima_{operazione}')
+
+def libera_spazio(conn):
+    """Restituisce al sistema le pagine liberate da una cancellazione di massa.
+
+    Con auto_vacuum incrementale basta PRAGMA incremental_vacuum; un database creato prima
+    passa a quel modo con un VACUUM completo, una volta sola. Se un'altra postazione tiene
+    il file occupato si rinuncia: lo spazio resta riutilizzabile e si recupera la volta dopo.
+    """
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        else:
+            # execute() farebbe un solo passo, cioè una pagina: executescript lo porta a termine
+            conn.executescript('PRAGMA incremental_vacuum;')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except sqlite3.OperationalError as e:
+        logger.warning('Spazio libero non recuperato: %s', e)
+        return False
+    return True